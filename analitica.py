@@ -0,0 +1,155 @@
+"""Consultas analíticas sobre respaldos PARQUET con el motor de ejecución de Arrow (Acero).
+
+Las métricas de /metricas/* y agrupaciones ad hoc sobre columnas permitidas se calculan
+sobre los respaldos que genera /respaldos, sin tocar PostgreSQL. La lectura es columnar
+(solo las columnas usadas) y los joins y agregaciones por hash (`Table.join`,
+`Table.group_by`) son planes de Acero que corren en el pool de hilos de Arrow.
+
+Sobre la misma instantánea, los resultados coinciden con los de las consultas SQL. Los
+textos se ordenan por sus bytes UTF-8, igual que una base con collation "C".
+
+Este módulo no importa FastAPI ni psycopg2.
+"""
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+SIN_ASIGNAR = "Sin asignar"
+
+# Dimensiones permitidas en `agrupar`: nombre -> columna de empleados de la que sale
+DIMENSIONES = {
+    "anio": "fecha_hora",
+    "trimestre": "fecha_hora",
+    "mes": "fecha_hora",
+    "id_departamento": "id_departamento",
+    "id_trabajo": "id_trabajo",
+    "departamento": "id_departamento",
+    "trabajo": "id_trabajo",
+}
+
+# Última versión leída de cada respaldo: ruta -> ((mtime, tamaño), columnas, tabla)
+_cache: Dict[str, Tuple[Tuple[float, int], Tuple[str, ...], object]] = {}
+_cache_lock = threading.Lock()
+
+
+def cargar_respaldo(ruta: str, columnas: Sequence[str]):
+    """pyarrow.Table con `columnas` del respaldo; `fecha_hora` (texto ISO) como timestamp.
+
+    Se guarda en memoria mientras el archivo no cambie (mtime y tamaño). Una tabla que se
+    respalda con otro nombre reemplaza a la anterior en la caché.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    estado = os.stat(ruta)
+    firma = (estado.st_mtime, estado.st_size)
+    columnas = tuple(columnas)
+    with _cache_lock:
+        previo = _cache.get(ruta)
+    if previo is not None and previo[0] == firma and set(columnas) <= set(previo[1]):
+        return previo[2].select(list(columnas))
+
+    tabla = pq.read_table(ruta, columns=list(columnas), use_threads=True)
+    if "fecha_hora" in columnas and not pa.types.is_timestamp(tabla.schema.field("fecha_hora").type):
+        indice = tabla.schema.get_field_index("fecha_hora")
+        tabla = tabla.set_column(indice, "fecha_hora", tabla.column("fecha_hora").cast(pa.timestamp("us")))
+    with _cache_lock:
+        # <directorio>/<tabla>_AAAAMMDD_HHMMSS.parquet: solo se conserva un respaldo por tabla
+        prefijo = ruta.rsplit("_", 2)[0]
+        for otra in [r for r in _cache if r.rsplit("_", 2)[0] == prefijo]:
+            del _cache[otra]
+        _cache[ruta] = (firma, columnas, tabla)
+    return tabla
+
+
+def _del_anio(empleados, anio: int):
+    import pyarrow.compute as pc
+
+    # Las fechas nulas dan una máscara nula y filter las descarta, como el WHERE del SQL
+    return empleados.filter(pc.equal(pc.year(empleados.column("fecha_hora")), anio))
+
+
+def contrataciones_por_trimestre(empleados, departamentos, trabajos, anio: int, incluir_nulos: bool = False):
+    """Contrataciones de `anio` por departamento y cargo en columnas q1..q4.
+
+    Sin `incluir_nulos` solo cuentan los empleados con departamento y cargo existentes
+    (JOIN); con él, los que no tienen se agrupan como 'Sin asignar' (LEFT JOIN + COALESCE).
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    union = "left outer" if incluir_nulos else "inner"
+    e = _del_anio(empleados, anio)
+    trimestre = pc.quarter(e.column("fecha_hora"))
+    e = pa.table({
+        "id_departamento": e.column("id_departamento"),
+        "id_trabajo": e.column("id_trabajo"),
+        **{f"q{q}": pc.equal(trimestre, q).cast(pa.int64()) for q in range(1, 5)},
+    })
+    e = e.join(departamentos.rename_columns(["id_departamento", "department"]), "id_departamento", join_type=union)
+    e = e.join(trabajos.rename_columns(["id_trabajo", "job"]), "id_trabajo", join_type=union)
+    if incluir_nulos:
+        e = e.set_column(e.schema.get_field_index("department"), "department", pc.fill_null(e.column("department"), SIN_ASIGNAR))
+        e = e.set_column(e.schema.get_field_index("job"), "job", pc.fill_null(e.column("job"), SIN_ASIGNAR))
+    agrupado = e.group_by(["department", "job"], use_threads=True).aggregate([(f"q{q}", "sum") for q in range(1, 5)])
+    resultado = pa.table({
+        "department": agrupado.column("department"),
+        "job": agrupado.column("job"),
+        **{f"q{q}": agrupado.column(f"q{q}_sum") for q in range(1, 5)},
+    })
+    return resultado.sort_by([("department", "ascending"), ("job", "ascending")])
+
+
+def departamentos_sobre_promedio(empleados, departamentos, anio: int):
+    """Departamentos con más contrataciones en `anio` que el promedio de todos (incluidos los de 0).
+
+    Orden: contrataciones descendente y, a igualdad, id ascendente.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    e = _del_anio(empleados, anio).select(["id_departamento"])
+    # count cuenta solo valores no nulos: el grupo de empleados sin departamento queda en 0
+    conteos = e.group_by("id_departamento", use_threads=True).aggregate([("id_departamento", "count")])
+    conteos = conteos.rename_columns(["hired" if c == "id_departamento_count" else c for c in conteos.column_names])
+    d = departamentos.join(conteos, "id", "id_departamento", join_type="left outer")
+    hired = pc.fill_null(d.column("hired"), 0)
+    total, cantidad = pc.sum(hired).as_py() or 0, d.num_rows
+    # hired > total / cantidad, en enteros para no depender del redondeo del promedio
+    d = pa.table({"id": d.column("id"), "department": d.column("departamento"), "hired": hired})
+    d = d.filter(pc.greater(pc.multiply(d.column("hired"), cantidad), total))
+    return d.sort_by([("hired", "descending"), ("id", "ascending")])
+
+
+def agrupar(empleados, departamentos, trabajos, dimensiones: List[str], anio: Optional[int] = None):
+    """Contrataciones (`contratados`) por las `dimensiones` pedidas (ver DIMENSIONES).
+
+    Los empleados sin el valor de una dimensión forman su propio grupo (nulo). Orden
+    ascendente por las dimensiones, con los nulos al final.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    e = _del_anio(empleados, anio) if anio is not None else empleados
+    # departamento y trabajo se agrupan por id (clave interna) y el nombre se une al final
+    claves = {d: f"_id_{d}" if d in ("departamento", "trabajo") else d for d in dimensiones}
+    columnas = {}
+    for dimension in dimensiones:
+        if dimension == "anio":
+            columnas[claves[dimension]] = pc.year(e.column("fecha_hora"))
+        elif dimension == "trimestre":
+            columnas[claves[dimension]] = pc.quarter(e.column("fecha_hora"))
+        elif dimension == "mes":
+            columnas[claves[dimension]] = pc.month(e.column("fecha_hora"))
+        else:
+            columnas[claves[dimension]] = e.column(DIMENSIONES[dimension])
+    if not columnas:
+        return pa.table({"contratados": pa.array([e.num_rows], pa.int64())})
+    agrupado = pa.table(columnas).group_by(list(columnas), use_threads=True).aggregate([([], "count_all")])
+    agrupado = agrupado.rename_columns(["contratados" if c == "count_all" else c for c in agrupado.column_names])
+    for dimension, referida in (("departamento", departamentos), ("trabajo", trabajos)):
+        if dimension in claves:
+            nombres = referida.rename_columns([claves[dimension], dimension])
+            agrupado = agrupado.join(nombres, claves[dimension], join_type="left outer")
+    resultado = agrupado.select(list(dimensiones) + ["contratados"])
+    return resultado.sort_by([(d, "ascending") for d in dimensiones])
@@ -0,0 +1,916 @@
+"""Benchmarks de rendimiento del servicio.
+
+Uso (desde la raíz del proyecto):
+    py benchmarks.py json --filas 5000
+    py benchmarks.py http --url http://127.0.0.1:8000 --anio 2021
+    py benchmarks.py escalado --max-workers 4
+    py benchmarks.py arranque --umbral-ms 1500
+    py benchmarks.py restaurar --filas 500000
+    py benchmarks.py lectura --filas 2000000 --trabajadores 4
+    py benchmarks.py reproduccion --entradas 500000 --por-transaccion 10
+    py benchmarks.py fk --filas 200000 --invalidas 0.05
+    py benchmarks.py csv --filas 2000000
+    py benchmarks.py diferido --solicitudes 2000 --clientes 16
+    py benchmarks.py contencion --escritores 8 --solicitudes 100 --filas 500
+    py benchmarks.py sin_cambios --filas 300000
+    py benchmarks.py cubo --filas 1000000,5000000
+    py benchmarks.py preparadas --anio 2021 --filas 100
+
+Cada benchmark imprime latencias p50/p95/media en milisegundos.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def medir(funcion: Callable[[], Any], repeticiones: int) -> Dict[str, float]:
+    """Ejecuta `funcion` varias veces y devuelve p50/p95/media en ms."""
+    tiempos: List[float] = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    tiempos.sort()
+    return {
+        "p50_ms": round(statistics.median(tiempos), 3),
+        "p95_ms": round(tiempos[max(0, int(len(tiempos) * 0.95) - 1)], 3),
+        "media_ms": round(statistics.mean(tiempos), 3),
+    }
+
+
+def imprimir(nombre: str, resultado: Dict[str, Any]) -> None:
+    detalle = ", ".join(f"{k}={v}" for k, v in resultado.items())
+    print(f"{nombre:<45} {detalle}")
+
+
+# =============================
+# Serialización JSON de métricas
+# =============================
+def bench_json(filas: int, repeticiones: int) -> None:
+    """Compara la serialización previa (dicts + jsonable_encoder + json) con la ruta rápida."""
+    import json
+    from fastapi.encoders import jsonable_encoder
+    import fast_api_con_rest as servicio
+
+    columnas = ("department", "job", "q1", "q2", "q3", "q4")
+    tuplas = [(f"Departamento {i % 300}", f"Trabajo {i}", i % 7, i % 5, i % 3, i % 11) for i in range(filas)]
+    # Lo que entregaba RealDictCursor: un dict por fila
+    filas_dict = [dict(zip(columnas, t)) for t in tuplas]
+
+    def ruta_previa():
+        remapeadas = [
+            {
+                "department": f.get("department"),
+                "job": f.get("job"),
+                "q1": int(f.get("q1", 0) or 0),
+                "q2": int(f.get("q2", 0) or 0),
+                "q3": int(f.get("q3", 0) or 0),
+                "q4": int(f.get("q4", 0) or 0),
+            }
+            for f in filas_dict
+        ]
+        json.dumps(jsonable_encoder(remapeadas), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def ruta_rapida():
+        servicio.a_json_bytes([dict(zip(columnas, t)) for t in tuplas])
+
+    print(f"Serialización de {filas} filas de métricas (orjson={'sí' if servicio.orjson else 'no'})")
+    imprimir("previa (RealDict + jsonable_encoder + json)", medir(ruta_previa, repeticiones))
+    imprimir("rápida (tuplas + a_json_bytes)", medir(ruta_rapida, repeticiones))
+
+
+# =============================
+# Latencia HTTP de endpoints de métricas
+# =============================
+def bench_http(url: str, anio: int, repeticiones: int) -> None:
+    """Mide la latencia extremo a extremo de los endpoints de métricas de un servidor en marcha."""
+    api_key = os.getenv("API_KEY") or ""
+    rutas = [
+        f"/metricas/contrataciones_por_trimestre?anio={anio}",
+        f"/metricas/contrataciones_por_trimestre?anio={anio}&incluir_nulos=true",
+        f"/metricas/departamentos_sobre_promedio?anio={anio}",
+    ]
+    for ruta in rutas:
+        peticion = urllib.request.Request(url.rstrip("/") + ruta, headers={"X-API-Key": api_key})
+
+        def llamar():
+            with urllib.request.urlopen(peticion) as resp:
+                resp.read()
+
+        imprimir(ruta, medir(llamar, repeticiones))
+
+
+# =============================
+# Escalado con varios workers (gunicorn)
+# =============================
+def _esperar_servidor(url: str, limite_s: float = 30.0) -> None:
+    fin = time.time() + limite_s
+    while time.time() < fin:
+        try:
+            with urllib.request.urlopen(url + "/healthz") as resp:
+                resp.read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"El servidor no respondió en {limite_s}s")
+
+
+def bench_escalado(max_workers: int, anio: int, segundos: float, clientes: int, puerto: int) -> None:
+    """Levanta gunicorn con 1..N workers y mide solicitudes/segundo contra las métricas."""
+    api_key = os.getenv("API_KEY") or ""
+    url = f"http://127.0.0.1:{puerto}"
+    ruta = f"{url}/metricas/departamentos_sobre_promedio?anio={anio}"
+    entorno = dict(os.environ, PORT=str(puerto), RATE_LIMIT_BACKEND="postgres", RATE_LIMIT_MAX_REQUESTS="100000000")
+
+    def cliente(fin: float) -> int:
+        peticion = urllib.request.Request(ruta, headers={"X-API-Key": api_key})
+        hechas = 0
+        while time.time() < fin:
+            with urllib.request.urlopen(peticion) as resp:
+                resp.read()
+            hechas += 1
+        return hechas
+
+    base = None
+    for workers in range(1, max_workers + 1):
+        entorno["WEB_CONCURRENCY"] = str(workers)
+        proceso = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "fast_api_con_rest:app"],
+            env=entorno,
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            _esperar_servidor(url)
+            fin = time.time() + segundos
+            with ThreadPoolExecutor(max_workers=clientes) as ejecutor:
+                total = sum(ejecutor.map(cliente, [fin] * clientes))
+            rps = total / segundos
+            base = base or rps
+            imprimir(f"workers={workers}", {"req_s": round(rps, 1), "aceleracion": round(rps / base, 2)})
+        finally:
+            proceso.terminate()
+            proceso.wait()
+
+
+# =============================
+# Arranque en frío
+# =============================
+_CODIGO_ARRANQUE = (
+    "import time; t0 = time.perf_counter(); import fast_api_con_rest as m; t1 = time.perf_counter(); "
+    "m._on_startup(); m.app.openapi(); t2 = time.perf_counter(); "
+    "print((t1 - t0) * 1000, (t2 - t1) * 1000)"
+)
+
+
+def perfil_importacion(top: int) -> None:
+    """Imprime los imports directos del servicio más costosos (python -X importtime)."""
+    salida = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import fast_api_con_rest"],
+        capture_output=True, text=True, check=True,
+    ).stderr
+    modulos = []
+    for linea in salida.splitlines():
+        if not linea.startswith("import time:") or "|" not in linea:
+            continue
+        _, acumulado, nombre = linea.split("|", 2)
+        sangria = len(nombre) - len(nombre.lstrip())
+        # sangría 1: el propio módulo; 3: sus imports directos
+        if sangria <= 3 and acumulado.strip().isdigit():
+            modulos.append((int(acumulado) / 1000, nombre.strip()))
+    for ms, nombre in sorted(modulos, reverse=True)[:top]:
+        print(f"  {nombre:<40} {ms:8.1f} ms")
+
+
+def bench_arranque(repeticiones: int, umbral_ms: float, top: int) -> int:
+    """Mide importación + startup (esquema, OpenAPI) en procesos nuevos.
+
+    Devuelve 1 si la mediana del total supera `umbral_ms` (para usarlo como gate en CI).
+    """
+    importacion: List[float] = []
+    arranque: List[float] = []
+    for _ in range(repeticiones):
+        salida = subprocess.run(
+            [sys.executable, "-c", _CODIGO_ARRANQUE], capture_output=True, text=True, check=True,
+        ).stdout.split()
+        importacion.append(float(salida[-2]))
+        arranque.append(float(salida[-1]))
+    total = statistics.median([a + b for a, b in zip(importacion, arranque)])
+    imprimir("importación", {"p50_ms": round(statistics.median(importacion), 1)})
+    imprimir("startup (esquema + OpenAPI)", {"p50_ms": round(statistics.median(arranque), 1)})
+    imprimir("total", {"p50_ms": round(total, 1), "umbral_ms": umbral_ms})
+    if top:
+        print("Imports más costosos:")
+        perfil_importacion(top)
+    if umbral_ms and total > umbral_ms:
+        print(f"FALLO: el arranque ({total:.1f} ms) supera el umbral de {umbral_ms} ms")
+        return 1
+    return 0
+
+
+# =============================
+# Restauración PARQUET: Arrow vs to_pylist
+# =============================
+# Se ejecuta en un proceso nuevo por motor para medir su pico de memoria (ru_maxrss, KB en
+# Linux). La transacción se revierte al final: la base no queda modificada.
+_CODIGO_RESTAURAR = """
+import resource, sys, time
+import fast_api_con_rest as m
+motor, archivo = sys.argv[1], sys.argv[2]
+base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+con = m.obtener_conexion_db()
+t0 = time.perf_counter()
+if motor == "arrow":
+    n = m.restaurar_parquet_arrow(con, "empleados_contratados", archivo)["restaurados"]
+elif motor == "reemplazar":
+    n = m.restaurar_parquet_arrow(con, "empleados_contratados", archivo, reemplazar=True)["restaurados"]
+else:
+    registros = m.leer_parquet_archivo(archivo)
+    modelos, _ = m._parsear_registros_para_tabla("empleados_contratados", registros)
+    validos, _ = m.validar_reglas_calidad("empleados_contratados", modelos, con)
+    n = sum(m.upsert_por_tabla(con, "empleados_contratados", validos, confirmar=False).values())
+segundos = time.perf_counter() - t0
+con.rollback()
+pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(n, segundos, base, pico)
+"""
+
+
+def bench_restaurar(filas: int, directorio: str) -> None:
+    """Genera un PARQUET de empleados y compara filas/s y pico de RSS de ambos motores.
+
+    "reemplazar" es el motor arrow con "modo": "reemplazar" (TRUNCATE + carga + índices).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import fast_api_con_rest as servicio
+
+    conexion = servicio.obtener_conexion_db()
+    try:
+        with conexion.cursor() as cursor:
+            cursor.execute("SELECT id FROM departamentos ORDER BY id LIMIT 100")
+            deps = [f[0] for f in cursor.fetchall()] or [None]
+            cursor.execute("SELECT id FROM trabajos ORDER BY id LIMIT 100")
+            trabajos = [f[0] for f in cursor.fetchall()] or [None]
+    finally:
+        servicio.liberar_conexion_db(conexion)
+
+    # ids altos para no pisar datos reales (igual se revierte la transacción)
+    inicio = 100_000_000
+    tabla = pa.table({
+        "id": pa.array(range(inicio, inicio + filas), type=pa.int32()),
+        "nombre": pa.array([f"Empleado {i}" for i in range(filas)]),
+        "fecha_hora": pa.array([f"2021-{1 + i % 12:02d}-{1 + i % 28:02d}T08:30:00" for i in range(filas)]),
+        "id_departamento": pa.array([deps[i % len(deps)] for i in range(filas)], type=pa.int32()),
+        "id_trabajo": pa.array([trabajos[i % len(trabajos)] for i in range(filas)], type=pa.int32()),
+    })
+    os.makedirs(directorio, exist_ok=True)
+    archivo = os.path.join(directorio, f"bench_empleados_{filas}.parquet")
+    pq.write_table(tabla, archivo)
+    del tabla
+
+    print(f"Restauración de {filas} filas de empleados desde PARQUET (transacción revertida)")
+    for motor in ("python", "arrow", "reemplazar"):
+        salida = subprocess.run(
+            [sys.executable, "-c", _CODIGO_RESTAURAR, motor, archivo],
+            capture_output=True, text=True, check=True,
+        ).stdout.split()
+        n, segundos, base, pico = int(salida[-4]), float(salida[-3]), int(salida[-2]), int(salida[-1])
+        imprimir(f"{motor}", {
+            "filas_s": round(n / segundos),
+            "segundos": round(segundos, 2),
+            "pico_rss_mb": round(pico / 1024, 1),
+            "incremento_rss_mb": round((pico - base) / 1024, 1),
+        })
+
+
+# =============================
+# Lectura de respaldos: secuencial vs paralela
+# =============================
+def bench_lectura(filas: int, trabajadores: int, directorio: str) -> None:
+    """Decodifica un AVRO y un PARQUET grandes en secuencia y en paralelo (sin base de datos)."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from fastavro import reader, writer
+    import lectura_respaldos
+    import fast_api_con_rest as servicio
+
+    os.makedirs(directorio, exist_ok=True)
+    registros = [
+        {"id": i, "nombre": f"Empleado {i}", "fecha_hora": "2021-06-01T08:30:00", "id_departamento": i % 300 + 1, "id_trabajo": i % 180 + 1}
+        for i in range(1, filas + 1)
+    ]
+    ruta_avro = os.path.join(directorio, f"bench_lectura_{filas}.avro")
+    ruta_parquet = os.path.join(directorio, f"bench_lectura_{filas}.parquet")
+    with open(ruta_avro, "wb") as f:
+        writer(f, servicio._avro_schema_para_tabla("empleados_contratados"), registros)
+    pq.write_table(pa.Table.from_pylist(registros), ruta_parquet, row_group_size=100_000)
+    del registros
+    columnas = servicio.COLUMNAS_POR_TABLA["empleados_contratados"]
+
+    def contar(lotes) -> int:
+        return sum(len(t) if isinstance(t, list) else t.num_rows for _, t in lotes)
+
+    def cronometrar(nombre: str, funcion: Callable[[], int]) -> None:
+        inicio = time.perf_counter()
+        n = funcion()
+        segundos = time.perf_counter() - inicio
+        imprimir(nombre, {"filas": n, "segundos": round(segundos, 2), "filas_s": round(n / segundos)})
+
+    print(f"Lectura de {filas} filas ({trabajadores} hilos/procesos)")
+
+    def avro_secuencial() -> int:
+        with open(ruta_avro, "rb") as f:
+            return sum(1 for _ in reader(f))
+
+    cronometrar("avro fastavro secuencial (dicts)", avro_secuencial)
+    cronometrar("avro bloques en 1 proceso (Arrow)", lambda: contar(lectura_respaldos.lotes_avro(ruta_avro, 1)))
+    cronometrar(f"avro bloques en {trabajadores} procesos (Arrow)",
+                lambda: contar(lectura_respaldos.lotes_avro(ruta_avro, trabajadores, ordenado=False, min_bytes_paralelo=0)))
+    cronometrar("parquet read_table (sin memory map)", lambda: pq.read_table(ruta_parquet, use_threads=False).num_rows)
+    cronometrar(f"parquet row groups mmap en {trabajadores} hilos",
+                lambda: contar(lectura_respaldos.lotes_parquet(ruta_parquet, columnas, trabajadores, ordenado=False)))
+
+
+
+# =============================
+# Reproducción del registro de cambios
+# =============================
+def bench_reproduccion(entradas: int, por_transaccion: int, por_segmento: int, directorio: str) -> None:
+    """Genera un registro de cambios sintético de empleados y mide lectura y reproducción.
+
+    Compara la reproducción transacción por transacción (un UPSERT por transacción
+    registrada) con la de reproducir_cambios (COPY + UPSERT por tramo). La transacción
+    se revierte.
+    """
+    import shutil
+    from datetime import timedelta, timezone
+    import psycopg2.extras as pgextras
+    import registro_cambios
+    import fast_api_con_rest as servicio
+
+    tabla = "empleados_contratados"
+    carpeta = os.path.join(directorio, "bench_registro_cambios")
+    shutil.rmtree(carpeta, ignore_errors=True)
+    esquema = servicio.esquema_arrow_tabla(tabla)
+    # ids altos para no pisar datos reales; cada id se escribe ~4 veces en el registro
+    inicio, distintos = 100_000_000, max(1, entradas // 4)
+    base = datetime.now(timezone.utc) - timedelta(hours=1)
+    for desde in range(0, entradas, por_segmento):
+        bloque = []
+        for i in range(desde, min(desde + por_segmento, entradas)):
+            secuencia = i // por_transaccion + 1
+            valores = (inicio + i % distintos, f"Empleado {i}", "2021-06-01T08:30:00", None, None)
+            bloque.append((secuencia, 1000 + secuencia, base + timedelta(microseconds=i), "upsert", valores))
+        registro_cambios.escribir_segmento(carpeta, tabla, esquema, bloque)
+
+    print(f"Registro de {entradas} entradas ({por_transaccion} por transacción, {por_segmento} por segmento)")
+    t0 = time.perf_counter()
+    cambios, leidos, _ = registro_cambios.leer_cambios(carpeta, tabla, datetime.now(timezone.utc), "1:1:")
+    segundos = time.perf_counter() - t0
+    imprimir("lectura + filtro + orden (Arrow)", {"segmentos": leidos, "entradas_s": round(entradas / segundos)})
+
+    columnas = servicio.COLUMNAS_POR_TABLA[tabla]
+    conexion = servicio.obtener_conexion_db()
+    try:
+        t0 = time.perf_counter()
+        with conexion.cursor() as cursor:
+            filas = cambios.select(["_secuencia"] + list(columnas)).to_pylist()
+            sql = (f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES %s ON CONFLICT (id) DO UPDATE SET "
+                   + ", ".join(f"{c} = EXCLUDED.{c}" for c in columnas if c != "id"))
+            for i in range(0, len(filas), por_transaccion):
+                lote = filas[i:i + por_transaccion]
+                pgextras.execute_values(cursor, sql, [tuple(f[c] for c in columnas) for f in lote])
+        segundos = time.perf_counter() - t0
+        imprimir("por transacción (execute_values)", {"entradas_s": round(entradas / segundos), "segundos": round(segundos, 2)})
+        conexion.rollback()
+
+        t0 = time.perf_counter()
+        servicio.reproducir_cambios(conexion, tabla, cambios)
+        segundos = time.perf_counter() - t0
+        imprimir("reproducir_cambios (COPY + UPSERT)", {"entradas_s": round(entradas / segundos), "segundos": round(segundos, 2)})
+    finally:
+        conexion.rollback()
+        servicio.liberar_conexion_db(conexion)
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+
+# =============================
+# Validación de FKs: Python vs SQL
+# =============================
+def bench_fk(filas: int, invalidas: float, repeticiones: int) -> None:
+    """Compara las estrategias de validar_reglas_calidad para empleados (sin escribir datos).
+
+    Una fracción `invalidas` de los registros apunta a departamentos/trabajos inexistentes.
+    """
+    import fast_api_con_rest as servicio
+
+    conexion = servicio.obtener_conexion_db()
+    try:
+        with conexion.cursor() as cursor:
+            cursor.execute("SELECT id FROM departamentos ORDER BY id LIMIT 100")
+            deps = [f[0] for f in cursor.fetchall()] or [None]
+            cursor.execute("SELECT id FROM trabajos ORDER BY id LIMIT 100")
+            trabajos = [f[0] for f in cursor.fetchall()] or [None]
+        cada = max(1, round(1 / invalidas)) if invalidas > 0 else 0
+        registros = [
+            servicio.RegistroEmpleado(
+                id=100_000_000 + i,
+                nombre=f"Empleado {i}",
+                fecha_hora=datetime(2021, 1 + i % 12, 1 + i % 28, 8, 30),
+                # ids cercanos al máximo de INTEGER: no existen
+                id_departamento=2_000_000_000 - i if cada and i % cada == 0 else deps[i % len(deps)],
+                id_trabajo=2_000_000_000 - i if cada and i % (2 * cada) == 0 else trabajos[i % len(trabajos)],
+            )
+            for i in range(filas)
+        ]
+        print(f"Validación de FKs de {filas} empleados ({invalidas:.1%} con FKs inexistentes)")
+        for estrategia in ("python", "sql"):
+            validos, errores = servicio.validar_reglas_calidad("empleados_contratados", registros, conexion, estrategia)
+            stats = medir(lambda: servicio.validar_reglas_calidad("empleados_contratados", registros, conexion, estrategia), repeticiones)
+            stats.update({"filas_s": round(filas / (stats["media_ms"] / 1000)), "validos": len(validos), "errores": len(errores)})
+            imprimir(estrategia, stats)
+            conexion.rollback()
+    finally:
+        conexion.rollback()
+        servicio.liberar_conexion_db(conexion)
+
+
+# =============================
+# Lectura de CSV históricos: csv.reader vs pyarrow
+# =============================
+def bench_csv(filas: int, directorio: str) -> None:
+    """Genera un hired_employees.csv sintético y mide MB/s de ambos lectores de modelos.py (sin base de datos).
+
+    El motor arrow además convierte tipos y filtra (trabajo que el lector previo deja
+    para insertar_lote_empleados), así que la comparación le es desfavorable.
+    """
+    import modelos
+
+    os.makedirs(directorio, exist_ok=True)
+    ruta = os.path.join(directorio, f"bench_{filas}_hired_employees.csv")
+    with open(ruta, "w", encoding="utf-8") as f:
+        f.write("id,name,datetime,department_id,job_id\n")
+        for i in range(filas):
+            # ~1% sin departamento, ~1% sin fecha: ejercita el relleno de nulos
+            fecha = "" if i % 97 == 0 else f"2021-{1 + i % 12:02d}-{1 + i % 28:02d}T08:30:00Z"
+            departamento = "" if i % 101 == 0 else 1 + i % 12
+            f.write(f"{i + 1},Empleado {i},{fecha},{departamento},{1 + i % 180}\n")
+    megabytes = os.path.getsize(ruta) / (1024 * 1024)
+    print(f"Lectura de {filas} filas ({megabytes:.1f} MB) de hired_employees.csv")
+
+    def python() -> int:
+        return sum(len(lote) for lote, _ in modelos.procesar_csv_por_lotes(ruta))
+
+    def arrow() -> int:
+        return sum(lote.num_rows for lote, _ in modelos.procesar_csv_arrow(ruta, modelos.COLUMNAS_EMPLEADOS))
+
+    try:
+        for nombre, funcion in (("python (csv.reader)", python), ("arrow (multihilo, tipado)", arrow)):
+            inicio = time.perf_counter()
+            n = funcion()
+            segundos = time.perf_counter() - inicio
+            imprimir(nombre, {"filas": n, "segundos": round(segundos, 2), "mb_s": round(megabytes / segundos, 1)})
+    finally:
+        os.remove(ruta)
+
+
+# =============================
+# Escritura diferida: commit por solicitud vs bitácora con fsync en grupo
+# =============================
+def bench_diferido(solicitudes: int, clientes: int, por_solicitud: int, directorio: str) -> None:
+    """Muchos productores pequeños contra /transacciones (en proceso, sin HTTP): directo vs diferido.
+
+    Usa ids altos de departamentos y los borra al final.
+    """
+    import shutil
+
+    os.environ["ESCRITURA_DIFERIDA_DIR"] = os.path.join(directorio, "bench_escritura_diferida")
+    import fast_api_con_rest as servicio
+
+    inicio_ids = 2_000_000_000 - 2 * solicitudes * por_solicitud
+
+    def medir_modo(diferido: bool, desplazamiento: int) -> None:
+        def producir(i: int) -> None:
+            base = inicio_ids + desplazamiento + i * por_solicitud
+            payload = {"departamentos": [{"id": base + j, "departamento": f"Bench {j}"} for j in range(por_solicitud)]}
+            servicio.recibir_transacciones(payload, None, diferido)
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clientes) as pool:
+            list(pool.map(producir, range(solicitudes)))
+        respuesta = time.perf_counter() - t0
+        if diferido:
+            servicio._escritor_diferido.vaciar()
+        total = time.perf_counter() - t0
+        imprimir("diferido" if diferido else "directo", {
+            "solicitudes_s": round(solicitudes / respuesta),
+            "filas_s_hasta_la_base": round(solicitudes * por_solicitud / total),
+            "segundos": round(total, 2),
+        })
+
+    print(f"{solicitudes} solicitudes de {por_solicitud} filas desde {clientes} clientes")
+    try:
+        medir_modo(False, 0)
+        medir_modo(True, solicitudes * por_solicitud)
+    finally:
+        servicio._escritor_diferido.cerrar()
+        conexion = servicio.obtener_conexion_db()
+        try:
+            with conexion.cursor() as cursor:
+                cursor.execute("DELETE FROM departamentos WHERE id >= %s", (inicio_ids,))
+            conexion.commit()
+        finally:
+            servicio.liberar_conexion_db(conexion)
+        shutil.rmtree(os.environ["ESCRITURA_DIFERIDA_DIR"], ignore_errors=True)
+
+
+# =============================
+# Upserts concurrentes sobre los mismos ids
+# =============================
+def bench_contencion(escritores: int, solicitudes: int, filas: int, rango: int, duplicados: float, sin_orden: bool) -> None:
+    """Escritores concurrentes de empleados con ids solapados, en orden aleatorio y con ids
+    repetidos dentro del lote. Cuenta fallas, reintentos y filas/s; con `sin_orden` también
+    mide escribir en el orden de llegada (con reintentos). Borra los ids al final.
+    """
+    import random
+
+    import fast_api_con_rest as servicio
+
+    conexion = servicio.obtener_conexion_db()
+    try:
+        with conexion.cursor() as cursor:
+            cursor.execute("SELECT (SELECT min(id) FROM departamentos), (SELECT min(id) FROM trabajos)")
+            id_departamento, id_trabajo = cursor.fetchone()
+        conexion.commit()
+    finally:
+        servicio.liberar_conexion_db(conexion)
+    base = 2_000_000_000 - rango
+
+    def payload(rnd: random.Random) -> Dict[str, Any]:
+        ids = rnd.sample(range(base, base + rango), filas)
+        ids += rnd.choices(ids, k=int(filas * duplicados))
+        rnd.shuffle(ids)
+        return {"empleados_contratados": [
+            {"id": i, "nombre": f"Bench {rnd.random():.6f}", "fecha_hora": "2021-01-01T00:00:00Z",
+             "id_departamento": id_departamento, "id_trabajo": id_trabajo}
+            for i in ids[:1000]
+        ]}
+
+    def medir_modo(nombre: str) -> None:
+        fallas: List[str] = []
+        reintentos_antes = dict(servicio.reintentos_por_conflicto)
+
+        def escritor(n: int) -> None:
+            rnd = random.Random(n)
+            for _ in range(solicitudes):
+                try:
+                    servicio.recibir_transacciones(payload(rnd), None, False)
+                except Exception as e:
+                    fallas.append(str(e).splitlines()[0])
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=escritores) as pool:
+            list(pool.map(escritor, range(escritores)))
+        segundos = time.perf_counter() - t0
+        reintentos = {c: n - reintentos_antes.get(c, 0) for c, n in servicio.reintentos_por_conflicto.items()}
+        imprimir(nombre, {
+            "filas_s": round(escritores * solicitudes * filas / segundos),
+            "fallas": len(fallas),
+            "reintentos": sum(reintentos.values()),
+            "deadlocks": reintentos.get("40P01", 0),
+        })
+        for falla in sorted(set(fallas))[:3]:
+            print(f"  {falla}")
+
+    print(f"{escritores} escritores x {solicitudes} solicitudes de {filas} filas (+{duplicados:.0%} repetidas) sobre {rango} ids")
+    ordenar = servicio._ordenar_sin_duplicados
+    try:
+        medir_modo("orden_por_id")
+        if not sin_orden:
+            return
+        # Sin ordenar: solo se quitan los repetidos (si no, ON CONFLICT falla en cada lote)
+        servicio._ordenar_sin_duplicados = lambda registros: list({r.id: r for r in registros}.values())
+        medir_modo("orden_de_llegada")
+    finally:
+        servicio._ordenar_sin_duplicados = ordenar
+        conexion = servicio.obtener_conexion_db()
+        try:
+            with conexion.cursor() as cursor:
+                cursor.execute("DELETE FROM empleados_contratados WHERE id >= %s", (base,))
+            conexion.commit()
+        finally:
+            servicio.liberar_conexion_db(conexion)
+
+
+# =============================
+# Re-restaurar un respaldo idéntico: filas sin cambios no se reescriben
+# =============================
+def bench_sin_cambios(filas: int, directorio: str) -> None:
+    """Restaura (motor arrow, con commit) un PARQUET de empleados con ids altos tres veces:
+    carga inicial, el mismo archivo otra vez y uno con todos los nombres cambiados (lo que
+    costaba antes re-restaurar un respaldo idéntico). Mide filas/s, WAL generado y tuplas
+    muertas. Borra los ids al final.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import fast_api_con_rest as servicio
+
+    conexion = servicio.obtener_conexion_db()
+    try:
+        with conexion.cursor() as cursor:
+            cursor.execute("SELECT (SELECT min(id) FROM departamentos), (SELECT min(id) FROM trabajos)")
+            id_departamento, id_trabajo = cursor.fetchone()
+        conexion.commit()
+    finally:
+        servicio.liberar_conexion_db(conexion)
+
+    inicio = 100_000_000
+    os.makedirs(directorio, exist_ok=True)
+    archivos = {}
+    for nombre, sufijo in (("identico", ""), ("modificado", " v2")):
+        tabla = pa.table({
+            "id": pa.array(range(inicio, inicio + filas), type=pa.int32()),
+            "nombre": pa.array([f"Empleado {i}{sufijo}" for i in range(filas)]),
+            "fecha_hora": pa.array([f"2021-{1 + i % 12:02d}-{1 + i % 28:02d}T08:30:00" for i in range(filas)]),
+            "id_departamento": pa.array([id_departamento] * filas, type=pa.int32()),
+            "id_trabajo": pa.array([id_trabajo] * filas, type=pa.int32()),
+        })
+        archivos[nombre] = os.path.join(directorio, f"bench_sin_cambios_{nombre}_{filas}.parquet")
+        pq.write_table(tabla, archivos[nombre])
+    del tabla
+
+    def restaurar(nombre: str, archivo: str) -> None:
+        conexion = servicio.obtener_conexion_db()
+        try:
+            with conexion.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_current_wal_insert_lsn(), n_dead_tup FROM pg_stat_user_tables "
+                    "WHERE relname = 'empleados_contratados'"
+                )
+                lsn, muertas = cursor.fetchone()
+            conexion.commit()
+            t0 = time.perf_counter()
+            resultado = servicio.restaurar_parquet_arrow(conexion, "empleados_contratados", archivo)
+            conexion.commit()
+            segundos = time.perf_counter() - t0
+            with conexion.cursor() as cursor:
+                cursor.execute("SELECT pg_stat_force_next_flush()")
+                cursor.execute(
+                    "SELECT pg_wal_lsn_diff(pg_current_wal_insert_lsn(), %s), n_dead_tup FROM pg_stat_user_tables "
+                    "WHERE relname = 'empleados_contratados'",
+                    (lsn,),
+                )
+                wal, muertas_despues = cursor.fetchone()
+            conexion.commit()
+        finally:
+            servicio.liberar_conexion_db(conexion)
+        imprimir(nombre, {
+            "filas_s": round(filas / segundos),
+            "wal_mb": round(float(wal) / 1024 / 1024, 1),
+            "tuplas_muertas": muertas_despues - muertas,
+            **resultado["conteos"],
+        })
+
+    print(f"Restauración de {filas} filas de empleados, tres veces seguidas")
+    try:
+        restaurar("carga_inicial", archivos["identico"])
+        restaurar("mismo_respaldo", archivos["identico"])
+        restaurar("todas_cambian", archivos["modificado"])
+    finally:
+        conexion = servicio.obtener_conexion_db()
+        try:
+            with conexion.cursor() as cursor:
+                cursor.execute("DELETE FROM empleados_contratados WHERE id >= %s", (inicio,))
+            conexion.commit()
+        finally:
+            servicio.liberar_conexion_db(conexion)
+
+
+
+# =============================
+# Cubo de contrataciones en memoria: memoria por millón de filas y latencias
+# =============================
+def bench_cubo(tamanos: List[int], departamentos: int, trabajos: int, repeticiones: int) -> None:
+    """Carga en el cubo empleados sintéticos (10 años, 5% con FKs o fecha nulas) y mide
+    la memoria de los arreglos (nbytes y tracemalloc, que ve las asignaciones de NumPy),
+    las dos métricas y la aplicación de deltas de 1000 filas (mitad nuevas). No usa la base.
+    """
+    import tracemalloc
+    import numpy as np
+    from cubo_contrataciones import NULO, CuboContrataciones
+
+    nombres_dep = {i: f"Departamento {i}" for i in range(1, departamentos + 1)}
+    nombres_trab = {i: f"Cargo {i}" for i in range(1, trabajos + 1)}
+    generador = np.random.default_rng(1)
+
+    def empleados(inicio: int, filas: int) -> Dict[str, Any]:
+        nulos = generador.random(filas) < 0.05
+        anio = generador.integers(2015, 2025, filas).astype(np.int16)
+        return {
+            "id": np.arange(inicio, inicio + filas, dtype=np.int32),
+            "departamento": np.where(nulos, NULO, generador.integers(1, departamentos + 1, filas)).astype(np.int32),
+            "trabajo": np.where(generador.random(filas) < 0.05, NULO, generador.integers(1, trabajos + 1, filas)).astype(np.int32),
+            "anio": np.where(generador.random(filas) < 0.05, 0, anio).astype(np.int16),
+            "trimestre": generador.integers(1, 5, filas).astype(np.int16),
+        }
+
+    for filas in tamanos:
+        columnas = empleados(1, filas)
+        cubo = CuboContrataciones()
+        tracemalloc.start()
+        inicio = time.perf_counter()
+        cubo.cargar(columnas, nombres_dep, nombres_trab, {})
+        carga_s = time.perf_counter() - inicio
+        del columnas
+        actual, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        metricas = cubo.metricas()
+        imprimir(f"cubo {filas} filas", {
+            "bytes_empleados": metricas["bytes_empleados"],
+            "MB_por_millon": round(metricas["bytes_empleados"] / filas, 1),
+            "MB_tracemalloc": round(actual / 1e6, 1),
+            "MB_pico_carga": round(pico / 1e6, 1),
+            "MB_diccionarios": round(metricas["bytes_diccionarios"] / 1e6, 2),
+            "carga_s": round(carga_s, 2),
+        })
+        imprimir("  contrataciones_por_trimestre", medir(lambda: cubo.contrataciones_por_trimestre(2020), repeticiones))
+        imprimir("  contrataciones_por_trimestre (nulos)", medir(lambda: cubo.contrataciones_por_trimestre(2020, True), repeticiones))
+        imprimir("  departamentos_sobre_promedio", medir(lambda: cubo.departamentos_sobre_promedio(2020), repeticiones))
+        siguiente = [filas + 1]
+
+        def delta() -> None:
+            lote = empleados(siguiente[0], 1000)
+            # La mitad actualiza empleados existentes
+            lote["id"][:500] = generador.integers(1, filas + 1, 500)
+            cubo.aplicar_empleados(lote)
+            siguiente[0] += 1000
+
+        imprimir("  delta de 1000 filas", medir(delta, repeticiones))
+
+
+# =============================
+# Sentencias preparadas vs texto: FKs, métricas y upserts
+# =============================
+def bench_preparadas(anio: int, filas: int, repeticiones: int) -> None:
+    """Mide las sentencias registradas con SENTENCIAS_PREPARADAS activo y sin él, en la misma
+    conexión: consulta de FKs con `filas` ids, las dos métricas de `anio` y un upsert de
+    `filas` departamentos nuevos que se deshace con rollback.
+    """
+    import fast_api_con_rest as servicio
+
+    conexion = servicio.obtener_conexion_db()
+    try:
+        with conexion.cursor() as cursor:
+            cursor.execute("SELECT id FROM departamentos ORDER BY id LIMIT %s", (filas,))
+            ids = [f[0] for f in cursor.fetchall()]
+        conexion.rollback()
+        registros = [servicio.RegistroDepartamento(id=2_000_000_000 - i, departamento=f"Bench {i}") for i in range(filas)]
+
+        def consulta(nombre: str, parametros: tuple) -> Callable[[], Any]:
+            def ejecutar() -> None:
+                with conexion.cursor() as cursor:
+                    servicio.ejecutar_preparada(cursor, nombre, parametros)
+                    cursor.fetchall()
+                conexion.rollback()
+            return ejecutar
+
+        def upsert() -> None:
+            servicio.upsert_departamentos(conexion, registros, confirmar=False)
+            conexion.rollback()
+
+        casos = {
+            f"fk_departamentos ({len(ids)} ids)": consulta(servicio.SQL_FK_DEPARTAMENTOS, (ids,)),
+            "metricas_trimestres": consulta(servicio.SQL_TRIMESTRES, (anio,)),
+            "metricas_trimestres_con_nulos": consulta(servicio.SQL_TRIMESTRES_CON_NULOS, (anio,)),
+            "metricas_sobre_promedio": consulta(servicio.SQL_SOBRE_PROMEDIO, (anio,)),
+            f"upsert_departamentos ({filas} filas)": upsert,
+        }
+        for activo in (False, True):
+            servicio.SENTENCIAS_PREPARADAS = activo
+            print(f"SENTENCIAS_PREPARADAS={str(activo).lower()}")
+            for nombre, funcion in casos.items():
+                funcion()  # calentamiento: en modo preparado envía el PREPARE
+                imprimir(f"  {nombre}", medir(funcion, repeticiones))
+    finally:
+        conexion.rollback()
+        servicio.liberar_conexion_db(conexion)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks del servicio de ingesta")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p_json = sub.add_parser("json", help="Serialización JSON de respuestas de métricas")
+    p_json.add_argument("--filas", type=int, default=5000)
+    p_json.add_argument("--repeticiones", type=int, default=30)
+
+    p_http = sub.add_parser("http", help="Latencia HTTP de los endpoints de métricas")
+    p_http.add_argument("--url", default="http://127.0.0.1:8000")
+    p_http.add_argument("--anio", type=int, default=datetime.now().year)
+    p_http.add_argument("--repeticiones", type=int, default=30)
+
+    p_esc = sub.add_parser("escalado", help="Solicitudes/segundo con 1..N workers de gunicorn")
+    p_esc.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    p_esc.add_argument("--anio", type=int, default=datetime.now().year)
+    p_esc.add_argument("--segundos", type=float, default=10.0)
+    p_esc.add_argument("--clientes", type=int, default=32)
+    p_esc.add_argument("--puerto", type=int, default=8765)
+
+    p_arr = sub.add_parser("arranque", help="Tiempo de arranque en frío; falla si supera el umbral")
+    p_arr.add_argument("--repeticiones", type=int, default=5)
+    p_arr.add_argument("--umbral-ms", type=float, default=float(os.getenv("ARRANQUE_UMBRAL_MS", "1500")))
+    p_arr.add_argument("--top", type=int, default=10, help="imports más costosos a mostrar (0 = ninguno)")
+
+    p_res = sub.add_parser("restaurar", help="Restauración PARQUET: python vs arrow vs reemplazar (filas/s y pico de RSS)")
+    p_res.add_argument("--filas", type=int, default=500_000)
+    p_res.add_argument("--directorio", default="respaldos")
+
+    p_lec = sub.add_parser("lectura", help="Decodificación de respaldos AVRO/PARQUET: secuencial vs paralela")
+    p_lec.add_argument("--filas", type=int, default=2_000_000)
+    p_lec.add_argument("--trabajadores", type=int, default=os.cpu_count() or 1)
+    p_lec.add_argument("--directorio", default="respaldos")
+
+    p_rep = sub.add_parser("reproduccion", help="Reproducción del registro de cambios: por transacción vs por tramos")
+    p_rep.add_argument("--entradas", type=int, default=500_000)
+    p_rep.add_argument("--por-transaccion", type=int, default=10)
+    p_rep.add_argument("--por-segmento", type=int, default=50_000)
+    p_rep.add_argument("--directorio", default="respaldos")
+
+    p_fk = sub.add_parser("fk", help="Validación de FKs de empleados: en Python vs en la base")
+    p_fk.add_argument("--filas", type=int, default=200_000)
+    p_fk.add_argument("--invalidas", type=float, default=0.05)
+    p_fk.add_argument("--repeticiones", type=int, default=5)
+
+    p_csv = sub.add_parser("csv", help="Lectura de CSV históricos: csv.reader vs pyarrow multihilo (MB/s)")
+    p_csv.add_argument("--filas", type=int, default=2_000_000)
+    p_csv.add_argument("--directorio", default="respaldos")
+
+    p_dif = sub.add_parser("diferido", help="/transacciones con commit por solicitud vs escritura diferida")
+    p_dif.add_argument("--solicitudes", type=int, default=2000)
+    p_dif.add_argument("--clientes", type=int, default=16)
+    p_dif.add_argument("--por-solicitud", type=int, default=5)
+    p_dif.add_argument("--directorio", default="respaldos")
+
+    p_con = sub.add_parser("contencion", help="Upserts concurrentes con ids solapados: fallas, reintentos y filas/s")
+    p_con.add_argument("--escritores", type=int, default=8)
+    p_con.add_argument("--solicitudes", type=int, default=100)
+    p_con.add_argument("--filas", type=int, default=500)
+    p_con.add_argument("--rango", type=int, default=2000, help="ids distintos que comparten los escritores")
+    p_con.add_argument("--duplicados", type=float, default=0.05, help="fracción de ids repetidos en cada lote")
+    p_con.add_argument("--sin-orden", action="store_true", help="comparar con escribir en el orden de llegada (lento: deadlocks)")
+
+    p_sin = sub.add_parser("sin_cambios", help="Re-restaurar un respaldo idéntico: filas/s, WAL y tuplas muertas")
+    p_sin.add_argument("--filas", type=int, default=300000)
+    p_sin.add_argument("--directorio", default="respaldos")
+
+    p_cub = sub.add_parser("cubo", help="Cubo de contrataciones en memoria: memoria por millón de filas y latencias")
+    p_cub.add_argument("--filas", default="1000000,5000000", help="tamaños separados por coma")
+    p_cub.add_argument("--departamentos", type=int, default=1000)
+    p_cub.add_argument("--trabajos", type=int, default=300)
+    p_cub.add_argument("--repeticiones", type=int, default=20)
+
+    p_pre = sub.add_parser("preparadas", help="Sentencias preparadas vs texto: FKs, métricas y upserts")
+    p_pre.add_argument("--anio", type=int, default=2021)
+    p_pre.add_argument("--filas", type=int, default=100)
+    p_pre.add_argument("--repeticiones", type=int, default=200)
+
+    args = parser.parse_args()
+    if args.bench == "json":
+        bench_json(args.filas, args.repeticiones)
+    elif args.bench == "http":
+        bench_http(args.url, args.anio, args.repeticiones)
+    elif args.bench == "escalado":
+        bench_escalado(args.max_workers, args.anio, args.segundos, args.clientes, args.puerto)
+    elif args.bench == "arranque":
+        sys.exit(bench_arranque(args.repeticiones, args.umbral_ms, args.top))
+    elif args.bench == "restaurar":
+        bench_restaurar(args.filas, args.directorio)
+    elif args.bench == "lectura":
+        bench_lectura(args.filas, args.trabajadores, args.directorio)
+    elif args.bench == "reproduccion":
+        bench_reproduccion(args.entradas, args.por_transaccion, args.por_segmento, args.directorio)
+    elif args.bench == "fk":
+        bench_fk(args.filas, args.invalidas, args.repeticiones)
+    elif args.bench == "csv":
+        bench_csv(args.filas, args.directorio)
+    elif args.bench == "diferido":
+        bench_diferido(args.solicitudes, args.clientes, args.por_solicitud, args.directorio)
+    elif args.bench == "contencion":
+        bench_contencion(args.escritores, args.solicitudes, args.filas, args.rango, args.duplicados, args.sin_orden)
+    elif args.bench == "sin_cambios":
+        bench_sin_cambios(args.filas, args.directorio)
+    elif args.bench == "cubo":
+        bench_cubo([int(f) for f in args.filas.split(",")], args.departamentos, args.trabajos, args.repeticiones)
+    elif args.bench == "preparadas":
+        bench_preparadas(args.anio, args.filas, args.repeticiones)
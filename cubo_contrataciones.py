@@ -0,0 +1,256 @@
+"""Cubo de contrataciones en memoria: las métricas de /metricas/* con NumPy, sin consultar la base.
+
+Cada empleado ocupa 16 bytes en cinco arreglos paralelos ordenados por id: id,
+departamento y cargo en int32 (-1 = nulo) y año y trimestre en int16 (0 = sin fecha).
+Los nombres de departamentos y cargos van codificados por diccionario: por cada id, un
+código int32 que apunta a la lista ordenada de nombres distintos, así que agrupar por
+código deja los grupos ordenados por nombre.
+
+Las consultas filtran y agrupan con operaciones vectorizadas (máscaras, searchsorted,
+unique, bincount) y devuelven las mismas filas que las consultas SQL sobre los mismos
+datos. Los textos se ordenan por sus bytes UTF-8, igual que una base con collation "C".
+`cargar` reemplaza todo el contenido; las escrituras confirmadas después se aplican
+como deltas con `aplicar_empleados`, `aplicar_nombres` y `vaciar`.
+
+Este módulo no importa FastAPI ni psycopg2.
+"""
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+SIN_ASIGNAR = "Sin asignar"
+NULO = -1
+COLUMNAS_EMPLEADOS = ("id", "departamento", "trabajo", "anio", "trimestre")
+_TIPOS = {"id": np.int32, "departamento": np.int32, "trabajo": np.int32, "anio": np.int16, "trimestre": np.int16}
+
+
+class Diccionario:
+    """Nombres de una tabla referida: ids ordenados, código de nombre por id y nombres distintos.
+
+    Los arreglos se reconstruyen al consultar si hubo cambios; un diccionario
+    reconstruido es un objeto nuevo, así que las consultas en curso no lo ven cambiar.
+    """
+
+    def __init__(self, nombres_por_id: Dict[int, str]):
+        self.ids = np.fromiter(sorted(nombres_por_id), dtype=np.int32, count=len(nombres_por_id))
+        # Nombres ordenados (ordenar por código es ordenar por nombre) e incluye siempre
+        # 'Sin asignar', el valor de los nulos en contrataciones_por_trimestre
+        self.nombres: List[str] = sorted(set(nombres_por_id.values()) | {SIN_ASIGNAR})
+        codigo = {nombre: i for i, nombre in enumerate(self.nombres)}
+        self.sin_asignar = codigo[SIN_ASIGNAR]
+        self.codigos = np.fromiter((codigo[nombres_por_id[i]] for i in self.ids.tolist()), dtype=np.int32, count=len(self.ids))
+        # Ids densos (lo habitual): tabla directa id -> posición en vez de búsqueda binaria
+        self._directa: Optional[np.ndarray] = None
+        if len(self.ids) and self.ids[0] >= 0 and self.ids[-1] <= 4 * len(self.ids) + 65536:
+            # La última entrada (-1) recibe los ids nulos o fuera de rango
+            self._directa = np.full(int(self.ids[-1]) + 2, -1, dtype=np.int32)
+            self._directa[self.ids] = np.arange(len(self.ids), dtype=np.int32)
+
+    def posiciones(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(posición en `self.ids`, máscara de encontrados) de cada id; los nulos no se encuentran."""
+        if len(self.ids) == 0:
+            return np.zeros(len(ids), dtype=np.intp), np.zeros(len(ids), dtype=bool)
+        if self._directa is not None:
+            fuera = len(self._directa) - 1
+            pos = self._directa[np.where((ids >= 0) & (ids < fuera), ids, fuera)]
+            encontrado = pos >= 0
+            return np.maximum(pos, 0), encontrado
+        pos = np.searchsorted(self.ids, ids)
+        np.minimum(pos, len(self.ids) - 1, out=pos)
+        return pos, self.ids[pos] == ids
+
+    def codigos_de(self, ids: np.ndarray) -> np.ndarray:
+        """Código de nombre de cada id; NULO si es nulo o no existe (lo que descarta un JOIN)."""
+        pos, encontrado = self.posiciones(ids)
+        return np.where(encontrado, self.codigos[pos], NULO) if len(self.ids) else np.full(len(ids), NULO, np.int32)
+
+    def bytes(self) -> int:
+        directa = self._directa.nbytes if self._directa is not None else 0
+        return self.ids.nbytes + self.codigos.nbytes + directa + sum(len(n.encode()) for n in self.nombres)
+
+
+class CuboContrataciones:
+    """Empleados contratados y nombres de departamentos y cargos, con deltas y consultas vectorizadas."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Arreglos con capacidad de sobra al final; las primeras `_filas` posiciones son los datos
+        self._reserva = {c: np.empty(0, dtype=t) for c, t in _TIPOS.items()}
+        self._filas = 0
+        self._nombres: Dict[str, Dict[int, str]] = {"departamentos": {}, "trabajos": {}}
+        self._diccionarios: Dict[str, Optional[Diccionario]] = {"departamentos": None, "trabajos": None}
+        self.cargado = False
+        self.versiones: Dict[str, int] = {}
+        self.cargas = 0
+        self.deltas = 0
+        self.filas_delta = 0
+
+    # --- Carga y deltas ---
+    def cargar(self, columnas: Dict[str, np.ndarray], departamentos: Dict[int, str], trabajos: Dict[int, str],
+               versiones: Dict[str, int]) -> None:
+        """Reemplaza el contenido; `columnas` (COLUMNAS_EMPLEADOS) en cualquier orden de id, sin repetidos."""
+        orden = np.argsort(columnas["id"], kind="stable")
+        nuevas = {c: np.ascontiguousarray(columnas[c][orden], dtype=t) for c, t in _TIPOS.items()}
+        with self._lock:
+            self._reserva = nuevas
+            self._filas = len(orden)
+            self._nombres = {"departamentos": dict(departamentos), "trabajos": dict(trabajos)}
+            self._diccionarios = {"departamentos": None, "trabajos": None}
+            self.versiones = dict(versiones)
+            self.cargado = True
+            self.cargas += 1
+
+    def avanzar_versiones(self, incrementos: Dict[str, int]) -> None:
+        """Suma a `versiones` lo que la base avanzó con escrituras ya aplicadas como delta."""
+        with self._lock:
+            for tabla, incremento in incrementos.items():
+                if tabla in self.versiones:
+                    self.versiones[tabla] += incremento
+
+    def aplicar_empleados(self, columnas: Dict[str, np.ndarray]) -> None:
+        """Upsert por id: actualiza las filas existentes e inserta las nuevas (gana la última repetida)."""
+        ids = np.asarray(columnas["id"], dtype=np.int32)
+        if len(ids) == 0:
+            return
+        orden = np.argsort(ids, kind="stable")
+        ids_ordenados = ids[orden]
+        ultima = np.append(ids_ordenados[1:] != ids_ordenados[:-1], True)
+        seleccion = orden[ultima]
+        valores = {c: np.asarray(columnas[c], dtype=t)[seleccion] for c, t in _TIPOS.items()}
+        with self._lock:
+            actuales = self._columnas()
+            pos = np.searchsorted(actuales["id"], valores["id"])
+            existe = pos < self._filas
+            existe[existe] = actuales["id"][pos[existe]] == valores["id"][existe]
+            for c in COLUMNAS_EMPLEADOS[1:]:
+                actuales[c][pos[existe]] = valores[c][existe]
+            nuevos = ~existe
+            if nuevos.any():
+                self._insertar(actuales, pos[nuevos], {c: v[nuevos] for c, v in valores.items()})
+            self.deltas += 1
+            self.filas_delta += len(seleccion)
+
+    def _insertar(self, actuales: Dict[str, np.ndarray], pos: np.ndarray, valores: Dict[str, np.ndarray]) -> None:
+        # Llamar con el lock tomado; `valores` ordenados por id y ausentes del cubo
+        filas, nuevas = self._filas, len(pos)
+        if filas and valores["id"][0] < actuales["id"][-1]:
+            # Posiciones no decrecientes: el resultado sigue ordenado por id
+            self._reserva = {c: np.insert(actuales[c], pos, valores[c]) for c in _TIPOS}
+            self._filas = filas + nuevas
+            return
+        # Lo habitual: ids mayores que todos los cargados, se agregan al final sin mover nada
+        if filas + nuevas > len(self._reserva["id"]):
+            capacidad = max(filas + nuevas, filas * 3 // 2 + 1024)
+            reserva = {c: np.empty(capacidad, dtype=t) for c, t in _TIPOS.items()}
+            for c in _TIPOS:
+                reserva[c][:filas] = actuales[c]
+            self._reserva = reserva
+        for c in _TIPOS:
+            self._reserva[c][filas:filas + nuevas] = valores[c]
+        self._filas = filas + nuevas
+
+    def aplicar_nombres(self, tabla: str, nombres_por_id: Dict[int, str]) -> None:
+        """Upsert de departamentos o trabajos ({id: nombre})."""
+        with self._lock:
+            self._nombres[tabla].update(nombres_por_id)
+            self._diccionarios[tabla] = None
+            self.deltas += 1
+            self.filas_delta += len(nombres_por_id)
+
+    def vaciar(self, tabla: str) -> None:
+        with self._lock:
+            if tabla == "empleados_contratados":
+                self._reserva = {c: np.empty(0, dtype=t) for c, t in _TIPOS.items()}
+                self._filas = 0
+            else:
+                self._nombres[tabla] = {}
+                self._diccionarios[tabla] = None
+            self.deltas += 1
+
+    def _columnas(self) -> Dict[str, np.ndarray]:
+        # Vistas de los datos (sin la capacidad de sobra); llamar con el lock tomado
+        return {c: a[:self._filas] for c, a in self._reserva.items()}
+
+    def _diccionario(self, tabla: str) -> Diccionario:
+        # Llamar con el lock tomado
+        if self._diccionarios[tabla] is None:
+            self._diccionarios[tabla] = Diccionario(self._nombres[tabla])
+        return self._diccionarios[tabla]
+
+    # --- Consultas ---
+    def contrataciones_por_trimestre(self, anio: int, incluir_nulos: bool = False) -> List[Tuple[str, str, int, int, int, int]]:
+        """(department, job, q1, q2, q3, q4) como /metricas/contrataciones_por_trimestre.
+
+        Sin `incluir_nulos` descarta los empleados sin departamento o cargo existentes
+        (JOIN); con él los agrupa como 'Sin asignar' (LEFT JOIN + COALESCE).
+        """
+        with self._lock:
+            departamentos = self._diccionario("departamentos")
+            trabajos = self._diccionario("trabajos")
+            columnas = self._columnas()
+            del_anio = columnas["anio"] == anio
+            codigo_dep = departamentos.codigos_de(columnas["departamento"][del_anio])
+            codigo_trab = trabajos.codigos_de(columnas["trabajo"][del_anio])
+            trimestre = columnas["trimestre"][del_anio]
+        if incluir_nulos:
+            # Como COALESCE: los nulos se suman al grupo de un nombre real 'Sin asignar', si existe
+            codigo_dep[codigo_dep == NULO] = departamentos.sin_asignar
+            codigo_trab[codigo_trab == NULO] = trabajos.sin_asignar
+        else:
+            validos = (codigo_dep != NULO) & (codigo_trab != NULO)
+            codigo_dep, codigo_trab, trimestre = codigo_dep[validos], codigo_trab[validos], trimestre[validos]
+        # Claves en orden de departamento y luego de cargo, como el ORDER BY
+        cantidad_trab = len(trabajos.nombres)
+        clave = codigo_dep.astype(np.int64) * cantidad_trab + codigo_trab
+        indice = trimestre.astype(np.int64) - 1
+        espacio = len(departamentos.nombres) * cantidad_trab
+        if espacio <= 4 * len(clave) + 65536:
+            # Pocas combinaciones posibles: conteo directo sobre todas, sin ordenar
+            conteos = np.bincount(clave * 4 + indice, minlength=espacio * 4).reshape(-1, 4)
+            grupos = np.flatnonzero(conteos.any(axis=1))
+            conteos = conteos[grupos]
+        else:
+            grupos, grupo = np.unique(clave, return_inverse=True)
+            conteos = np.bincount(grupo * 4 + indice, minlength=len(grupos) * 4).reshape(-1, 4)
+        nombres_dep, nombres_trab = departamentos.nombres, trabajos.nombres
+        return [
+            (nombres_dep[d], nombres_trab[t], *c)
+            for d, t, c in zip((grupos // cantidad_trab).tolist(), (grupos % cantidad_trab).tolist(), conteos.tolist())
+        ]
+
+    def departamentos_sobre_promedio(self, anio: int) -> List[Tuple[int, str, int]]:
+        """(id, department, hired) como /metricas/departamentos_sobre_promedio; empates por id."""
+        with self._lock:
+            departamentos = self._diccionario("departamentos")
+            columnas = self._columnas()
+            del_anio = columnas["departamento"][columnas["anio"] == anio]
+        pos, encontrado = departamentos.posiciones(del_anio)
+        contratados = np.bincount(pos[encontrado], minlength=len(departamentos.ids)).astype(np.int64)
+        # hired > total / cantidad, en enteros para no depender del redondeo del promedio
+        sobre = np.flatnonzero(contratados * len(departamentos.ids) > contratados.sum())
+        sobre = sobre[np.lexsort((departamentos.ids[sobre], -contratados[sobre]))]
+        return [
+            (departamentos.ids[i].item(), departamentos.nombres[departamentos.codigos[i]], contratados[i].item())
+            for i in sobre.tolist()
+        ]
+
+    def metricas(self) -> Dict[str, Any]:
+        with self._lock:
+            filas = self._filas
+            # Incluye la capacidad de sobra reservada para agregar al final
+            bytes_empleados = sum(a.nbytes for a in self._reserva.values())
+            diccionarios = {t: self._diccionario(t) for t in self._diccionarios}
+            return {
+                "cargado": self.cargado,
+                "empleados": filas,
+                "departamentos": len(diccionarios["departamentos"].ids),
+                "trabajos": len(diccionarios["trabajos"].ids),
+                "bytes_empleados": bytes_empleados,
+                "bytes_diccionarios": sum(d.bytes() for d in diccionarios.values()),
+                "bytes_por_millon_de_filas": round(bytes_empleados / filas * 1_000_000) if filas else None,
+                "versiones": dict(self.versiones),
+                "cargas": self.cargas,
+                "deltas": self.deltas,
+                "filas_delta": self.filas_delta,
+            }
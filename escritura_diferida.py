@@ -0,0 +1,238 @@
+"""Bitácora local append-only para la escritura diferida (write-behind) de /transacciones.
+
+Cada solicitud aceptada agrega una línea con su secuencia y sus registros validados; la
+respuesta sale cuando la línea está en disco. El fsync se hace en grupo: la primera
+solicitud que espera escribe y sincroniza todas las líneas pendientes de una vez y las
+demás solo esperan. Un hilo del servicio aplica después las filas a la base en bloques
+grandes y registra (en la misma transacción) la última secuencia aplicada del origen.
+
+Formato de línea: `<crc32 hex> <json [secuencia, {tabla: [registros]}, procedencia]>\\n`.
+`procedencia` (opcional) es `{"lote_id": ..., "indices": {tabla: [posiciones]}}`: el lote de
+rechazados de la solicitud y la posición de cada registro en ella, para que lo que falle
+al aplicar quede en ese mismo lote. Los segmentos se llaman `<origen>_<n>.log`, con un
+origen distinto por proceso. Mientras el proceso vive mantiene un flock sobre cada segmento
+sin aplicar; un segmento que se puede bloquear es huérfano (su proceso terminó) y se
+recupera con `recuperar`.
+
+Este módulo no importa FastAPI ni psycopg2.
+"""
+import json
+import os
+import threading
+import uuid
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    # Sin flock no se distingue un segmento huérfano de uno en uso por otro proceso:
+    # la recuperación asume un único proceso (p. ej. uvicorn sin gunicorn)
+    fcntl = None
+
+SUFIJO_SEGMENTO = ".log"
+
+
+def _bloquear(fd: int, esperar: bool = False) -> bool:
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if esperar else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _fsync_directorio(ruta: str) -> None:
+    try:
+        fd = os.open(ruta, os.O_RDONLY)
+    except OSError:
+        return  # p. ej. Windows: no se pueden abrir directorios
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _codificar(secuencia: int, grupos: Dict[str, List[Dict[str, Any]]], procedencia: Optional[Dict[str, Any]]) -> bytes:
+    linea = [secuencia, grupos] if procedencia is None else [secuencia, grupos, procedencia]
+    cuerpo = json.dumps(linea, separators=(",", ":"), default=str).encode()
+    return b"%08x %s\n" % (zlib.crc32(cuerpo), cuerpo)
+
+
+def leer_segmento(ruta: str) -> Iterator[Tuple[int, Dict[str, List[Dict[str, Any]]], Optional[Dict[str, Any]]]]:
+    """(secuencia, grupos, procedencia) de cada línea completa y con CRC válido.
+
+    La lectura termina en la primera línea incompleta o corrupta: es la escritura que
+    estaba en curso al caer el proceso y nunca se confirmó al cliente.
+    """
+    with open(ruta, "rb") as f:
+        for linea in f:
+            if not linea.endswith(b"\n") or len(linea) < 10:
+                return
+            crc, cuerpo = linea[:8], linea[9:-1]
+            try:
+                if int(crc, 16) != zlib.crc32(cuerpo):
+                    return
+                secuencia, grupos, *procedencia = json.loads(cuerpo)
+            except ValueError:
+                return
+            yield secuencia, grupos, procedencia[0] if procedencia else None
+
+
+class BitacoraEscritura:
+    """Bitácora de un proceso: agregar con fsync en grupo y borrado de segmentos aplicados.
+
+    `al_persistir(secuencia, grupos, procedencia)` se llama tras el fsync, una vez por
+    línea, en orden de secuencia y antes de que `agregar` devuelva.
+    """
+
+    def __init__(self, directorio: str, tamano_segmento: int, espera_grupo: float,
+                 al_persistir: Callable[[int, Dict[str, List[Dict[str, Any]]], Optional[Dict[str, Any]]], None]):
+        self.directorio = directorio
+        self.origen = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        self._tamano_segmento = tamano_segmento
+        self._espera_grupo = espera_grupo
+        self._al_persistir = al_persistir
+        self._cond = threading.Condition()
+        self._secuencia = 0
+        self._durable = 0
+        self._pendientes: List[Tuple[int, Dict[str, List[Dict[str, Any]]], Optional[Dict[str, Any]], bytes]] = []
+        self._escribiendo = False
+        self._error: Optional[BaseException] = None
+        self._contador = 0
+        self._archivo = None
+        self._escrito = 0
+        # Segmentos cerrados o en uso que aún tienen líneas sin aplicar: [(ruta, archivo, última secuencia)]
+        self._segmentos: List[List[Any]] = []
+
+    def _nuevo_segmento(self) -> None:
+        os.makedirs(self.directorio, exist_ok=True)
+        self._contador += 1
+        ruta = os.path.join(self.directorio, f"{self.origen}_{self._contador:06d}{SUFIJO_SEGMENTO}")
+        self._archivo = open(ruta, "ab")
+        _bloquear(self._archivo.fileno(), esperar=True)
+        _fsync_directorio(self.directorio)
+        self._escrito = 0
+        with self._cond:  # marcar_aplicado recorre la lista desde el hilo que aplica
+            self._segmentos.append([ruta, self._archivo, 0])
+
+    def _escribir(self, lineas: List[bytes], hasta: int) -> None:
+        if self._archivo is None or self._escrito >= self._tamano_segmento:
+            self._nuevo_segmento()
+        datos = b"".join(lineas)
+        self._archivo.write(datos)
+        self._archivo.flush()
+        os.fsync(self._archivo.fileno())
+        self._escrito += len(datos)
+        with self._cond:
+            self._segmentos[-1][2] = hasta
+
+    def agregar(self, grupos: Dict[str, List[Dict[str, Any]]], procedencia: Optional[Dict[str, Any]] = None) -> int:
+        """Agrega una línea y bloquea hasta que esté sincronizada a disco; devuelve su secuencia."""
+        with self._cond:
+            if self._error is not None:
+                raise RuntimeError(f"Bitácora de escritura diferida inutilizable: {self._error}")
+            self._secuencia += 1
+            secuencia = self._secuencia
+            self._pendientes.append((secuencia, grupos, procedencia, _codificar(secuencia, grupos, procedencia)))
+            while self._durable < secuencia:
+                if self._error is not None:
+                    raise RuntimeError(f"Bitácora de escritura diferida inutilizable: {self._error}")
+                if self._escribiendo:
+                    self._cond.wait()
+                    continue
+                # Esta solicitud escribe el grupo; las que lleguen mientras tanto esperan el próximo
+                self._escribiendo = True
+                try:
+                    if self._espera_grupo > 0:
+                        self._cond.wait(self._espera_grupo)
+                    grupo, self._pendientes = self._pendientes, []
+                    hasta = grupo[-1][0]
+                    self._cond.release()
+                    try:
+                        self._escribir([linea for *_, linea in grupo], hasta)
+                        for sec, datos, origen, _ in grupo:
+                            self._al_persistir(sec, datos, origen)
+                    except BaseException as e:
+                        # Una escritura a medias deja el archivo en estado incierto: no se sigue
+                        self._error = e
+                        raise
+                    finally:
+                        self._cond.acquire()
+                    self._durable = hasta
+                finally:
+                    self._escribiendo = False
+                    self._cond.notify_all()
+        return secuencia
+
+    def marcar_aplicado(self, secuencia: int) -> None:
+        """Borra los segmentos cerrados cuyas líneas ya están todas aplicadas en la base."""
+        with self._cond:
+            while len(self._segmentos) > 1 and self._segmentos[0][2] <= secuencia:
+                ruta, archivo, _ = self._segmentos.pop(0)
+                os.remove(ruta)
+                archivo.close()
+
+    def cerrar(self, aplicado: int = 0) -> bool:
+        """Cierra (y libera) los segmentos. Borra los aplicados hasta `aplicado`; el resto queda huérfano.
+
+        Devuelve True si no quedó ningún segmento.
+        """
+        with self._cond:
+            huerfanos = 0
+            for ruta, archivo, ultima in self._segmentos:
+                if ultima <= aplicado:
+                    os.remove(ruta)
+                else:
+                    huerfanos += 1
+                archivo.close()
+            self._segmentos = []
+            self._archivo = None
+            return huerfanos == 0
+
+
+@contextmanager
+def _bloqueo_directorio(directorio: str):
+    fd = os.open(os.path.join(directorio, ".recuperacion"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        _bloquear(fd, esperar=True)
+        yield
+    finally:
+        os.close(fd)
+
+
+def recuperar(directorio: str, aplicar: Callable[[str, List[Tuple[int, Dict[str, List[Dict[str, Any]]], Optional[Dict[str, Any]]]]], None]) -> Dict[str, int]:
+    """Reproduce los segmentos huérfanos de `directorio` y los borra.
+
+    Por cada origen sin proceso vivo llama a `aplicar(origen, [(secuencia, grupos, procedencia)])` con
+    sus líneas en orden; `aplicar` descarta lo que la base ya tiene (secuencia aplicada
+    del origen) y confirma. Un solo proceso recupera a la vez. Devuelve {origen: líneas}.
+    """
+    if not os.path.isdir(directorio):
+        return {}
+    recuperados: Dict[str, int] = {}
+    with _bloqueo_directorio(directorio):
+        por_origen: Dict[str, List[str]] = defaultdict(list)
+        for nombre in os.listdir(directorio):
+            if nombre.endswith(SUFIJO_SEGMENTO):
+                por_origen[nombre.rsplit("_", 1)[0]].append(os.path.join(directorio, nombre))
+        for origen, rutas in por_origen.items():
+            rutas.sort()
+            archivos = [open(ruta, "rb") for ruta in rutas]
+            try:
+                # El proceso dueño mantiene bloqueados todos sus segmentos sin aplicar
+                if not all(_bloquear(a.fileno()) for a in archivos):
+                    continue
+                lineas = [linea for ruta in rutas for linea in leer_segmento(ruta)]
+                aplicar(origen, lineas)
+                for ruta in rutas:
+                    os.remove(ruta)
+                recuperados[origen] = len(lineas)
+            finally:
+                for a in archivos:
+                    a.close()
+        _fsync_directorio(directorio)
+    return recuperados
@@ -1,18 +1,46 @@
 import os
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from datetime import datetime
-from fastapi import FastAPI, Body, HTTPException, Request, Depends
-from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse
+from fastapi import FastAPI, Body, HTTPException, Request, Depends, Header
+from fastapi.responses import HTMLResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.base import BaseHTTPMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
+from decimal import Decimal
+import asyncio
+import codecs
+import csv
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import queue
+import random
+import re
+import threading
 import time
+import uuid
+import zlib
 from pydantic import BaseModel, Field, constr, ValidationError
 import psycopg2
 import psycopg2.extras as pgextras
 from dotenv import load_dotenv
+from registro_cambios import OPERACION_BARRERA, OPERACION_UPSERT, OPERACION_VACIAR
+from modelos import normalizar_fila_csv
+import escritura_diferida
+
+logger = logging.getLogger(__name__)
+
+try:
+    # orjson es opcional: si no está instalado se usa el módulo json estándar
+    import orjson
+except ImportError:  # pragma: no cover - depende del entorno
+    orjson = None
 
 
 # Cargar variables de entorno desde .env
@@ -26,6 +54,8 @@ ALLOWED_ORIGINS = os.getenv('ALLOWED_ORIGINS', '*')
 EXPOSE_API_KEY_IN_UI = os.getenv('EXPOSE_API_KEY_IN_UI', 'false').strip().lower() in ('1','true','yes')
 _RATE_WINDOW = int(os.getenv('RATE_LIMIT_WINDOW_SECONDS', '60'))
 _RATE_MAX = int(os.getenv('RATE_LIMIT_MAX_REQUESTS', '100'))
+# 'memoria' (por proceso) o 'postgres' (compartido entre workers/réplicas del servicio)
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memoria').strip().lower()
 _rate_store: Dict[str, List[float]] = defaultdict(list)
 
 def api_key_required(request: Request):
@@ -54,37 +84,335 @@ def rate_limiter(request: Request):
     return None
 
 
+def rate_limiter_compartido(request: Request):
+    """Limita solicitudes por IP con una ventana fija cuyo contador vive en Postgres.
+
+    Todos los workers comparten el mismo contador, así que el límite es global y no
+    se multiplica por el número de procesos.
+    """
+    ip = request.client.host if request.client else 'unknown'
+    ventana = int(time.time()) // _RATE_WINDOW
+    conexion = obtener_conexion_db()
+    try:
+        with conexion.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO limites_tasa (clave, ventana, conteo) VALUES (%s, %s, 1)
+                ON CONFLICT (clave, ventana) DO UPDATE SET conteo = limites_tasa.conteo + 1
+                RETURNING conteo
+                """,
+                (ip, ventana),
+            )
+            conteo = cursor.fetchone()[0]
+            if conteo == 1:
+                # Primera solicitud de la ventana para esta IP: purgar ventanas vencidas
+                cursor.execute("DELETE FROM limites_tasa WHERE clave = %s AND ventana < %s", (ip, ventana))
+        conexion.commit()
+    except Exception:
+        conexion.rollback()
+        raise
+    finally:
+        liberar_conexion_db(conexion)
+    if conteo > _RATE_MAX:
+        raise HTTPException(status_code=429, detail="Demasiadas solicitudes, intente más tarde")
+    return None
+
+
 # =============================
 # Conexión a la base de datos
 # =============================
+def _parametros_conexion() -> Dict[str, Any]:
+    """Parámetros de conexión al primario tomados de variables de entorno (.env)."""
+    # Parámetros básicos
+    params = {
+        'dbname': os.getenv('DB_NAME'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD'),
+        'host': os.getenv('DB_HOST'),
+        'port': os.getenv('DB_PORT'),
+    }
+
+    # Soporte SSL opcional (útil para Azure PostgreSQL)
+    sslmode = os.getenv('DB_SSLMODE')  # e.g., 'require', 'verify-ca', 'verify-full'
+    sslrootcert = os.getenv('DB_SSLROOTCERT')  # ruta a CA si se usa verificación
+    if sslmode:
+        params['sslmode'] = sslmode
+    if sslrootcert:
+        # No validamos existencia aquí para permitir rutas en contenedores/montajes
+        params['sslrootcert'] = sslrootcert
+    return params
+
+
+def _tamano_pool_por_worker() -> int:
+    """Conexiones máximas por proceso.
+
+    DB_POOL_MAX fija el valor explícitamente (0 desactiva el pool). Si no se define, se
+    reparte el presupuesto DB_MAX_CONNECTIONS (menos DB_CONEXIONES_RESERVADAS para
+    administración y otros clientes) entre los WEB_CONCURRENCY workers.
+    """
+    explicito = os.getenv('DB_POOL_MAX')
+    if explicito is not None and explicito.strip() != '':
+        return int(explicito)
+    presupuesto = int(os.getenv('DB_MAX_CONNECTIONS', '100')) - int(os.getenv('DB_CONEXIONES_RESERVADAS', '10'))
+    workers = max(1, int(os.getenv('WEB_CONCURRENCY') or '1'))
+    return max(2, presupuesto // workers)
+
+
+class ConexionPG(psycopg2.extensions.connection):
+    """Conexión psycopg2 que recuerda qué sentencias preparó (ver ejecutar_preparada)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # PREPARE dura lo que la sesión y no se deshace con rollback
+        self.sentencias_preparadas: set = set()
+
+
+class PoolConexiones:
+    """Pool de conexiones de un proceso con espera acotada.
+
+    Mantiene hasta `maximo` conexiones abiertas y reutilizables; si todas están en uso,
+    obtener() espera hasta `timeout` segundos antes de fallar.
+    """
+
+    def __init__(self, params: Dict[str, Any], maximo: int, timeout: float):
+        self._params = params
+        self._libres: List[Any] = []
+        self._lock = threading.Lock()
+        self._cupos = threading.BoundedSemaphore(maximo)
+        self._timeout = timeout
+        self.maximo = maximo
+
+    def obtener(self):
+        if not self._cupos.acquire(timeout=self._timeout):
+            raise RuntimeError(f"Pool de conexiones agotado ({self.maximo}) tras {self._timeout}s de espera")
+        try:
+            with self._lock:
+                while self._libres:
+                    conexion = self._libres.pop()
+                    if not conexion.closed:
+                        return conexion
+            return psycopg2.connect(connection_factory=ConexionPG, **self._params)
+        except BaseException:
+            self._cupos.release()
+            raise
+
+    def liberar(self, conexion) -> None:
+        try:
+            if not conexion.closed:
+                estado = conexion.info.transaction_status
+                if estado == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    conexion.close()
+                elif estado != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    # Nunca devolver una transacción abierta al pool
+                    conexion.rollback()
+            if not conexion.closed:
+                with self._lock:
+                    self._libres.append(conexion)
+        except Exception:
+            conexion.close()
+        finally:
+            self._cupos.release()
+
+    def cerrar(self) -> None:
+        with self._lock:
+            for conexion in self._libres:
+                conexion.close()
+            self._libres.clear()
+
+
+_DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT_SECONDS', '10'))
+_pools: Dict[Tuple[int, str], PoolConexiones] = {}
+_pool_de_conexion: Dict[int, PoolConexiones] = {}
+_pools_lock = threading.Lock()
+
+
+def _obtener_pool(nombre: str, params: Dict[str, Any]) -> Optional[PoolConexiones]:
+    """Devuelve el pool `nombre` de este proceso (se crea bajo demanda, también tras un fork)."""
+    maximo = _tamano_pool_por_worker()
+    if maximo <= 0:
+        return None
+    clave = (os.getpid(), nombre)
+    pool = _pools.get(clave)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(clave)
+            if pool is None:
+                pool = PoolConexiones(params, maximo, _DB_POOL_TIMEOUT)
+                _pools[clave] = pool
+    return pool
+
+
+def _conectar_con_pool(nombre: str, params: Dict[str, Any]):
+    pool = _obtener_pool(nombre, params)
+    if pool is None:
+        return psycopg2.connect(connection_factory=ConexionPG, **params)
+    conexion = pool.obtener()
+    with _pools_lock:
+        _pool_de_conexion[id(conexion)] = pool
+    return conexion
+
+
+# 'arranque': verificar el esquema en el evento de startup; 'diferida': con la primera conexión
+ESQUEMA_VERIFICACION = os.getenv('ESQUEMA_VERIFICACION', 'arranque').strip().lower()
+_esquema_verificado_pid: Optional[int] = None
+_esquema_lock = threading.Lock()
+
+
+def _verificar_esquema_una_vez(conexion) -> None:
+    """Ejecuta asegurar_esquema una sola vez por proceso."""
+    global _esquema_verificado_pid
+    with _esquema_lock:
+        if _esquema_verificado_pid != os.getpid():
+            asegurar_esquema(conexion)
+            _esquema_verificado_pid = os.getpid()
+
+
 def obtener_conexion_db():
     """Establece conexión con la base de datos PostgreSQL.
 
-    Nota: Usa variables de entorno definidas en .env.
+    Nota: Usa variables de entorno definidas en .env. Las conexiones salen del pool del
+    proceso; devolverlas siempre con liberar_conexion_db().
     """
     try:
-        # Parámetros básicos
-        params = {
-            'dbname': os.getenv('DB_NAME'),
-            'user': os.getenv('DB_USER'),
-            'password': os.getenv('DB_PASSWORD'),
-            'host': os.getenv('DB_HOST'),
-            'port': os.getenv('DB_PORT'),
-        }
+        conexion = _conectar_con_pool("primario", _parametros_conexion())
+    except Exception as e:
+        raise RuntimeError(f"Error al conectar a la base de datos: {e}")
+    if _esquema_verificado_pid != os.getpid():
+        try:
+            _verificar_esquema_una_vez(conexion)
+        except BaseException:
+            liberar_conexion_db(conexion)
+            raise
+    return conexion
+
+
+# Réplicas de lectura: DSNs libpq separados por ';' (p. ej. "host=replica1 dbname=... user=...")
+_DSNS_LECTURA = [d.strip() for d in os.getenv('DB_READ_DSNS', '').split(';') if d.strip()]
+_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG_SECONDS', '30'))
+_REPLICA_LAG_CACHE = float(os.getenv('DB_REPLICA_LAG_CACHE_SECONDS', '5'))
+_replica_turno = itertools.count()
+# dsn -> (momento de la medición, lag en segundos o None si la réplica falló)
+_replica_lag: Dict[str, Tuple[float, Optional[float]]] = {}
+
+
+def _medir_lag_replica(conexion) -> Optional[float]:
+    """Segundos de atraso de la réplica (0 si está al día o si no es una réplica)."""
+    with conexion.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+            END
+            """
+        )
+        lag = cursor.fetchone()[0]
+    conexion.commit()
+    return float(lag) if lag is not None else None
 
-        # Soporte SSL opcional (útil para Azure PostgreSQL)
-        sslmode = os.getenv('DB_SSLMODE')  # e.g., 'require', 'verify-ca', 'verify-full'
-        sslrootcert = os.getenv('DB_SSLROOTCERT')  # ruta a CA si se usa verificación
-        if sslmode:
-            params['sslmode'] = sslmode
-        if sslrootcert:
-            # No validamos existencia aquí para permitir rutas en contenedores/montajes
-            params['sslrootcert'] = sslrootcert
 
-        conexion = psycopg2.connect(**params)
+def obtener_conexion_lectura():
+    """Conexión para lecturas pesadas que toleran datos algo atrasados (métricas, respaldos).
+
+    Reparte entre las réplicas de DB_READ_DSNS (round robin) y descarta las que no
+    responden o superan DB_REPLICA_MAX_LAG_SECONDS; el lag se mide como mucho cada
+    DB_REPLICA_LAG_CACHE_SECONDS por réplica. Sin réplicas válidas usa el primario.
+    Escrituras y validación de FKs deben seguir usando obtener_conexion_db().
+    """
+    for _ in range(len(_DSNS_LECTURA)):
+        dsn = _DSNS_LECTURA[next(_replica_turno) % len(_DSNS_LECTURA)]
+        medido, lag = _replica_lag.get(dsn, (0.0, None))
+        vigente = time.time() - medido < _REPLICA_LAG_CACHE
+        if vigente and (lag is None or lag > _REPLICA_MAX_LAG):
+            continue
+        try:
+            conexion = _conectar_con_pool(f"replica:{dsn}", {'dsn': dsn})
+        except Exception:
+            _replica_lag[dsn] = (time.time(), None)
+            continue
+        if not vigente:
+            try:
+                lag = _medir_lag_replica(conexion)
+            except Exception:
+                lag = None
+            _replica_lag[dsn] = (time.time(), lag)
+            if lag is None or lag > _REPLICA_MAX_LAG:
+                liberar_conexion_db(conexion)
+                continue
         return conexion
-    except Exception as e:
-        raise RuntimeError(f"Error al conectar a la base de datos: {e}")
+    return obtener_conexion_db()
+
+
+def liberar_conexion_db(conexion) -> None:
+    """Devuelve la conexión a su pool (o la cierra si no proviene de uno)."""
+    with _pools_lock:
+        pool = _pool_de_conexion.pop(id(conexion), None)
+    if pool is None:
+        conexion.close()
+    else:
+        pool.liberar(conexion)
+
+
+def cerrar_pools() -> None:
+    """Cierra las conexiones libres de los pools de este proceso."""
+    pid = os.getpid()
+    for (pool_pid, _), pool in list(_pools.items()):
+        if pool_pid == pid:
+            pool.cerrar()
+
+
+# =============================
+# Sentencias preparadas por conexión
+# =============================
+# false: las sentencias registradas se envían como texto (p. ej. detrás de PgBouncer en modo transacción)
+SENTENCIAS_PREPARADAS = os.getenv('SENTENCIAS_PREPARADAS', 'true').strip().lower() in ('1','true','yes')
+
+# nombre -> (tipos de $1..$n, sentencia)
+_SENTENCIAS: Dict[str, Tuple[Tuple[str, ...], str]] = {}
+# Por sentencia, en este proceso: PREPARE enviados y ejecuciones que reutilizaron uno anterior
+preparaciones_sentencias: Counter = Counter()
+reutilizaciones_sentencias: Counter = Counter()
+
+
+def registrar_sentencia(nombre: str, tipos: Tuple[str, ...], sql: str) -> str:
+    """Registra una sentencia fija del servicio con parámetros $1..$n de `tipos`; devuelve su nombre."""
+    _SENTENCIAS[nombre] = (tipos, sql)
+    return nombre
+
+
+def ejecutar_preparada(cursor, nombre: str, parametros: Tuple[Any, ...]) -> None:
+    """Ejecuta una sentencia registrada: PREPARE la primera vez en la conexión y EXECUTE después.
+
+    Así PostgreSQL no vuelve a analizar el texto en cada solicitud y, tras unas
+    ejecuciones, puede reutilizar un plan genérico. Con SENTENCIAS_PREPARADAS=false, o
+    en conexiones que no son ConexionPG, se envía el texto con los mismos parámetros.
+    """
+    tipos, sql = _SENTENCIAS[nombre]
+    preparadas = getattr(cursor.connection, "sentencias_preparadas", None)
+    # Los parámetros van con su tipo explícito: una lista vacía o de nulos no tiene tipo propio
+    marcadores = [f"%s::{tipo}" for tipo in tipos]
+    if not SENTENCIAS_PREPARADAS or preparadas is None:
+        cursor.execute(
+            re.sub(r"\$(\d+)", lambda m: marcadores[int(m.group(1)) - 1], sql.replace("%", "%%")),
+            parametros,
+        )
+        return
+    if nombre in preparadas:
+        reutilizaciones_sentencias[nombre] += 1
+    else:
+        cursor.execute(f"PREPARE {nombre} ({', '.join(tipos)}) AS {sql}")
+        preparadas.add(nombre)
+        preparaciones_sentencias[nombre] += 1
+    cursor.execute(f"EXECUTE {nombre} ({', '.join(marcadores)})", parametros)
+
+
+SQL_FK_DEPARTAMENTOS = registrar_sentencia(
+    "fk_departamentos", ("int[]",), "SELECT id FROM departamentos WHERE id = ANY($1)"
+)
+SQL_FK_TRABAJOS = registrar_sentencia(
+    "fk_trabajos", ("int[]",), "SELECT id FROM trabajos WHERE id = ANY($1)"
+)
 
 
 # =============================
@@ -116,21 +444,107 @@ TABLAS_VALIDAS = {
     "empleados_contratados": RegistroEmpleado,
 }
 
+# Orden de escritura: primero las tablas referenciadas por FKs
+ORDEN_DEPENDENCIAS = ("departamentos", "trabajos", "empleados_contratados")
+
+# Códigos de motivo para registros rechazados (dead-letter)
+CODIGO_ESQUEMA_INVALIDO = "esquema_invalido"
+CODIGO_FK_DEPARTAMENTO = "fk_departamento_inexistente"
+CODIGO_FK_TRABAJO = "fk_trabajo_inexistente"
+
 
 # =============================
 # Reglas de calidad específicas
 # =============================
-def validar_reglas_calidad(tabla: str, registros: List[BaseModel], conexion) -> Tuple[List[BaseModel], List[Dict[str, Any]]]:
+# Desde cuántos registros la validación de FKs se resuelve en la base (estrategia "auto");
+# 0 = siempre en Python
+FK_SQL_UMBRAL = int(os.getenv('FK_SQL_UMBRAL', '0'))
+ESTRATEGIAS_FK = ("auto", "python", "sql")
+
+
+def _fks_inexistentes_sql(conexion, registros: List[BaseModel]) -> List[Tuple[int, bool, bool]]:
+    """Clasifica las FKs de empleados en la base: (indice, falta_departamento, falta_trabajo).
+
+    Copia (indice, id_departamento, id_trabajo) a un staging temporal con COPY y resuelve
+    ambas FKs con un único anti-join que devuelve solo las filas con alguna FK inexistente.
+    """
+    # Solo hay enteros: reemplazar "None" deja el campo vacío (NULL en CSV)
+    datos = io.StringIO("\n".join(
+        [f"{i},{r.id_departamento},{r.id_trabajo}" for i, r in enumerate(registros)]
+    ).replace("None", ""))
+    with conexion.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS _fk_empleados "
+            "(indice INTEGER, id_departamento INTEGER, id_trabajo INTEGER) ON COMMIT DROP"
+        )
+        cursor.copy_expert("COPY _fk_empleados FROM STDIN WITH (FORMAT csv)", datos)
+        # Sin estadísticas el planificador supone pocas filas y elige nested loops
+        cursor.execute("ANALYZE _fk_empleados")
+        cursor.execute(
+            """
+            SELECT s.indice,
+                   s.id_departamento IS NOT NULL AND d.id IS NULL,
+                   s.id_trabajo IS NOT NULL AND t.id IS NULL
+            FROM _fk_empleados s
+            LEFT JOIN departamentos d ON d.id = s.id_departamento
+            LEFT JOIN trabajos t ON t.id = s.id_trabajo
+            WHERE (s.id_departamento IS NOT NULL AND d.id IS NULL)
+               OR (s.id_trabajo IS NOT NULL AND t.id IS NULL)
+            ORDER BY s.indice
+            """
+        )
+        inexistentes = cursor.fetchall()
+        cursor.execute("TRUNCATE _fk_empleados")
+    return inexistentes
+
+
+def validar_reglas_calidad(tabla: str, registros: List[BaseModel], conexion, estrategia: str = "auto") -> Tuple[List[BaseModel], List[Dict[str, Any]]]:
     """Aplica reglas de calidad por tabla y retorna (registros_validos, errores).
 
     - departamentos: longitud de texto <= 50 ya validada por esquema.
     - trabajos: longitud de texto <= 200 ya validada por esquema.
     - empleados_contratados: validar existencia de FKs (id_departamento, id_trabajo).
+
+    `estrategia` para las FKs: "python" trae los ids existentes y clasifica cada registro
+    en Python; "sql" clasifica en la base y solo trae las filas con errores; "auto" usa
+    "sql" desde FK_SQL_UMBRAL registros (si es > 0). Con tablas referenciadas chicas
+    "python" suele ser más rápida; "sql" conviene cuando hay muchos ids referenciados
+    distintos o muchos rechazos (ver `benchmarks.py fk`).
     """
     errores: List[Dict[str, Any]] = []
     registros_validos: List[BaseModel] = []
 
-    if tabla == "empleados_contratados":
+    if estrategia not in ESTRATEGIAS_FK:
+        raise ValueError(f"Estrategia de validación de FKs desconocida: {estrategia}")
+    if estrategia == "auto":
+        estrategia = "sql" if 0 < FK_SQL_UMBRAL <= len(registros) else "python"
+
+    if tabla == "empleados_contratados" and estrategia == "sql":
+        try:
+            inexistentes = _fks_inexistentes_sql(conexion, registros)
+        except Exception as e:
+            raise RuntimeError(f"Error validando reglas de calidad de empleados: {e}")
+        for idx, falta_dep, falta_job in inexistentes:
+            r = registros[idx]
+            if falta_dep:
+                errores.append({
+                    "indice": idx,
+                    "tabla": tabla,
+                    "codigo": CODIGO_FK_DEPARTAMENTO,
+                    "detalle": f"id_departamento {r.id_departamento} no existe",
+                    "registro": r.model_dump(mode="json"),
+                })
+            if falta_job:
+                errores.append({
+                    "indice": idx,
+                    "tabla": tabla,
+                    "codigo": CODIGO_FK_TRABAJO,
+                    "detalle": f"id_trabajo {r.id_trabajo} no existe",
+                    "registro": r.model_dump(mode="json"),
+                })
+        descartados = {fila[0] for fila in inexistentes}
+        registros_validos = [r for idx, r in enumerate(registros) if idx not in descartados] if descartados else list(registros)
+    elif tabla == "empleados_contratados":
         # Verificación de llaves foráneas en lote
         ids_dep = {r.id_departamento for r in registros if getattr(r, 'id_departamento', None) is not None}
         ids_job = {r.id_trabajo for r in registros if getattr(r, 'id_trabajo', None) is not None}
@@ -138,17 +552,11 @@ def validar_reglas_calidad(tabla: str, registros: List[BaseModel], conexion) ->
         try:
             with conexion.cursor() as cursor:
                 # Validar departamentos existentes
-                cursor.execute(
-                    "SELECT id FROM departamentos WHERE id = ANY(%s)",
-                    (list(ids_dep),),
-                )
+                ejecutar_preparada(cursor, SQL_FK_DEPARTAMENTOS, (list(ids_dep),))
                 dep_validos = {row[0] for row in cursor.fetchall()}
 
                 # Validar trabajos existentes
-                cursor.execute(
-                    "SELECT id FROM trabajos WHERE id = ANY(%s)",
-                    (list(ids_job),),
-                )
+                ejecutar_preparada(cursor, SQL_FK_TRABAJOS, (list(ids_job),))
                 job_validos = {row[0] for row in cursor.fetchall()}
 
             # Clasificar cada registro según FKs válidas
@@ -159,14 +567,18 @@ def validar_reglas_calidad(tabla: str, registros: List[BaseModel], conexion) ->
                     errores.append({
                         "indice": idx,
                         "tabla": tabla,
+                        "codigo": CODIGO_FK_DEPARTAMENTO,
                         "detalle": f"id_departamento {r.id_departamento} no existe",
+                        "registro": r.model_dump(mode="json"),
                     })
                     fk_ok = False
                 if r.id_trabajo is not None and r.id_trabajo not in job_validos:
                     errores.append({
                         "indice": idx,
                         "tabla": tabla,
+                        "codigo": CODIGO_FK_TRABAJO,
                         "detalle": f"id_trabajo {r.id_trabajo} no existe",
+                        "registro": r.model_dump(mode="json"),
                     })
                     fk_ok = False
                 if fk_ok:
@@ -183,48 +595,161 @@ def validar_reglas_calidad(tabla: str, registros: List[BaseModel], conexion) ->
 # =============================
 # Operaciones de inserción (UPSERT)
 # =============================
-def upsert_departamentos(conexion, registros: List[RegistroDepartamento]) -> int:
-    """Inserta/actualiza departamentos en lote con ON CONFLICT (UPSERT)."""
+# Errores de PostgreSQL por concurrencia que se resuelven repitiendo la transacción
+_SQLSTATE_REINTENTABLES = {"40P01": "deadlock", "40001": "serializacion"}
+_UPSERT_REINTENTOS = int(os.getenv('UPSERT_REINTENTOS', '4'))
+_UPSERT_REINTENTO_BASE_SEGUNDOS = float(os.getenv('UPSERT_REINTENTO_BASE_MS', '20')) / 1000
+# Reintentos hechos por este proceso, por SQLSTATE
+reintentos_por_conflicto: Counter = Counter()
+
+
+def _ordenar_sin_duplicados(registros: List[BaseModel]) -> List[BaseModel]:
+    """Un registro por id (gana el último) en orden de id.
+
+    ON CONFLICT DO UPDATE falla si un mismo INSERT toca dos veces la misma fila, y dos
+    lotes concurrentes que bloquean las mismas filas en distinto orden pueden trabarse:
+    escribiendo siempre en orden de id los bloqueos se toman en el mismo orden.
+    """
+    return sorted({r.id: r for r in registros}.values(), key=lambda r: r.id)  # type: ignore[attr-defined]
+
+
+# Conteos de un UPSERT: filas nuevas, existentes con algún valor distinto e idénticas (no se reescriben)
+CONTEOS_UPSERT = ("insertados", "actualizados", "sin_cambios")
+# Sobre la CTE `escritas` (INSERT ... RETURNING (xmax = 0) AS insertada). xmax es 0 solo en
+# filas recién insertadas; las que se saltan por el WHERE del DO UPDATE no se devuelven
+_SQL_CONTAR_ESCRITAS = "SELECT count(*) FILTER (WHERE insertada), count(*) FILTER (WHERE NOT insertada) FROM escritas"
+
+
+def _conteos_upsert(filas: int, escritas: Iterable[Tuple[int, int]]) -> Dict[str, int]:
+    """Conteos de un UPSERT de `filas` filas distintas a partir de las páginas de _SQL_CONTAR_ESCRITAS."""
+    insertados = actualizados = 0
+    for pagina_insertados, pagina_actualizados in escritas:
+        insertados += pagina_insertados
+        actualizados += pagina_actualizados
+    return {"insertados": insertados, "actualizados": actualizados, "sin_cambios": filas - insertados - actualizados}
+
+
+def _sqlstate_reintentable(error: Optional[BaseException]) -> Optional[str]:
+    # Los upsert_* envuelven el error de psycopg2 en RuntimeError: se recorre la cadena
+    while error is not None:
+        codigo = getattr(error, "pgcode", None)
+        if codigo in _SQLSTATE_REINTENTABLES:
+            return codigo
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def con_reintentos(conexion, operacion: Callable[[], Any]) -> Any:
+    """Ejecuta `operacion` (escrituras sin confirmar en `conexion`) y la repite desde cero
+    si PostgreSQL aborta la transacción por deadlock o fallo de serialización.
+
+    Entre intentos hace rollback y espera un tiempo al azar de hasta
+    UPSERT_REINTENTO_BASE_MS * 2^intento (jitter completo), hasta UPSERT_REINTENTOS veces.
+    `operacion` no debe tener efectos fuera de la transacción.
+    """
+    for intento in itertools.count():
+        try:
+            return operacion()
+        except Exception as e:
+            codigo = _sqlstate_reintentable(e)
+            if codigo is None or intento >= _UPSERT_REINTENTOS:
+                raise
+            conexion.rollback()
+            reintentos_por_conflicto[codigo] += 1
+            time.sleep(random.uniform(0, _UPSERT_REINTENTO_BASE_SEGUNDOS * 2 ** intento))
+
+
+# Filas por EXECUTE de un UPSERT: cada columna viaja como un arreglo que se desarma con unnest
+_UPSERT_FILAS_POR_SENTENCIA = 5000
+
+SQL_UPSERT_DEPARTAMENTOS = registrar_sentencia(
+    "upsert_departamentos", ("int[]", "text[]"),
+    "WITH escritas AS ("
+    "INSERT INTO departamentos (id, departamento) SELECT * FROM unnest($1, $2) "
+    "ON CONFLICT (id) DO UPDATE SET departamento = EXCLUDED.departamento "
+    "WHERE departamentos.departamento IS DISTINCT FROM EXCLUDED.departamento "
+    "RETURNING (xmax = 0) AS insertada) " + _SQL_CONTAR_ESCRITAS,
+)
+SQL_UPSERT_TRABAJOS = registrar_sentencia(
+    "upsert_trabajos", ("int[]", "text[]"),
+    "WITH escritas AS ("
+    "INSERT INTO trabajos (id, trabajo) SELECT * FROM unnest($1, $2) "
+    "ON CONFLICT (id) DO UPDATE SET trabajo = EXCLUDED.trabajo "
+    "WHERE trabajos.trabajo IS DISTINCT FROM EXCLUDED.trabajo "
+    "RETURNING (xmax = 0) AS insertada) " + _SQL_CONTAR_ESCRITAS,
+)
+SQL_UPSERT_EMPLEADOS = registrar_sentencia(
+    "upsert_empleados", ("int[]", "text[]", "timestamp[]", "int[]", "int[]"),
+    "WITH escritas AS ("
+    "INSERT INTO empleados_contratados (id, nombre, fecha_hora, id_departamento, id_trabajo) "
+    "SELECT * FROM unnest($1, $2, $3, $4, $5) "
+    "ON CONFLICT (id) DO UPDATE SET "
+    "nombre = EXCLUDED.nombre, "
+    "fecha_hora = EXCLUDED.fecha_hora, "
+    "id_departamento = EXCLUDED.id_departamento, "
+    "id_trabajo = EXCLUDED.id_trabajo "
+    "WHERE (empleados_contratados.nombre, empleados_contratados.fecha_hora, "
+    "empleados_contratados.id_departamento, empleados_contratados.id_trabajo) "
+    "IS DISTINCT FROM (EXCLUDED.nombre, EXCLUDED.fecha_hora, EXCLUDED.id_departamento, EXCLUDED.id_trabajo) "
+    "RETURNING (xmax = 0) AS insertada) " + _SQL_CONTAR_ESCRITAS,
+)
+
+
+def _ejecutar_upsert(cursor, nombre: str, valores: List[Tuple]) -> List[Tuple[int, int]]:
+    """Ejecuta el UPSERT registrado `nombre` por páginas; devuelve los conteos de cada página."""
+    paginas = []
+    for inicio in range(0, len(valores), _UPSERT_FILAS_POR_SENTENCIA):
+        columnas = tuple(list(columna) for columna in zip(*valores[inicio:inicio + _UPSERT_FILAS_POR_SENTENCIA]))
+        ejecutar_preparada(cursor, nombre, columnas)
+        paginas.append(cursor.fetchone())
+    return paginas
+
+
+def upsert_departamentos(conexion, registros: List[RegistroDepartamento], confirmar: bool = True) -> Dict[str, int]:
+    """Inserta/actualiza departamentos en lote con ON CONFLICT (UPSERT).
+
+    Con confirmar=False no hace commit, para agrupar varias tablas en una transacción.
+    Los ids repetidos se escriben una vez (gana el último) y en orden de id. Las filas
+    que ya tienen los mismos valores no se reescriben (sin WAL ni tuplas muertas);
+    devuelve los conteos de CONTEOS_UPSERT.
+    """
     if not registros:
-        return 0
+        return dict.fromkeys(CONTEOS_UPSERT, 0)
+    registros = _ordenar_sin_duplicados(registros)
     valores = [(r.id, r.departamento) for r in registros]
-    sql = (
-        "INSERT INTO departamentos (id, departamento) VALUES %s "
-        "ON CONFLICT (id) DO UPDATE SET departamento = EXCLUDED.departamento"
-    )
     try:
         with conexion.cursor() as cursor:
-            pgextras.execute_values(cursor, sql, valores, page_size=1090)
-        conexion.commit()
-        return len(registros)
+            paginas = _ejecutar_upsert(cursor, SQL_UPSERT_DEPARTAMENTOS, valores)
+        if confirmar:
+            conexion.commit()
+        return _conteos_upsert(len(registros), paginas)
     except Exception as e:
         conexion.rollback()
-        raise RuntimeError(f"Error al upsert departamentos: {e}")
+        raise RuntimeError(f"Error al upsert departamentos: {e}") from e
 
 
-def upsert_trabajos(conexion, registros: List[RegistroTrabajo]) -> int:
+def upsert_trabajos(conexion, registros: List[RegistroTrabajo], confirmar: bool = True) -> Dict[str, int]:
     """Inserta/actualiza trabajos en lote con ON CONFLICT (UPSERT)."""
     if not registros:
-        return 0
+        return dict.fromkeys(CONTEOS_UPSERT, 0)
+    registros = _ordenar_sin_duplicados(registros)
     valores = [(r.id, r.trabajo) for r in registros]
-    sql = (
-        "INSERT INTO trabajos (id, trabajo) VALUES %s "
-        "ON CONFLICT (id) DO UPDATE SET trabajo = EXCLUDED.trabajo"
-    )
     try:
         with conexion.cursor() as cursor:
-            pgextras.execute_values(cursor, sql, valores, page_size=1090)
-        conexion.commit()
-        return len(registros)
+            paginas = _ejecutar_upsert(cursor, SQL_UPSERT_TRABAJOS, valores)
+        if confirmar:
+            conexion.commit()
+        return _conteos_upsert(len(registros), paginas)
     except Exception as e:
         conexion.rollback()
-        raise RuntimeError(f"Error al upsert trabajos: {e}")
+        raise RuntimeError(f"Error al upsert trabajos: {e}") from e
 
 
-def upsert_empleados(conexion, registros: List[RegistroEmpleado]) -> int:
+def upsert_empleados(conexion, registros: List[RegistroEmpleado], confirmar: bool = True) -> Dict[str, int]:
     """Inserta/actualiza empleados en lote con ON CONFLICT (UPSERT)."""
     if not registros:
-        return 0
+        return dict.fromkeys(CONTEOS_UPSERT, 0)
+    registros = _ordenar_sin_duplicados(registros)
     valores = [
         (
             r.id,
@@ -235,22 +760,693 @@ def upsert_empleados(conexion, registros: List[RegistroEmpleado]) -> int:
         )
         for r in registros
     ]
-    sql = (
-        "INSERT INTO empleados_contratados (id, nombre, fecha_hora, id_departamento, id_trabajo) VALUES %s "
-        "ON CONFLICT (id) DO UPDATE SET "
-        "nombre = EXCLUDED.nombre, "
-        "fecha_hora = EXCLUDED.fecha_hora, "
-        "id_departamento = EXCLUDED.id_departamento, "
-        "id_trabajo = EXCLUDED.id_trabajo"
+    try:
+        with conexion.cursor() as cursor:
+            paginas = _ejecutar_upsert(cursor, SQL_UPSERT_EMPLEADOS, valores)
+        if confirmar:
+            conexion.commit()
+        return _conteos_upsert(len(registros), paginas)
+    except Exception as e:
+        conexion.rollback()
+        raise RuntimeError(f"Error al upsert empleados: {e}") from e
+
+
+def upsert_por_tabla(conexion, tabla: str, registros: List[BaseModel], confirmar: bool = True) -> Dict[str, int]:
+    """Despacha el UPSERT correspondiente a la tabla; devuelve los conteos de CONTEOS_UPSERT."""
+    if tabla == "departamentos":
+        return upsert_departamentos(conexion, registros, confirmar)  # type: ignore[arg-type]
+    if tabla == "trabajos":
+        return upsert_trabajos(conexion, registros, confirmar)  # type: ignore[arg-type]
+    if tabla == "empleados_contratados":
+        return upsert_empleados(conexion, registros, confirmar)  # type: ignore[arg-type]
+    raise HTTPException(status_code=400, detail=f"Tabla no soportada: {tabla}")
+
+
+# =============================
+# Registros rechazados (dead-letter)
+# =============================
+_RECHAZADOS_TAMANO_BLOQUE = int(os.getenv('RECHAZADOS_TAMANO_BLOQUE', '5000'))
+_RECHAZADOS_INTERVALO_SEGUNDOS = float(os.getenv('RECHAZADOS_INTERVALO_SEGUNDOS', '1'))
+_RECHAZADOS_COLA_MAX = int(os.getenv('RECHAZADOS_COLA_MAX', '100000'))
+
+
+class EscritorEnBloque:
+    """Persiste filas en bloque desde un hilo de fondo.
+
+    Las peticiones solo encolan; el hilo agrupa hasta `tamano_bloque` filas (o lo que
+    haya tras `intervalo` segundos) y las entrega juntas a `_escribir`.
+    La cola es acotada: si se llena, encolar bloquea y actúa como contrapresión.
+    """
+
+    nombre_hilo = "escritor"
+
+    def __init__(self, tamano_bloque: int, intervalo: float, cola_max: int):
+        self._tamano_bloque = tamano_bloque
+        self._intervalo = intervalo
+        self._cola: "queue.Queue[Tuple]" = queue.Queue(maxsize=cola_max)
+        self._hilo: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _asegurar_hilo(self) -> None:
+        # El hilo se crea bajo demanda (y de nuevo tras un fork) para no arrancar al importar
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._hilo = threading.Thread(target=self._bucle, name=self.nombre_hilo, daemon=True)
+                self._hilo.start()
+
+    def encolar(self, filas: List[Tuple]) -> None:
+        self._asegurar_hilo()
+        for fila in filas:
+            self._cola.put(fila)
+
+    def vaciar(self) -> None:
+        """Bloquea hasta que todo lo encolado esté persistido."""
+        self._asegurar_hilo()
+        self._cola.join()
+
+    def _bucle(self) -> None:
+        while True:
+            bloque = [self._cola.get()]
+            limite = time.monotonic() + self._intervalo
+            while len(bloque) < self._tamano_bloque:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    bloque.append(self._cola.get(timeout=restante))
+                except queue.Empty:
+                    break
+            try:
+                self._escribir(bloque)
+            except Exception as e:
+                logger.exception("Error persistiendo %d filas (%s): %s", len(bloque), self.nombre_hilo, e)
+            finally:
+                for _ in bloque:
+                    self._cola.task_done()
+
+    def _escribir(self, bloque: List[Tuple]) -> None:
+        raise NotImplementedError
+
+
+class EscritorRechazados(EscritorEnBloque):
+    """Persiste registros rechazados con un único execute_values por bloque.
+
+    La respuesta ya informó su `lote_id`: si la base falla, el bloque se reintenta (con
+    espera creciente) hasta escribirse, como en los demás escritores.
+    """
+
+    nombre_hilo = "escritor-rechazados"
+
+    def _escribir(self, bloque: List[Tuple]) -> None:
+        espera = 0.5
+        while True:
+            try:
+                conexion = obtener_conexion_db()
+                try:
+                    with conexion.cursor() as cursor:
+                        pgextras.execute_values(
+                            cursor,
+                            "INSERT INTO registros_rechazados (lote_id, tabla, indice, codigo, detalle, registro) VALUES %s",
+                            bloque,
+                            page_size=1000,
+                        )
+                    conexion.commit()
+                finally:
+                    liberar_conexion_db(conexion)
+                return
+            except Exception as e:
+                logger.warning("Error persistiendo %d registros rechazados; reintento en %.1f s: %s", len(bloque), espera, e)
+                time.sleep(espera)
+                espera = min(espera * 2, 30.0)
+
+
+_escritor_rechazados = EscritorRechazados(
+    _RECHAZADOS_TAMANO_BLOQUE, _RECHAZADOS_INTERVALO_SEGUNDOS, _RECHAZADOS_COLA_MAX
+)
+
+
+def resumen_rechazados(errores: List[Dict[str, Any]], lote_id: Optional[str] = None) -> Dict[str, Any]:
+    """Resumen de los errores para la respuesta: total, conteo por código y el `lote_id`
+    con el que se consultan o reprocesan después con /rechazados."""
+    por_codigo: Dict[str, int] = defaultdict(int)
+    for err in errores:
+        por_codigo[err.get("codigo", "desconocido")] += 1
+    if not errores:
+        return {"total": 0, "por_codigo": {}, "lote_id": None}
+    return {"total": len(errores), "por_codigo": dict(por_codigo), "lote_id": lote_id or str(uuid.uuid4())}
+
+
+def encolar_rechazados(errores: List[Dict[str, Any]], lote_id: str) -> None:
+    """Envía los errores al dead-letter bajo `lote_id`; llamar tras confirmar la escritura que los produjo."""
+    filas = [
+        (
+            lote_id,
+            err.get("tabla"),
+            err.get("indice"),
+            err.get("codigo", "desconocido"),
+            json.dumps(err.get("detalle"), default=str),
+            json.dumps(err.get("registro"), default=str),
+        )
+        for err in errores
+    ]
+    _escritor_rechazados.encolar(filas)
+
+
+def registrar_rechazados(errores: List[Dict[str, Any]], lote_id: Optional[str] = None) -> Dict[str, Any]:
+    """Envía los errores al dead-letter y devuelve solo el resumen para la respuesta."""
+    resumen = resumen_rechazados(errores, lote_id)
+    if errores:
+        encolar_rechazados(errores, resumen["lote_id"])
+    return resumen
+
+
+# =============================
+# Registro de cambios (restauración a un punto en el tiempo)
+# =============================
+# Directorio de segmentos; vacío desactiva el registro
+REGISTRO_CAMBIOS_DIR = os.getenv('REGISTRO_CAMBIOS_DIR', 'registro_cambios')
+_CAMBIOS_TAMANO_BLOQUE = int(os.getenv('REGISTRO_CAMBIOS_TAMANO_BLOQUE', '50000'))
+_CAMBIOS_INTERVALO_SEGUNDOS = float(os.getenv('REGISTRO_CAMBIOS_INTERVALO_SEGUNDOS', '1'))
+_CAMBIOS_COLA_MAX = int(os.getenv('REGISTRO_CAMBIOS_COLA_MAX', '200000'))
+
+
+class EscritorCambios(EscritorEnBloque):
+    """Agrega las escrituras confirmadas al registro: un segmento PARQUET por tabla y bloque.
+
+    Como en EscritorDiferido, un bloque que falla no se descarta: se reintenta hasta
+    escribirlo, porque esas transacciones ya están confirmadas y no hay otra copia de sus
+    entradas. Mientras una transacción tiene entradas sin escribir, `marca` la deja
+    registrada en disco (ver registro_cambios.MarcaPendientes).
+    """
+
+    nombre_hilo = "escritor-cambios"
+
+    def __init__(self, directorio: str, tamano_bloque: int, intervalo: float, cola_max: int):
+        from registro_cambios import MarcaPendientes
+
+        super().__init__(tamano_bloque, intervalo, cola_max)
+        self._directorio = directorio
+        self.marca = MarcaPendientes(directorio)
+
+    def _escribir(self, bloque: List[Tuple]) -> None:
+        from registro_cambios import escribir_segmento
+
+        por_tabla: Dict[str, List[Tuple]] = defaultdict(list)
+        completas = []
+        for tabla, *entrada, ultima in bloque:
+            por_tabla[tabla].append(tuple(entrada))
+            if ultima:
+                completas.append(entrada[0])
+        espera = 0.5
+        while por_tabla:
+            tabla = next(iter(por_tabla))
+            try:
+                escribir_segmento(self._directorio, tabla, esquema_arrow_tabla(tabla), por_tabla[tabla])
+            except Exception as e:
+                logger.warning("Error escribiendo %d entradas del registro de cambios de %s; reintento en %.1f s: %s",
+                               len(por_tabla[tabla]), tabla, espera, e)
+                time.sleep(espera)
+                espera = min(espera * 2, 30.0)
+                continue
+            # Solo se reintentan las tablas que faltan, sin duplicar segmentos ya escritos
+            del por_tabla[tabla]
+        self.marca.liberar(completas)
+
+
+_escritor_cambios = EscritorCambios(
+    REGISTRO_CAMBIOS_DIR, _CAMBIOS_TAMANO_BLOQUE, _CAMBIOS_INTERVALO_SEGUNDOS, _CAMBIOS_COLA_MAX
+)
+
+
+def _incrementos_version(cursor) -> Dict[str, int]:
+    """Cuánto incrementó la transacción en curso la versión de cada tabla del cubo."""
+    cursor.execute(
+        "SELECT tabla, COALESCE(NULLIF(current_setting('versiones_tablas.' || tabla, true), ''), '0')::bigint "
+        "FROM unnest(%s::text[]) AS tabla",
+        (list(_TABLAS_CUBO),),
+    )
+    return {tabla: incremento for tabla, incremento in cursor.fetchall() if incremento}
+
+
+def marcar_cambios(conexion) -> Optional[Tuple[Optional[int], Optional[int], Optional[datetime], Dict[str, int]]]:
+    """(secuencia, txid, instante, incrementos) de la transacción en curso; llamar justo antes del commit.
+
+    La secuencia se toma después de escribir: dos transacciones que tocan la misma fila
+    se serializan por su bloqueo, así que para esa fila el orden de secuencia es el de
+    commit. Con el registro desactivado los tres primeros son None. `incrementos` (solo
+    con el cubo activo) es lo que la transacción sumó a versiones_tablas: el cubo avanza
+    su versión en eso al aplicar los cambios. Devuelve None si ambos están desactivados.
+    """
+    if not REGISTRO_CAMBIOS_DIR and _cubo is None:
+        return None
+    secuencia = txid = instante = None
+    incrementos: Dict[str, int] = {}
+    with conexion.cursor() as cursor:
+        if REGISTRO_CAMBIOS_DIR:
+            cursor.execute("SELECT nextval('registro_cambios_secuencia'), txid_current(), clock_timestamp()")
+            secuencia, txid, instante = cursor.fetchone()
+        if _cubo is not None:
+            incrementos = _incrementos_version(cursor)
+    if secuencia is not None:
+        # Antes del commit: si el proceso cae antes de escribir las entradas, la marca lo delata
+        _escritor_cambios.marca.reservar(secuencia, instante)
+    return secuencia, txid, instante, incrementos
+
+
+def registrar_cambios(marca: Optional[Tuple[Optional[int], Optional[int], Optional[datetime], Dict[str, int]]],
+                      cambios: List[Tuple[str, str, List[BaseModel]]]) -> None:
+    """Encola [(tabla, operacion, registros)] con la marca de su transacción; llamar tras el commit.
+
+    Si el cubo de contrataciones está activo, también le aplica los cambios.
+    """
+    if _cubo is not None:
+        _aplicar_cambios_cubo(cambios, marca[3] if marca is not None else {})
+    if marca is None or marca[0] is None:
+        return
+    secuencia, txid, instante, _ = marca
+    filas: List[Tuple] = []
+    for tabla, operacion, registros in cambios:
+        if operacion != OPERACION_UPSERT:
+            filas.append((tabla, secuencia, txid, instante, operacion, None, False))
+            continue
+        columnas = COLUMNAS_POR_TABLA[tabla]
+        for registro in registros:
+            valores = tuple(
+                valor.isoformat() if isinstance(valor, datetime) else valor
+                for valor in (getattr(registro, c) for c in columnas)
+            )
+            filas.append((tabla, secuencia, txid, instante, operacion, valores, False))
+    if not filas:
+        _escritor_cambios.marca.liberar([secuencia])
+        return
+    # La última entrada de la transacción la libera de la marca cuando su bloque está escrito
+    filas[-1] = filas[-1][:-1] + (True,)
+    _escritor_cambios.encolar(filas)
+
+
+# =============================
+# Escritura diferida (write-behind) de /transacciones
+# =============================
+# Directorio de la bitácora local; vacío desactiva el modo diferido
+ESCRITURA_DIFERIDA_DIR = os.getenv('ESCRITURA_DIFERIDA_DIR', '')
+_DIFERIDA_FILAS = int(os.getenv('ESCRITURA_DIFERIDA_FILAS', '50000'))
+_DIFERIDA_INTERVALO_SEGUNDOS = float(os.getenv('ESCRITURA_DIFERIDA_INTERVALO_MS', '200')) / 1000
+_DIFERIDA_COLA_MAX = int(os.getenv('ESCRITURA_DIFERIDA_COLA_MAX', '200000'))
+_DIFERIDA_SEGMENTO_BYTES = int(os.getenv('ESCRITURA_DIFERIDA_SEGMENTO_MB', '64')) * 1024 * 1024
+_DIFERIDA_ESPERA_GRUPO = float(os.getenv('ESCRITURA_DIFERIDA_ESPERA_GRUPO_MS', '2')) / 1000
+
+
+def _con_procedencia(grupos: Dict[str, List[Dict[str, Any]]], procedencia: Optional[Dict[str, Any]],
+                     tabla: str) -> List[Tuple[Dict[str, Any], Optional[str], Optional[int]]]:
+    """(registro, lote_id, indice en la solicitud) de cada registro de `tabla` en una línea
+    de la bitácora. Las líneas sin procedencia (anteriores a que se guardara) dan None."""
+    if procedencia is None:
+        return [(registro, None, None) for registro in grupos[tabla]]
+    return list(zip(grupos[tabla], itertools.repeat(procedencia["lote_id"]), procedencia["indices"][tabla]))
+
+
+class EscritorDiferido(EscritorEnBloque):
+    """Aplica a la base las filas de la bitácora de escritura diferida en bloques grandes.
+
+    Las filas llegan en orden de secuencia (ver BitacoraEscritura.al_persistir). Un bloque
+    que falla no se descarta: se reintenta hasta aplicarlo, porque su única otra copia es
+    la bitácora. Mientras tanto la cola se llena; las solicitudes reservan su lugar con
+    `reservar_cupo` antes de tomar una conexión y, sin lugar, responden 503.
+    """
+
+    nombre_hilo = "escritor-diferido"
+
+    def __init__(self, directorio: str, tamano_bloque: int, intervalo: float, cola_max: int):
+        super().__init__(tamano_bloque, intervalo, cola_max)
+        self._directorio = directorio
+        self._bitacora: Optional[escritura_diferida.BitacoraEscritura] = None
+        self._bitacora_pid: Optional[int] = None
+        self._lock_bitacora = threading.Lock()
+        # ids en la bitácora que aún no están en la base, por tabla (para validar FKs)
+        self._en_bufer: Dict[str, Counter] = defaultdict(Counter)
+        self._lock_en_bufer = threading.Lock()
+        self._aplicado = 0
+        self._cupo_reservado = 0
+        self._lock_cupo = threading.Lock()
+
+    def bitacora(self) -> escritura_diferida.BitacoraEscritura:
+        # Una por proceso: tras un fork la del padre no se comparte
+        with self._lock_bitacora:
+            if self._bitacora is None or self._bitacora_pid != os.getpid():
+                self._bitacora_pid = os.getpid()
+                self._bitacora = escritura_diferida.BitacoraEscritura(
+                    self._directorio, _DIFERIDA_SEGMENTO_BYTES, _DIFERIDA_ESPERA_GRUPO, self._al_persistir
+                )
+                self._en_bufer = defaultdict(Counter)
+            return self._bitacora
+
+    def reservar_cupo(self, filas: int) -> bool:
+        """Aparta lugar en la cola para `filas`; False si no lo hay.
+
+        Con el lugar apartado, encolar las filas de la solicitud no bloquea: una solicitud
+        que esperara ahí con su conexión del pool tomada podría agotar el pool que este
+        hilo necesita para aplicar la bitácora. Devolver con `liberar_cupo`.
+        """
+        with self._lock_cupo:
+            if self._cola.qsize() + self._cupo_reservado + filas > self._cola.maxsize:
+                return False
+            self._cupo_reservado += filas
+            return True
+
+    def liberar_cupo(self, filas: int) -> None:
+        with self._lock_cupo:
+            self._cupo_reservado -= filas
+
+    def _al_persistir(self, secuencia: int, grupos: Dict[str, List[Dict[str, Any]]],
+                      procedencia: Optional[Dict[str, Any]]) -> None:
+        with self._lock_en_bufer:
+            for tabla, registros in grupos.items():
+                self._en_bufer[tabla].update(r["id"] for r in registros)
+        filas = [
+            (secuencia, tabla, fila, False)
+            for tabla in grupos
+            for fila in _con_procedencia(grupos, procedencia, tabla)
+        ]
+        # La última fila de la línea indica que la secuencia queda completa en su bloque
+        filas[-1] = filas[-1][:3] + (True,)
+        self.encolar(filas)
+
+    def en_bufer(self, tabla: str, id_registro: Any) -> bool:
+        with self._lock_en_bufer:
+            return self._en_bufer[tabla][id_registro] > 0
+
+    def _escribir(self, bloque: List[Tuple]) -> None:
+        secuencia, _, _, completa = bloque[-1]
+        # Si la última línea sigue en el próximo bloque, solo las anteriores quedan aplicadas
+        hasta = secuencia if completa else secuencia - 1
+        por_tabla: Dict[str, List[Tuple[Dict[str, Any], Optional[str], Optional[int]]]] = defaultdict(list)
+        for _, tabla, fila, _ in bloque:
+            por_tabla[tabla].append(fila)
+        bitacora = self.bitacora()
+        espera = 0.5
+        while True:
+            try:
+                aplicar_diferidos(bitacora.origen, por_tabla, hasta)
+                break
+            except Exception as e:
+                logger.warning("Error aplicando %d filas diferidas; reintento en %.1f s: %s", len(bloque), espera, e)
+                time.sleep(espera)
+                espera = min(espera * 2, 30.0)
+        self._aplicado = hasta
+        bitacora.marcar_aplicado(hasta)
+        with self._lock_en_bufer:
+            for tabla, filas in por_tabla.items():
+                self._en_bufer[tabla].subtract(registro["id"] for registro, _, _ in filas)
+                self._en_bufer[tabla] += Counter()  # descarta los que llegaron a cero
+
+    def cerrar(self) -> None:
+        """Aplica lo pendiente y borra los segmentos ya aplicados de este proceso."""
+        if self._bitacora is None or self._bitacora_pid != os.getpid():
+            return
+        self.vaciar()
+        if self._bitacora.cerrar(self._aplicado):
+            # Sin segmentos que recuperar, la marca del origen ya no sirve
+            conexion = obtener_conexion_db()
+            try:
+                with conexion.cursor() as cursor:
+                    cursor.execute("DELETE FROM escritura_diferida_aplicada WHERE origen = %s", (self._bitacora.origen,))
+                conexion.commit()
+            finally:
+                liberar_conexion_db(conexion)
+
+
+_escritor_diferido = EscritorDiferido(
+    ESCRITURA_DIFERIDA_DIR, _DIFERIDA_FILAS, _DIFERIDA_INTERVALO_SEGUNDOS, _DIFERIDA_COLA_MAX
+)
+
+
+def aplicar_diferidos(origen: str, por_tabla: Dict[str, List[Tuple[Dict[str, Any], Optional[str], Optional[int]]]],
+                      hasta: int) -> None:
+    """Aplica filas diferidas en una transacción y registra `hasta` como aplicada para `origen`.
+
+    Cada fila es (registro, lote_id, indice) (ver _con_procedencia). Las FKs se validan de
+    nuevo: entre la aceptación y la escritura la fila referida pudo haberse borrado. Lo que
+    falle va al dead-letter, en el lote y con el índice de la solicitud que lo aceptó.
+    """
+    errores: Dict[Optional[str], List[Dict[str, Any]]] = defaultdict(list)
+    cambios: List[Tuple[str, str, List[BaseModel]]] = []
+    conexion = obtener_conexion_db()
+    try:
+        for tabla in ORDEN_DEPENDENCIAS:
+            if tabla not in por_tabla:
+                continue
+            filas = por_tabla[tabla]
+            registros_modelo, errores_modelo = _parsear_registros_para_tabla(tabla, [registro for registro, _, _ in filas])
+            registros_validos, errores_calidad = validar_reglas_calidad(tabla, registros_modelo, conexion)
+            _referir_errores_calidad(len(filas), errores_modelo, errores_calidad)
+            for err in errores_modelo + errores_calidad:
+                _, lote_id, indice = filas[err["indice"]]
+                if lote_id is not None:
+                    err["indice"] = indice
+                errores[lote_id].append(err)
+            with conexion.cursor() as cursor:
+                copiar_registros(cursor, tabla, registros_validos)
+            cambios.append((tabla, OPERACION_UPSERT, registros_validos))
+        with conexion.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO escritura_diferida_aplicada (origen, secuencia) VALUES (%s, %s) "
+                "ON CONFLICT (origen) DO UPDATE SET secuencia = EXCLUDED.secuencia, actualizado = now()",
+                (origen, hasta),
+            )
+        marca = marcar_cambios(conexion)
+        conexion.commit()
+    except BaseException:
+        conexion.rollback()
+        raise
+    finally:
+        liberar_conexion_db(conexion)
+    registrar_cambios(marca, cambios)
+    for lote_id, errores_lote in errores.items():
+        registrar_rechazados(errores_lote, lote_id)
+
+
+def _recuperar_origen(origen: str, lineas: List[Tuple[int, Dict[str, List[Dict[str, Any]]], Optional[Dict[str, Any]]]]) -> None:
+    """Aplica las líneas de un origen huérfano posteriores a su última secuencia aplicada."""
+    conexion = obtener_conexion_db()
+    try:
+        with conexion.cursor() as cursor:
+            cursor.execute("SELECT secuencia FROM escritura_diferida_aplicada WHERE origen = %s", (origen,))
+            fila = cursor.fetchone()
+        conexion.rollback()
+    finally:
+        liberar_conexion_db(conexion)
+    aplicada = fila[0] if fila else 0
+
+    por_tabla: Dict[str, List[Tuple[Dict[str, Any], Optional[str], Optional[int]]]] = defaultdict(list)
+    filas = 0
+    for secuencia, grupos, procedencia in lineas:
+        if secuencia <= aplicada:
+            continue
+        for tabla, registros in grupos.items():
+            por_tabla[tabla].extend(_con_procedencia(grupos, procedencia, tabla))
+            filas += len(registros)
+        if filas >= _DIFERIDA_FILAS:
+            aplicar_diferidos(origen, por_tabla, secuencia)
+            por_tabla, filas = defaultdict(list), 0
+    if por_tabla:
+        aplicar_diferidos(origen, por_tabla, lineas[-1][0])
+
+    conexion = obtener_conexion_db()
+    try:
+        with conexion.cursor() as cursor:
+            cursor.execute("DELETE FROM escritura_diferida_aplicada WHERE origen = %s", (origen,))
+        conexion.commit()
+    finally:
+        liberar_conexion_db(conexion)
+
+
+def recuperar_escritura_diferida() -> Dict[str, int]:
+    """Aplica los segmentos de bitácora que dejaron procesos caídos (ver escritura_diferida.recuperar)."""
+    recuperados = escritura_diferida.recuperar(ESCRITURA_DIFERIDA_DIR, _recuperar_origen)
+    for origen, lineas in recuperados.items():
+        logger.info("Escritura diferida: recuperadas %d líneas del origen %s", lineas, origen)
+    return recuperados
+
+
+def _resolver_fks_diferidas(registros_modelo: List[BaseModel], errores_calidad: List[Dict[str, Any]],
+                            locales: Dict[str, set]) -> Tuple[List[BaseModel], List[Dict[str, Any]]]:
+    """En modo diferido una FK también existe si su id está en la bitácora sin aplicar de
+    este proceso o en un grupo anterior del mismo payload. Devuelve (validos, errores)."""
+    referidas = {codigo: (columna, tabla) for columna, tabla, codigo in _FKS_EMPLEADOS}
+    conservados: List[Dict[str, Any]] = []
+    fallidos = set()
+    for err in errores_calidad:
+        columna, tabla = referidas[err["codigo"]]
+        valor = getattr(registros_modelo[err["indice"]], columna)
+        if valor in locales.get(tabla, ()) or _escritor_diferido.en_bufer(tabla, valor):
+            continue
+        conservados.append(err)
+        fallidos.add(err["indice"])
+    return [r for i, r in enumerate(registros_modelo) if i not in fallidos], conservados
+
+
+# =============================
+# Idempotencia de lotes (Idempotency-Key)
+# =============================
+_IDEMPOTENCIA_RETENCION_HORAS = int(os.getenv('IDEMPOTENCIA_RETENCION_HORAS', '24'))
+_IDEMPOTENCIA_EN_PROCESO_SEGUNDOS = int(os.getenv('IDEMPOTENCIA_EN_PROCESO_SEGUNDOS', '300'))
+_IDEMPOTENCIA_POR_CONTENIDO = os.getenv('IDEMPOTENCIA_POR_CONTENIDO', 'false').strip().lower() in ('1','true','yes')
+_IDEMPOTENCIA_PURGA_SEGUNDOS = 300
+_idempotencia_ultima_purga = 0.0
+
+
+def huella_payload(payload: Dict[str, Any]) -> str:
+    """SHA-256 del payload en JSON canónico (claves ordenadas)."""
+    canonico = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonico.encode('utf-8')).hexdigest()
+
+
+def _purgar_idempotencia(cursor) -> None:
+    """Borra claves vencidas como mucho una vez cada pocos minutos por proceso."""
+    global _idempotencia_ultima_purga
+    ahora = time.monotonic()
+    if ahora - _idempotencia_ultima_purga < _IDEMPOTENCIA_PURGA_SEGUNDOS:
+        return
+    _idempotencia_ultima_purga = ahora
+    cursor.execute(
+        "DELETE FROM solicitudes_idempotentes WHERE creado < now() - make_interval(hours => %s)",
+        (_IDEMPOTENCIA_RETENCION_HORAS,),
     )
+
+
+def reservar_idempotencia(conexion, clave: str, huella: str) -> Optional[Dict[str, Any]]:
+    """Reserva la clave para esta solicitud o devuelve la respuesta ya registrada.
+
+    - None: la clave es nueva (o venció); el llamador debe procesar y luego completar.
+    - dict: la solicitud ya se procesó; es la respuesta original.
+    - 409 si otra solicitud con la misma clave sigue en proceso.
+    - 422 si la clave ya se usó con un payload distinto.
+    La reserva se confirma de inmediato para que otros workers la vean.
+    """
     try:
         with conexion.cursor() as cursor:
-            pgextras.execute_values(cursor, sql, valores, page_size=1090)
+            _purgar_idempotencia(cursor)
+            cursor.execute(
+                "INSERT INTO solicitudes_idempotentes (clave, huella) VALUES (%s, %s) "
+                "ON CONFLICT (clave) DO UPDATE SET huella = EXCLUDED.huella, estado = 'en_proceso', "
+                "respuesta = NULL, creado = now() "
+                # Solo se reutiliza una clave vencida o una reserva abandonada por un worker caído
+                "WHERE solicitudes_idempotentes.creado < now() - make_interval(hours => %s) "
+                "OR (solicitudes_idempotentes.estado = 'en_proceso' "
+                "AND solicitudes_idempotentes.creado < now() - make_interval(secs => %s)) "
+                "RETURNING clave",
+                (clave, huella, _IDEMPOTENCIA_RETENCION_HORAS, _IDEMPOTENCIA_EN_PROCESO_SEGUNDOS),
+            )
+            reservada = cursor.fetchone() is not None
+            existente = None
+            if not reservada:
+                cursor.execute(
+                    "SELECT huella, estado, respuesta FROM solicitudes_idempotentes WHERE clave = %s",
+                    (clave,),
+                )
+                existente = cursor.fetchone()
         conexion.commit()
-        return len(registros)
     except Exception as e:
         conexion.rollback()
-        raise RuntimeError(f"Error al upsert empleados: {e}")
+        raise RuntimeError(f"Error registrando clave de idempotencia: {e}")
+
+    if reservada or existente is None:
+        return None
+    huella_previa, estado, respuesta = existente
+    if huella_previa != huella:
+        raise HTTPException(status_code=422, detail="Idempotency-Key ya usada con un payload distinto")
+    if estado != 'completado':
+        raise HTTPException(
+            status_code=409,
+            detail="Solicitud con la misma Idempotency-Key en proceso",
+            headers={"Retry-After": "1"},
+        )
+    return respuesta
+
+
+def completar_idempotencia(conexion, clave: str, respuesta: Dict[str, Any]) -> None:
+    """Guarda la respuesta de la clave. No confirma: va en la transacción del llamador."""
+    with conexion.cursor() as cursor:
+        cursor.execute(
+            "UPDATE solicitudes_idempotentes SET estado = 'completado', respuesta = %s WHERE clave = %s",
+            (json.dumps(respuesta, default=str), clave),
+        )
+
+
+def liberar_idempotencia(clave: str) -> None:
+    """Libera una reserva tras un fallo para que el reintento pueda procesarse."""
+    try:
+        conexion = obtener_conexion_db()
+        try:
+            with conexion.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM solicitudes_idempotentes WHERE clave = %s AND estado = 'en_proceso'",
+                    (clave,),
+                )
+            conexion.commit()
+        finally:
+            liberar_conexion_db(conexion)
+    except Exception as e:
+        # Si no se puede liberar, la reserva vence sola tras IDEMPOTENCIA_EN_PROCESO_SEGUNDOS
+        logger.warning("No se pudo liberar la clave de idempotencia %s: %s", clave, e)
+
+
+# =============================
+# Serialización JSON (ruta rápida)
+# =============================
+_JSON_STREAM_UMBRAL = int(os.getenv('JSON_STREAM_UMBRAL_FILAS', '5000'))
+_JSON_STREAM_BLOQUE = int(os.getenv('JSON_STREAM_BLOQUE_FILAS', '2000'))
+
+
+def _json_default(valor: Any) -> Any:
+    """Convierte tipos que el encoder no soporta de forma nativa."""
+    if isinstance(valor, Decimal):
+        return int(valor) if valor == valor.to_integral_value() else float(valor)
+    if hasattr(valor, 'isoformat'):
+        return valor.isoformat()
+    return str(valor)
+
+
+def a_json_bytes(contenido: Any) -> bytes:
+    """Serializa a JSON en bytes con orjson (o json estándar si no está disponible)."""
+    if orjson is not None:
+        return orjson.dumps(contenido, default=_json_default)
+    return json.dumps(contenido, default=_json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def respuesta_json(contenido: Any, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    """Respuesta JSON que evita jsonable_encoder y el encoder estándar de FastAPI."""
+    return Response(content=a_json_bytes(contenido), status_code=status_code, headers=headers, media_type="application/json")
+
+
+def respuesta_json_filas(conexion, cursor, columnas: Tuple[str, ...]) -> Response:
+    """Serializa el resultado de un cursor de tuplas directamente a un arreglo JSON.
+
+    El cursor es del lado del cliente: tras execute las filas ya están en memoria, así que
+    se leen todas y la conexión vuelve al pool antes de responder.
+    - Resultados pequeños: una sola serialización.
+    - Más de JSON_STREAM_UMBRAL_FILAS filas: se emite un arreglo JSON por bloques con
+      StreamingResponse, sin armar el cuerpo completo de una vez.
+    La conexión pasa a ser responsabilidad de esta función.
+    """
+    try:
+        filas = cursor.fetchall()
+    finally:
+        cursor.close()
+        liberar_conexion_db(conexion)
+    if len(filas) <= _JSON_STREAM_UMBRAL:
+        return respuesta_json([dict(zip(columnas, f)) for f in filas])
+
+    def generar():
+        yield b"["
+        for inicio in range(0, len(filas), _JSON_STREAM_BLOQUE):
+            fragmento = a_json_bytes([dict(zip(columnas, f)) for f in filas[inicio:inicio + _JSON_STREAM_BLOQUE]])[1:-1]
+            yield fragmento if inicio == 0 else b"," + fragmento
+        yield b"]"
+
+    return StreamingResponse(generar(), media_type="application/json")
 
 
 # =============================
@@ -268,40 +1464,524 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Servir archivos estáticos (UI JS)
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Servir archivos estáticos (UI JS)
+app.mount("/static", StaticFiles(directory="static"), name="static")
+
+# Exponer esquema de seguridad ApiKey en OpenAPI para facilitar pruebas desde Swagger
+# Esquema OpenAPI precalculado: se genera al construir la imagen (exportar_openapi) y se
+# carga en el primer acceso a /docs en lugar de recorrer todas las rutas en cada réplica.
+OPENAPI_PRECALCULADO = os.getenv(
+    'OPENAPI_PRECALCULADO',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openapi_precalculado.json'),
+)
+
+
+def _huella_rutas() -> str:
+    """Huella de versión + rutas/métodos; invalida el esquema precalculado si cambian."""
+    partes = sorted(f"{','.join(sorted(getattr(r, 'methods', None) or []))} {r.path}" for r in app.routes)
+    return hashlib.sha256("\n".join([app.version] + partes).encode('utf-8')).hexdigest()
+
+
+def construir_openapi() -> Dict[str, Any]:
+    from fastapi.openapi.utils import get_openapi  # Lazy import: solo lo usa /docs
+
+    openapi_schema = get_openapi(
+        title="Servicio de Ingesta de Datos",
+        version="1.0.0",
+        description="API de ingesta, respaldos y restauración de datos.",
+        routes=app.routes,
+    )
+    # Definir esquema de seguridad por API Key en cabecera
+    components = openapi_schema.setdefault("components", {})
+    security_schemes = components.setdefault("securitySchemes", {})
+    security_schemes["ApiKeyAuth"] = {
+        "type": "apiKey",
+        "in": "header",
+        "name": "X-API-Key",
+    }
+    # Aplicar seguridad global a todas las operaciones (solo para UI de Swagger)
+    for path_item in openapi_schema.get("paths", {}).values():
+        for operation in path_item.values():
+            if isinstance(operation, dict):
+                sec = operation.get("security", [])
+                sec.append({"ApiKeyAuth": []})
+                operation["security"] = sec
+    return openapi_schema
+
+
+def exportar_openapi(ruta: str = OPENAPI_PRECALCULADO) -> str:
+    """Escribe el esquema OpenAPI junto con la huella de rutas (paso de build)."""
+    esquema = construir_openapi()
+    esquema["x-huella-rutas"] = _huella_rutas()
+    with open(ruta, 'wb') as f:
+        f.write(a_json_bytes(esquema))
+    return ruta
+
+
+def _cargar_openapi_precalculado() -> Optional[Dict[str, Any]]:
+    try:
+        with open(OPENAPI_PRECALCULADO, 'rb') as f:
+            esquema = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if esquema.pop("x-huella-rutas", None) != _huella_rutas():
+        return None
+    return esquema
+
+
+def custom_openapi():
+    if app.openapi_schema:
+        return app.openapi_schema
+    app.openapi_schema = _cargar_openapi_precalculado() or construir_openapi()
+    return app.openapi_schema
+
+app.openapi = custom_openapi
+
+
+# =============================
+# Control de admisión de endpoints pesados
+# =============================
+# Espera máxima en la cola antes de responder 503
+_ADMISION_ESPERA_MAX = float(os.getenv('ADMISION_ESPERA_MAX_SEGUNDOS', '30'))
+# Tamaño (archivo a restaurar, tabla a respaldar, cuerpo de una carga) que cuenta como una unidad de peso
+_ADMISION_UNIDAD_BYTES = int(os.getenv('ADMISION_UNIDAD_MB', '64')) * 1024 * 1024
+# En /transacciones una unidad es menos: los payloads menores no pasan por el control
+_ADMISION_UNIDAD_TRANSACCIONES = int(os.getenv('ADMISION_TRANSACCIONES_UNIDAD_KB', '256')) * 1024
+# Tamaños de tablas para pesar /respaldos (pg_table_size), refrescados como mucho cada N segundos
+_ADMISION_TAMANOS_CACHE = float(os.getenv('ADMISION_TAMANOS_CACHE_SEGUNDOS', '60'))
+
+
+class LimiteAdmision:
+    """Semáforo con peso y cola de espera acotada para una clase de endpoints.
+
+    `capacidad` es la suma de pesos que puede ejecutarse a la vez; la cola es FIFO (una
+    solicitud liviana no adelanta a una pesada que espera). Vive en el event loop del
+    worker: las solicitudes en espera no ocupan hilos del threadpool.
+    """
+
+    def __init__(self, nombre: str, capacidad: int, cola_max: int):
+        self.nombre = nombre
+        self.capacidad = capacidad
+        self.cola_max = cola_max
+        self.en_uso = 0
+        self._cola: "deque[Tuple[int, asyncio.Future]]" = deque()
+        self._esperas_ms: "deque[float]" = deque(maxlen=1000)
+        # Media móvil de cuánto retiene cada solicitud su peso (para Retry-After)
+        self._duracion_media = 1.0
+        self.admitidas = 0
+        self.admitidas_con_espera = 0
+        self.rechazadas_cola_llena = 0
+        self.rechazadas_por_espera = 0
+        self.cola_maxima_observada = 0
+
+    def _despachar(self) -> None:
+        while self._cola:
+            peso, futuro = self._cola[0]
+            if self.en_uso + peso > self.capacidad:
+                return
+            self._cola.popleft()
+            self.en_uso += peso
+            futuro.set_result(None)
+
+    def reintentar_en(self) -> int:
+        """Segundos sugeridos para Retry-After: la cola actual a la velocidad reciente."""
+        return max(1, math.ceil(self._duracion_media * (len(self._cola) + 1) / max(1, self.capacidad)))
+
+    async def adquirir(self, peso: int) -> float:
+        """Espera hasta poder ejecutar `peso`; devuelve la espera en segundos.
+
+        Lanza HTTPException 503 si la cola está llena o la espera supera ADMISION_ESPERA_MAX_SEGUNDOS.
+        """
+        peso = min(peso, self.capacidad)  # una solicitud más pesada que todo corre sola
+        if not self._cola and self.en_uso + peso <= self.capacidad:
+            self.en_uso += peso
+            self.admitidas += 1
+            self._esperas_ms.append(0.0)
+            return 0.0
+        if len(self._cola) >= self.cola_max:
+            self.rechazadas_cola_llena += 1
+            raise HTTPException(status_code=503, detail=f"Servicio saturado ({self.nombre}), intente más tarde",
+                                headers={"Retry-After": str(self.reintentar_en())})
+        futuro = asyncio.get_running_loop().create_future()
+        self._cola.append((peso, futuro))
+        self.cola_maxima_observada = max(self.cola_maxima_observada, len(self._cola))
+        inicio = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(futuro), _ADMISION_ESPERA_MAX)
+        except asyncio.TimeoutError:
+            if not futuro.done():
+                futuro.cancel()
+                self._cola.remove((peso, futuro))
+                self.rechazadas_por_espera += 1
+                raise HTTPException(status_code=503, detail=f"Servicio saturado ({self.nombre}): se agotó la espera en cola",
+                                    headers={"Retry-After": str(self.reintentar_en())})
+        except asyncio.CancelledError:
+            if futuro.done() and not futuro.cancelled():
+                self.liberar(peso)
+            else:
+                futuro.cancel()
+                self._cola.remove((peso, futuro))
+            raise
+        espera = time.perf_counter() - inicio
+        self.admitidas += 1
+        self.admitidas_con_espera += 1
+        self._esperas_ms.append(espera * 1000)
+        return espera
+
+    def liberar(self, peso: int, duracion: Optional[float] = None) -> None:
+        self.en_uso -= min(peso, self.capacidad)
+        if duracion is not None:
+            self._duracion_media = 0.8 * self._duracion_media + 0.2 * duracion
+        self._despachar()
+
+    def metricas(self) -> Dict[str, Any]:
+        esperas = sorted(self._esperas_ms)
+
+        def percentil(p: float) -> Optional[float]:
+            return round(esperas[min(len(esperas) - 1, int(p * len(esperas)))], 1) if esperas else None
+
+        return {
+            "capacidad": self.capacidad,
+            "en_uso": self.en_uso,
+            "en_cola": len(self._cola),
+            "peso_en_cola": sum(peso for peso, _ in self._cola),
+            "cola_max": self.cola_max,
+            "cola_maxima_observada": self.cola_maxima_observada,
+            "admitidas": self.admitidas,
+            "admitidas_con_espera": self.admitidas_con_espera,
+            "rechazadas_cola_llena": self.rechazadas_cola_llena,
+            "rechazadas_por_espera": self.rechazadas_por_espera,
+            "espera_ms": {"p50": percentil(0.5), "p95": percentil(0.95), "max": round(esperas[-1], 1) if esperas else None},
+            "duracion_media_ms": round(self._duracion_media * 1000, 1),
+        }
+
+
+def _limite_desde_entorno(nombre: str, capacidad: int, cola_max: int) -> Optional[LimiteAdmision]:
+    clave = nombre.upper()
+    capacidad = int(os.getenv(f'ADMISION_{clave}_CAPACIDAD', str(capacidad)))
+    cola_max = int(os.getenv(f'ADMISION_{clave}_COLA', str(cola_max)))
+    # Capacidad 0 desactiva el control para esa clase
+    return LimiteAdmision(nombre, capacidad, cola_max) if capacidad > 0 else None
+
+
+# Límites por proceso (cada worker tiene los suyos, como su pool de conexiones)
+_LIMITES_ADMISION: Dict[str, Optional[LimiteAdmision]] = {
+    "restauraciones": _limite_desde_entorno("restauraciones", 2, 8),
+    "respaldos": _limite_desde_entorno("respaldos", 2, 8),
+    "cargas": _limite_desde_entorno("cargas", 2, 8),
+    "transacciones": _limite_desde_entorno("transacciones", 8, 32),
+}
+_tamanos_tablas: Dict[str, int] = {}
+_tamanos_tablas_medido = 0.0
+
+
+def _tamanos_tablas_bytes() -> Dict[str, int]:
+    """pg_table_size de las tablas de datos, medido como mucho cada ADMISION_TAMANOS_CACHE_SEGUNDOS."""
+    global _tamanos_tablas_medido
+    if time.time() - _tamanos_tablas_medido < _ADMISION_TAMANOS_CACHE:
+        return _tamanos_tablas
+    conexion = obtener_conexion_lectura()
+    try:
+        with conexion.cursor() as cursor:
+            cursor.execute(
+                "SELECT relname, pg_table_size(oid) FROM pg_class WHERE relname = ANY(%s) AND relkind = 'r'",
+                (list(TABLAS_VALIDAS),),
+            )
+            _tamanos_tablas.update(cursor.fetchall())
+        conexion.commit()
+    finally:
+        liberar_conexion_db(conexion)
+    _tamanos_tablas_medido = time.time()
+    return _tamanos_tablas
+
+
+def _unidades(tamano: int, unidad: int) -> int:
+    return max(1, math.ceil(tamano / unidad))
+
+
+def _peso_maximo(clase: str) -> int:
+    """Peso que ocupa toda la clase (corre sola en ella)."""
+    limite = _LIMITES_ADMISION[clase]
+    return limite.capacidad if limite else 1
+
+
+async def _clase_y_peso(request: Request) -> Optional[Tuple[str, int]]:
+    """Clase de admisión y peso de la solicitud, o None si no pasa por el control.
+
+    Solo se lee el cuerpo de /restaurar y /respaldos (JSON chico); Starlette lo
+    conserva para el endpoint. El de /cargas/csv no se toca: se procesa por streaming.
+    Un cuerpo sin Content-Length (chunked) no se puede medir antes de leerlo: en
+    /transacciones y /cargas/csv ocupa toda su clase.
+    """
+    if request.method != "POST":
+        return None
+    path = request.url.path
+    try:
+        largo = int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        largo = None
+    if path == "/transacciones":
+        if largo is None:
+            return "transacciones", _peso_maximo("transacciones")
+        # Payloads chicos (peso 0) no esperan detrás de los grandes
+        peso = largo // _ADMISION_UNIDAD_TRANSACCIONES
+        return ("transacciones", peso) if peso else None
+    if path.startswith("/cargas/csv/"):
+        if largo is None:
+            return "cargas", _peso_maximo("cargas")
+        return "cargas", _unidades(largo, _ADMISION_UNIDAD_BYTES)
+    if path == "/restaurar/punto_en_el_tiempo":
+        # Vacía y recarga varias tablas: corre sola en su clase
+        return "restauraciones", _peso_maximo("restauraciones")
+    if path not in ("/restaurar", "/respaldos"):
+        return None
+    try:
+        payload = json.loads(await request.body() or b"{}")
+    except ValueError:
+        payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
+    if path == "/restaurar":
+        archivo = payload.get("archivo")
+        try:
+            tamano = os.path.getsize(archivo) if isinstance(archivo, str) else 0
+        except OSError:
+            tamano = 0  # el endpoint responde el error
+        return "restauraciones", _unidades(tamano, _ADMISION_UNIDAD_BYTES)
+    tablas = payload.get("tablas")
+    if not isinstance(tablas, list):
+        tablas = list(TABLAS_VALIDAS)
+    try:
+        tamanos = await run_in_threadpool(_tamanos_tablas_bytes)
+    except Exception:
+        tamanos = {}
+    return "respaldos", sum(_unidades(tamanos.get(t, 0), _ADMISION_UNIDAD_BYTES) for t in tablas if isinstance(t, str))
+
+
+class ControlAdmisionMiddleware(BaseHTTPMiddleware):
+    """Limita cuántas restauraciones, respaldos, cargas y /transacciones grandes corren a la vez.
+
+    Con la clase saturada responde 503 con Retry-After; las solicitudes admitidas traen
+    la espera en cola en `X-Admision-Espera-Ms`.
+    """
+
+    async def dispatch(self, request, call_next):
+        clase_peso = await _clase_y_peso(request)
+        limite = _LIMITES_ADMISION.get(clase_peso[0]) if clase_peso else None
+        if limite is None:
+            return await call_next(request)
+        peso = clase_peso[1]
+        try:
+            espera = await limite.adquirir(peso)
+        except HTTPException as e:
+            return PlainTextResponse(e.detail, status_code=e.status_code, headers=e.headers)
+        inicio = time.perf_counter()
+        try:
+            respuesta = await call_next(request)
+        finally:
+            limite.liberar(peso, time.perf_counter() - inicio)
+        respuesta.headers["X-Admision-Espera-Ms"] = str(int(espera * 1000))
+        return respuesta
+
+# Se registra antes que la seguridad para quedar por dentro: lo no autorizado no ocupa cupo
+app.add_middleware(ControlAdmisionMiddleware)
+
+
+@app.get("/metricas/admision")
+async def metricas_admision():
+    """Estado del control de admisión de este worker: uso, cola, rechazos y espera por clase.
+
+    Es async para leer las colas desde el mismo event loop que las modifica.
+    """
+    return respuesta_json({
+        "pid": os.getpid(),
+        "espera_max_segundos": _ADMISION_ESPERA_MAX,
+        "clases": {nombre: (limite.metricas() if limite else None) for nombre, limite in _LIMITES_ADMISION.items()},
+    })
+
+
+@app.get("/metricas/sentencias_preparadas")
+def metricas_sentencias_preparadas():
+    """PREPARE enviados y reutilizaciones por sentencia en este worker, y los planes de una conexión.
+
+    `conexion` muestra pg_prepared_statements de una conexión de lectura del pool: cuántas
+    ejecuciones usaron el plan genérico y cuántas uno a medida (PostgreSQL 14+).
+    """
+    sentencias = {}
+    for nombre in _SENTENCIAS:
+        preparaciones = preparaciones_sentencias[nombre]
+        reutilizaciones = reutilizaciones_sentencias[nombre]
+        total = preparaciones + reutilizaciones
+        sentencias[nombre] = {
+            "preparaciones": preparaciones,
+            "reutilizaciones": reutilizaciones,
+            "tasa_reutilizacion": round(reutilizaciones / total, 4) if total else None,
+        }
+    conexion = obtener_conexion_lectura()
+    try:
+        with conexion.cursor() as cur:
+            cur.execute(
+                "SELECT name, generic_plans, custom_plans FROM pg_prepared_statements "
+                "WHERE name = ANY(%s) ORDER BY name",
+                (list(_SENTENCIAS),),
+            )
+            planes = {nombre: {"planes_genericos": g, "planes_a_medida": c} for nombre, g, c in cur.fetchall()}
+        conexion.rollback()
+    except psycopg2.Error:
+        conexion.rollback()
+        planes = None
+    finally:
+        liberar_conexion_db(conexion)
+    return respuesta_json({
+        "pid": os.getpid(),
+        "activo": SENTENCIAS_PREPARADAS,
+        "sentencias": sentencias,
+        "conexion": planes,
+    })
+
+
+# =============================
+# Límites de tiempo y cancelación de consultas abandonadas
+# =============================
+# statement_timeout por endpoint (0 = sin límite)
+_STATEMENT_TIMEOUT_MS = {
+    "metricas": int(os.getenv('STATEMENT_TIMEOUT_METRICAS_MS', '30000')),
+    "restaurar": int(os.getenv('STATEMENT_TIMEOUT_RESTAURAR_MS', '600000')),
+}
+# Tras una desconexión, cada cuánto se repite la cancelación hasta que el hilo termina
+_CANCELACION_REPETIR = int(os.getenv('CANCELACION_REPETIR_MS', '200')) / 1000
+# Estado HTTP (convención de nginx) de las solicitudes cuyo cliente se desconectó: nadie lo recibe
+HTTP_CLIENTE_DESCONECTADO = 499
+
+# Por clase: trabajos, cancelados por desconexión o por statement_timeout y segundos que llevaban
+trabajos_cancelables: Dict[str, Counter] = {clase: Counter() for clase in _STATEMENT_TIMEOUT_MS}
 
-# Exponer esquema de seguridad ApiKey en OpenAPI para facilitar pruebas desde Swagger
-from fastapi.openapi.utils import get_openapi
 
-def custom_openapi():
-    if app.openapi_schema:
-        return app.openapi_schema
-    openapi_schema = get_openapi(
-        title="Servicio de Ingesta de Datos",
-        version="1.0.0",
-        description="API de ingesta, respaldos y restauración de datos.",
-        routes=app.routes,
-    )
-    # Definir esquema de seguridad por API Key en cabecera
-    components = openapi_schema.setdefault("components", {})
-    security_schemes = components.setdefault("securitySchemes", {})
-    security_schemes["ApiKeyAuth"] = {
-        "type": "apiKey",
-        "in": "header",
-        "name": "X-API-Key",
-    }
-    # Aplicar seguridad global a todas las operaciones (solo para UI de Swagger)
-    for path_item in openapi_schema.get("paths", {}).values():
-        for operation in path_item.values():
-            if isinstance(operation, dict):
-                sec = operation.get("security", [])
-                sec.append({"ApiKeyAuth": []})
-                operation["security"] = sec
-    app.openapi_schema = openapi_schema
-    return app.openapi_schema
+class TrabajoCancelable:
+    """Conexión que usa una solicitud mientras consulta, para cancelar la consulta si el cliente se va.
 
-app.openapi = custom_openapi
+    El hilo que consulta llama usar() al tomar la conexión y soltar() antes de devolverla
+    al pool: cancelar() solo alcanza a la conexión entre ambos momentos. La cancelación
+    es una señal asíncrona que puede llegar a la sentencia siguiente (el ROLLBACK o la de
+    otra solicitud que reutilice la conexión), así que soltar() cierra la conexión si se
+    le envió alguna: el pool descarta las cerradas.
+    """
+
+    def __init__(self, clase: str):
+        self.clase = clase
+        self.desconectado = False
+        self._conexion = None
+        self._cancelada = False
+        self._lock = threading.Lock()
+
+    def usar(self, conexion) -> None:
+        """Asocia `conexion` y fija el statement_timeout de la clase para la transacción en curso."""
+        with conexion.cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('statement_timeout', %s, true)",
+                (str(_STATEMENT_TIMEOUT_MS[self.clase]),),
+            )
+        with self._lock:
+            self._conexion = conexion
+        if self.desconectado:
+            # El cliente se fue antes de que hubiera una consulta que cancelar
+            raise psycopg2.extensions.QueryCanceledError("cliente desconectado")
+
+    def soltar(self) -> None:
+        with self._lock:
+            if self._cancelada and self._conexion is not None:
+                self._conexion.close()
+            self._conexion = None
+
+    def cancelar(self) -> None:
+        """Cancela la sentencia en curso, si la hay (como pg_cancel_backend, sin ocupar otra conexión del pool)."""
+        with self._lock:
+            self.desconectado = True
+            if self._conexion is not None and not self._conexion.closed:
+                self._conexion.cancel()
+                self._cancelada = True
+
+
+def _por_cancelacion(error: BaseException) -> bool:
+    """True si `error` o alguna excepción de su cadena es una sentencia cancelada (57014)."""
+    vistos = set()
+    while error is not None and id(error) not in vistos:
+        if isinstance(error, psycopg2.extensions.QueryCanceledError):
+            return True
+        vistos.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+
+async def _esperar_desconexion(request: Request) -> None:
+    """Termina cuando llega http.disconnect (el cuerpo ya se leyó; solo queda ese mensaje).
+
+    request.is_disconnected() no sirve aquí: sondea sin esperar y, detrás de los
+    BaseHTTPMiddleware, el mensaje nunca está disponible en el acto.
+    """
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+
+async def ejecutar_cancelable(request: Request, clase: str, funcion: Callable[..., Any], *args) -> Any:
+    """Ejecuta funcion(trabajo, *args) en un hilo y cancela su consulta si el cliente se desconecta.
+
+    Si la conexión HTTP se cierra antes de que el hilo termine, se cancela la sentencia
+    en curso y se repite cada CANCELACION_REPETIR_MS hasta que el hilo termine (una
+    transacción larga ejecuta varias). El cliente desconectado recibe 499; una sentencia
+    que supera el statement_timeout de la clase, 504.
+    """
+    trabajo = TrabajoCancelable(clase)
+    contadores = trabajos_cancelables[clase]
+    contadores["trabajos"] += 1
+    inicio = time.perf_counter()
+    tarea = asyncio.ensure_future(run_in_threadpool(funcion, trabajo, *args))
+    desconexion = asyncio.ensure_future(_esperar_desconexion(request))
+    try:
+        await asyncio.wait({tarea, desconexion}, return_when=asyncio.FIRST_COMPLETED)
+        while not tarea.done():
+            trabajo.cancelar()
+            await asyncio.wait({tarea}, timeout=_CANCELACION_REPETIR)
+    finally:
+        desconexion.cancel()
+        if desconexion.done() and not desconexion.cancelled():
+            desconexion.exception()  # un receive que falló cuenta como desconexión
+    try:
+        resultado = tarea.result()
+    except BaseException as e:
+        if not _por_cancelacion(e):
+            raise
+        contadores["desconexion" if trabajo.desconectado else "statement_timeout"] += 1
+        contadores["segundos_cancelados"] += time.perf_counter() - inicio
+        if trabajo.desconectado:
+            return Response(status_code=HTTP_CLIENTE_DESCONECTADO)
+        raise HTTPException(
+            status_code=504,
+            detail=f"La consulta superó el límite de {_STATEMENT_TIMEOUT_MS[clase]} ms y se canceló",
+        )
+    if trabajo.desconectado:
+        # Terminó antes de que la cancelación llegara a una sentencia
+        contadores["desconexion_tardia"] += 1
+    return resultado
+
+
+@app.get("/metricas/cancelaciones")
+def metricas_cancelaciones():
+    """Trabajos cancelables de este worker por clase: cuántos hubo, cuántos se cancelaron y por qué."""
+    return respuesta_json({
+        "pid": os.getpid(),
+        "clases": {
+            clase: {
+                "statement_timeout_ms": _STATEMENT_TIMEOUT_MS[clase],
+                "trabajos": contadores["trabajos"],
+                "cancelados_desconexion": contadores["desconexion"],
+                "cancelados_statement_timeout": contadores["statement_timeout"],
+                "desconexiones_tardias": contadores["desconexion_tardia"],
+                "segundos_cancelados": round(contadores["segundos_cancelados"], 3),
+            }
+            for clase, contadores in trabajos_cancelables.items()
+        },
+    })
 
 
 # =============================
@@ -331,7 +2011,10 @@ class SimpleSecurityMiddleware(BaseHTTPMiddleware):
 
         # Rate limiting
         try:
-            rate_limiter(request)
+            if RATE_LIMIT_BACKEND == 'postgres':
+                await run_in_threadpool(rate_limiter_compartido, request)
+            else:
+                rate_limiter(request)
         except HTTPException as e:
             return PlainTextResponse(e.detail, status_code=e.status_code)
 
@@ -340,10 +2023,33 @@ class SimpleSecurityMiddleware(BaseHTTPMiddleware):
 app.add_middleware(SimpleSecurityMiddleware)
 
 
+# Incrementar al cambiar el DDL de asegurar_esquema: las réplicas que encuentren esta
+# versión (o una mayor) registrada en la base omiten el DDL por completo.
+ESQUEMA_VERSION = 6
+
+
+def version_esquema_registrada(conexion) -> Optional[int]:
+    """Versión del esquema registrada en la base (None si aún no existe el marcador)."""
+    with conexion.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('esquema_version') IS NOT NULL")
+        version = None
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT version FROM esquema_version")
+            fila = cursor.fetchone()
+            version = fila[0] if fila else None
+    conexion.commit()
+    return version
+
+
 def asegurar_esquema(conexion) -> None:
     """Crea tablas si no existen, sin borrar datos existentes."""
     try:
+        version = version_esquema_registrada(conexion)
+        if version is not None and version >= ESQUEMA_VERSION:
+            return
         with conexion.cursor() as cursor:
+            # Serializa el DDL cuando varios workers arrancan a la vez
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('asegurar_esquema'))")
             cursor.execute(
                 """
                 CREATE TABLE IF NOT EXISTS departamentos (
@@ -371,7 +2077,130 @@ def asegurar_esquema(conexion) -> None:
                 );
                 """
             )
+            # Dead-letter de registros rechazados por esquema o reglas de calidad
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS registros_rechazados (
+                    id BIGSERIAL PRIMARY KEY,
+                    lote_id VARCHAR(36) NOT NULL,
+                    tabla VARCHAR(50) NOT NULL,
+                    indice INTEGER,
+                    codigo VARCHAR(50) NOT NULL,
+                    detalle JSONB,
+                    registro JSONB,
+                    creado TIMESTAMP NOT NULL DEFAULT now(),
+                    reprocesado BOOLEAN NOT NULL DEFAULT FALSE
+                );
+                CREATE INDEX IF NOT EXISTS idx_registros_rechazados_lote
+                    ON registros_rechazados (lote_id);
+                """
+            )
+            # Resultados de lotes por Idempotency-Key (compartido entre workers)
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS solicitudes_idempotentes (
+                    clave VARCHAR(255) PRIMARY KEY,
+                    huella CHAR(64) NOT NULL,
+                    estado VARCHAR(20) NOT NULL DEFAULT 'en_proceso',
+                    respuesta JSONB,
+                    creado TIMESTAMP NOT NULL DEFAULT now()
+                );
+                CREATE INDEX IF NOT EXISTS idx_solicitudes_idempotentes_creado
+                    ON solicitudes_idempotentes (creado);
+                """
+            )
+            # Contadores de rate limiting compartidos (UNLOGGED: no necesitan sobrevivir a un crash)
+            cursor.execute(
+                """
+                CREATE UNLOGGED TABLE IF NOT EXISTS limites_tasa (
+                    clave VARCHAR(100) NOT NULL,
+                    ventana BIGINT NOT NULL,
+                    conteo INTEGER NOT NULL,
+                    PRIMARY KEY (clave, ventana)
+                );
+                """
+            )
+            # Versión de datos por tabla: triggers por sentencia la incrementan en cada
+            # escritura que cambia filas (con las tablas de transición se descartan las
+            # sentencias que no tocaron ninguna, p. ej. un UPSERT de filas idénticas).
+            # Se reparte en particiones por backend para que escrituras concurrentes no se
+            # serialicen sobre una misma fila; la versión es la suma.
+            # Lo que incrementa la transacción en curso queda además en la variable local
+            # `versiones_tablas.<tabla>` (ver _incrementos_version).
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS versiones_tablas (
+                    tabla VARCHAR(50) NOT NULL,
+                    particion SMALLINT NOT NULL,
+                    version BIGINT NOT NULL,
+                    PRIMARY KEY (tabla, particion)
+                );
+                CREATE OR REPLACE FUNCTION incrementar_version_tabla() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP <> 'TRUNCATE' THEN
+                        IF NOT EXISTS (SELECT 1 FROM filas) THEN
+                            RETURN NULL;
+                        END IF;
+                    END IF;
+                    INSERT INTO versiones_tablas (tabla, particion, version)
+                    VALUES (TG_TABLE_NAME, pg_backend_pid() % 16, 1)
+                    ON CONFLICT (tabla, particion)
+                    DO UPDATE SET version = versiones_tablas.version + 1;
+                    PERFORM set_config(
+                        'versiones_tablas.' || TG_TABLE_NAME,
+                        (COALESCE(NULLIF(current_setting('versiones_tablas.' || TG_TABLE_NAME, true), ''), '0')::bigint + 1)::text,
+                        true
+                    );
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+                """
+            )
+            # Un trigger con tabla de transición (`filas`) admite un solo evento; TRUNCATE no
+            # tiene, por eso la función solo la consulta en los demás.
+            eventos = {
+                "INSERT": "REFERENCING NEW TABLE AS filas",
+                "UPDATE": "REFERENCING NEW TABLE AS filas",
+                "DELETE": "REFERENCING OLD TABLE AS filas",
+                "TRUNCATE": "",
+            }
+            for tabla in TABLAS_VALIDAS:
+                cursor.execute(f"DROP TRIGGER IF EXISTS trg_version_{tabla} ON {tabla}")
+                for evento, transicion in eventos.items():
+                    cursor.execute(
+                        f"""
+                        DROP TRIGGER IF EXISTS trg_version_{tabla}_{evento.lower()} ON {tabla};
+                        CREATE TRIGGER trg_version_{tabla}_{evento.lower()}
+                            AFTER {evento} ON {tabla} {transicion}
+                            FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version_tabla();
+                        """
+                    )
+            # Orden de las transacciones en el registro de cambios (ver marcar_cambios)
+            cursor.execute("CREATE SEQUENCE IF NOT EXISTS registro_cambios_secuencia")
+            # Última secuencia de la bitácora de escritura diferida aplicada por cada origen (proceso)
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS escritura_diferida_aplicada (
+                    origen VARCHAR(64) PRIMARY KEY,
+                    secuencia BIGINT NOT NULL,
+                    actualizado TIMESTAMP NOT NULL DEFAULT now()
+                );
+                """
+            )
             # El esquema previo no incluye tabla de usuarios/api keys
+            cursor.execute(
+                """
+                CREATE TABLE IF NOT EXISTS esquema_version (
+                    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                    version INTEGER NOT NULL,
+                    actualizado TIMESTAMP NOT NULL DEFAULT now()
+                );
+                INSERT INTO esquema_version (id, version) VALUES (TRUE, %s)
+                ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version, actualizado = now()
+                WHERE esquema_version.version < EXCLUDED.version;
+                """,
+                (ESQUEMA_VERSION,),
+            )
         conexion.commit()
     except Exception as e:
         conexion.rollback()
@@ -380,12 +2209,32 @@ def asegurar_esquema(conexion) -> None:
 
 @app.on_event("startup")
 def _on_startup():
-    """Evento de arranque: asegurar que el esquema existe."""
-    conexion = obtener_conexion_db()
-    try:
-        asegurar_esquema(conexion)
-    finally:
-        conexion.close()
+    """Evento de arranque: asegurar que el esquema existe y recuperar la escritura diferida.
+
+    Con ESQUEMA_VERIFICACION=diferida no se toca la base al arrancar; la verificación
+    ocurre con la primera conexión que pida el proceso (salvo que haya bitácora que recuperar).
+    """
+    if ESQUEMA_VERIFICACION != 'diferida':
+        conexion = obtener_conexion_db()
+        liberar_conexion_db(conexion)
+    if ESCRITURA_DIFERIDA_DIR:
+        # Antes de atender solicitudes: lo que dejó un proceso caído va primero
+        try:
+            recuperar_escritura_diferida()
+        except Exception as e:
+            logger.error("Error recuperando la bitácora de escritura diferida (se reintenta al próximo arranque): %s", e)
+
+
+@app.on_event("shutdown")
+def _on_shutdown():
+    """Evento de cierre: aplicar la escritura diferida, persistir rechazados y cambios que sigan en cola y cerrar el pool."""
+    if ESCRITURA_DIFERIDA_DIR:
+        _escritor_diferido.cerrar()
+    _escritor_rechazados.vaciar()
+    if REGISTRO_CAMBIOS_DIR:
+        _escritor_cambios.vaciar()
+        _escritor_cambios.marca.cerrar()
+    cerrar_pools()
 
 # =============================
 # Healthcheck simple
@@ -400,119 +2249,360 @@ def healthz():
                 cur.execute("SELECT 1")
                 _ = cur.fetchone()
         finally:
-            con.close()
+            liberar_conexion_db(con)
         return "ok"
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"unhealthy: {e}")
 
+# =============================
+# Cubo de contrataciones en memoria (métricas sin consultar la base)
+# =============================
+CUBO_CONTRATACIONES = os.getenv('CUBO_CONTRATACIONES', 'false').strip().lower() in ('1','true','yes')
+# Cada cuánto, como mucho, se compara la versión de datos de las tablas con la del cubo
+_CUBO_VERIFICAR_SEGUNDOS = float(os.getenv('CUBO_VERIFICAR_SEGUNDOS', '5'))
+_TABLAS_CUBO = ("empleados_contratados", "departamentos", "trabajos")
+
+if CUBO_CONTRATACIONES:
+    from cubo_contrataciones import CuboContrataciones
+    _cubo: Optional["CuboContrataciones"] = CuboContrataciones()
+else:
+    _cubo = None
+_cubo_carga_lock = threading.Lock()
+_cubo_invalido = True
+_cubo_verificado = 0.0
+_cubo_recargando = False
+
+
+def _versiones_cubo(cursor) -> Dict[str, int]:
+    cursor.execute(
+        "SELECT tabla, SUM(version) FROM versiones_tablas WHERE tabla = ANY(%s) GROUP BY tabla",
+        (list(_TABLAS_CUBO),),
+    )
+    versiones = {tabla: 0 for tabla in _TABLAS_CUBO}
+    versiones.update({tabla: int(version) for tabla, version in cursor.fetchall()})
+    return versiones
+
+
+def cargar_cubo() -> None:
+    """Lee las tres tablas del primario, en una misma instantánea, y reemplaza el contenido del cubo."""
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    from cubo_contrataciones import COLUMNAS_EMPLEADOS, NULO
+
+    conexion = obtener_conexion_db()
+    try:
+        conexion.rollback()
+        with conexion.cursor() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            versiones = _versiones_cubo(cursor)
+            datos = io.BytesIO()
+            # Solo los 16 bytes por fila que usa el cubo; COPY + lector CSV de Arrow, sin tuplas Python
+            cursor.copy_expert(
+                "COPY (SELECT id, "
+                f"COALESCE(id_departamento, {NULO}), COALESCE(id_trabajo, {NULO}), "
+                "COALESCE(EXTRACT(YEAR FROM fecha_hora)::int, 0), COALESCE(EXTRACT(QUARTER FROM fecha_hora)::int, 0) "
+                "FROM empleados_contratados) TO STDOUT WITH (FORMAT csv)",
+                datos,
+            )
+            cursor.execute("SELECT id, departamento FROM departamentos")
+            departamentos = dict(cursor.fetchall())
+            cursor.execute("SELECT id, trabajo FROM trabajos")
+            trabajos = dict(cursor.fetchall())
+        conexion.rollback()
+    finally:
+        liberar_conexion_db(conexion)
+
+    if datos.tell() == 0:
+        columnas = {c: np.empty(0, dtype=np.int32) for c in COLUMNAS_EMPLEADOS}
+    else:
+        datos.seek(0)
+        tabla = pacsv.read_csv(
+            datos,
+            read_options=pacsv.ReadOptions(column_names=list(COLUMNAS_EMPLEADOS)),
+            convert_options=pacsv.ConvertOptions(column_types={c: pa.int32() for c in COLUMNAS_EMPLEADOS}),
+        )
+        columnas = {c: tabla.column(c).to_numpy() for c in COLUMNAS_EMPLEADOS}
+    _cubo.cargar(columnas, departamentos, trabajos, versiones)
+
+
+def _recargar_cubo() -> None:
+    global _cubo_recargando
+    try:
+        with _cubo_carga_lock:
+            cargar_cubo()
+    except Exception as e:
+        logger.error("Error recargando el cubo de contrataciones (sigue el contenido anterior): %s", e)
+    finally:
+        _cubo_recargando = False
+
+
+def cubo_vigente() -> "CuboContrataciones":
+    """El cubo, cargado y con la versión de datos verificada hace menos de CUBO_VERIFICAR_SEGUNDOS.
+
+    La primera vez (o tras una restauración) se carga antes de responder. Si otro
+    worker o un proceso externo escribió, las versiones difieren y se recarga en un
+    hilo de fondo mientras se sigue respondiendo con el contenido anterior.
+    """
+    global _cubo_invalido, _cubo_verificado, _cubo_recargando
+    if _cubo_invalido or not _cubo.cargado:
+        with _cubo_carga_lock:
+            if _cubo_invalido or not _cubo.cargado:
+                # Antes de leer: una barrera durante la carga vuelve a invalidar
+                _cubo_invalido = False
+                _cubo_verificado = time.time()
+                try:
+                    cargar_cubo()
+                except BaseException:
+                    _cubo_invalido = True
+                    raise
+        return _cubo
+    if time.time() - _cubo_verificado >= _CUBO_VERIFICAR_SEGUNDOS and not _cubo_recargando:
+        _cubo_verificado = time.time()
+        conexion = obtener_conexion_db()
+        try:
+            with conexion.cursor() as cursor:
+                versiones = _versiones_cubo(cursor)
+            conexion.rollback()
+        finally:
+            liberar_conexion_db(conexion)
+        if versiones != _cubo.versiones:
+            _cubo_recargando = True
+            threading.Thread(target=_recargar_cubo, name="cubo-recarga", daemon=True).start()
+    return _cubo
+
+
+def _aplicar_cambios_cubo(cambios: List[Tuple[str, str, List[BaseModel]]], incrementos: Dict[str, int]) -> None:
+    """Lleva al cubo las escrituras recién confirmadas por este proceso.
+
+    `incrementos` (ver marcar_cambios) avanza la versión del cubo: sin eso, la próxima
+    verificación vería la versión que subió el trigger y recargaría todo por una
+    escritura que el cubo ya tiene.
+    """
+    global _cubo_invalido
+    from cubo_contrataciones import NULO
+
+    for tabla, operacion, registros in cambios:
+        if tabla not in _TABLAS_CUBO:
+            continue
+        if operacion == OPERACION_VACIAR:
+            _cubo.vaciar(tabla)
+        elif operacion != OPERACION_UPSERT:
+            # Restauraciones: no traen las filas, se recarga todo en la próxima consulta
+            # (salvo que no hayan cambiado ninguna: entonces el trigger no sumó nada)
+            if incrementos.get(tabla):
+                _cubo_invalido = True
+        elif tabla == "empleados_contratados":
+            _cubo.aplicar_empleados({
+                "id": [r.id for r in registros],
+                "departamento": [NULO if r.id_departamento is None else r.id_departamento for r in registros],
+                "trabajo": [NULO if r.id_trabajo is None else r.id_trabajo for r in registros],
+                "anio": [0 if r.fecha_hora is None else r.fecha_hora.year for r in registros],
+                "trimestre": [0 if r.fecha_hora is None else (r.fecha_hora.month - 1) // 3 + 1 for r in registros],
+            })
+        else:
+            campo = "departamento" if tabla == "departamentos" else "trabajo"
+            _cubo.aplicar_nombres(tabla, {r.id: getattr(r, campo) for r in registros})
+    _cubo.avanzar_versiones(incrementos)
+
+
+@app.get("/metricas/cubo")
+def metricas_cubo():
+    """Estado del cubo de contrataciones: filas, memoria, versiones, cargas y deltas aplicados."""
+    if _cubo is None:
+        return {"activo": False}
+    return {"activo": True, **_cubo.metricas()}
+
+
 # =============================
 # Métricas trimestrales (Desafío #2)
 # =============================
+SQL_TRIMESTRES = registrar_sentencia("metricas_trimestres", ("int",), (
+    "SELECT "
+    "  d.departamento AS department, "
+    "  j.trabajo AS job, "
+    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 1 AND 3 THEN 1 ELSE 0 END)::int AS q1, "
+    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 4 AND 6 THEN 1 ELSE 0 END)::int AS q2, "
+    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 7 AND 9 THEN 1 ELSE 0 END)::int AS q3, "
+    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 10 AND 12 THEN 1 ELSE 0 END)::int AS q4 "
+    "FROM empleados_contratados e "
+    "JOIN departamentos d ON e.id_departamento = d.id "
+    "JOIN trabajos j ON e.id_trabajo = j.id "
+    "WHERE e.fecha_hora IS NOT NULL AND EXTRACT(YEAR FROM e.fecha_hora) = $1 "
+    "GROUP BY d.departamento, j.trabajo "
+    "ORDER BY d.departamento ASC, j.trabajo ASC"
+))
+SQL_TRIMESTRES_CON_NULOS = registrar_sentencia("metricas_trimestres_con_nulos", ("int",), (
+    "SELECT "
+    "  COALESCE(d.departamento, 'Sin asignar') AS department, "
+    "  COALESCE(j.trabajo, 'Sin asignar') AS job, "
+    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 1 AND 3 THEN 1 ELSE 0 END)::int AS q1, "
+    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 4 AND 6 THEN 1 ELSE 0 END)::int AS q2, "
+    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 7 AND 9 THEN 1 ELSE 0 END)::int AS q3, "
+    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 10 AND 12 THEN 1 ELSE 0 END)::int AS q4 "
+    "FROM empleados_contratados e "
+    "LEFT JOIN departamentos d ON e.id_departamento = d.id "
+    "LEFT JOIN trabajos j ON e.id_trabajo = j.id "
+    "WHERE e.fecha_hora IS NOT NULL AND EXTRACT(YEAR FROM e.fecha_hora) = $1 "
+    "GROUP BY department, job "
+    "ORDER BY department ASC, job ASC"
+))
+
+
+def _consultar_metrica(trabajo: TrabajoCancelable, nombre: str, parametros: Tuple[Any, ...],
+                       columnas: Tuple[str, ...]) -> Response:
+    """Ejecuta la métrica registrada `nombre` en una conexión de lectura y serializa sus filas."""
+    conexion = obtener_conexion_lectura()
+    try:
+        trabajo.usar(conexion)
+        # Cursor de tuplas: las filas van directo al serializador sin RealDictCursor
+        cur = conexion.cursor()
+        ejecutar_preparada(cur, nombre, parametros)
+    except BaseException:
+        trabajo.soltar()
+        liberar_conexion_db(conexion)
+        raise
+    # Las filas ya están en el cliente: serializarlas no usa la base
+    trabajo.soltar()
+    return respuesta_json_filas(conexion, cur, columnas)
+
+
+def _metrica_desde_cubo(metodo: str, columnas: Tuple[str, ...], *args) -> Response:
+    filas = getattr(cubo_vigente(), metodo)(*args)
+    return respuesta_json([dict(zip(columnas, f)) for f in filas])
+
+
 @app.get("/metricas/contrataciones_por_trimestre")
-def metricas_contrataciones_por_trimestre(anio: int, incluir_nulos: bool = False):
+async def metricas_contrataciones_por_trimestre(request: Request, anio: int, incluir_nulos: bool = False):
     """Cantidad de empleados contratados en 'anio' por departamento y cargo, dividido por trimestre.
 
     - Ordena alfabéticamente por departamento y luego por cargo.
     - Si `incluir_nulos=true`, agrupa NULL como 'Sin asignar'.
     - Requiere API key si está configurada (middleware global).
+    - Con CUBO_CONTRATACIONES=true se responde desde el cubo en memoria.
+    - La consulta se cancela si supera STATEMENT_TIMEOUT_METRICAS_MS (504) o si el
+      cliente se desconecta antes de recibir la respuesta.
     """
-    conexion = obtener_conexion_db()
-    try:
-        with conexion.cursor(cursor_factory=pgextras.RealDictCursor) as cur:
-            if incluir_nulos:
-                sql = (
-                    "SELECT "
-                    "  COALESCE(d.departamento, 'Sin asignar') AS department, "
-                    "  COALESCE(j.trabajo, 'Sin asignar') AS job, "
-                    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 1 AND 3 THEN 1 ELSE 0 END) AS q1, "
-                    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 4 AND 6 THEN 1 ELSE 0 END) AS q2, "
-                    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 7 AND 9 THEN 1 ELSE 0 END) AS q3, "
-                    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 10 AND 12 THEN 1 ELSE 0 END) AS q4 "
-                    "FROM empleados_contratados e "
-                    "LEFT JOIN departamentos d ON e.id_departamento = d.id "
-                    "LEFT JOIN trabajos j ON e.id_trabajo = j.id "
-                    "WHERE e.fecha_hora IS NOT NULL AND EXTRACT(YEAR FROM e.fecha_hora) = %s "
-                    "GROUP BY department, job "
-                    "ORDER BY department ASC, job ASC"
-                )
-                cur.execute(sql, (anio,))
-            else:
-                sql = (
-                    "SELECT "
-                    "  d.departamento AS department, "
-                    "  j.trabajo AS job, "
-                    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 1 AND 3 THEN 1 ELSE 0 END) AS q1, "
-                    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 4 AND 6 THEN 1 ELSE 0 END) AS q2, "
-                    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 7 AND 9 THEN 1 ELSE 0 END) AS q3, "
-                    "  SUM(CASE WHEN EXTRACT(MONTH FROM e.fecha_hora) BETWEEN 10 AND 12 THEN 1 ELSE 0 END) AS q4 "
-                    "FROM empleados_contratados e "
-                    "JOIN departamentos d ON e.id_departamento = d.id "
-                    "JOIN trabajos j ON e.id_trabajo = j.id "
-                    "WHERE e.fecha_hora IS NOT NULL AND EXTRACT(YEAR FROM e.fecha_hora) = %s "
-                    "GROUP BY d.departamento, j.trabajo "
-                    "ORDER BY d.departamento ASC, j.trabajo ASC"
-                )
-                cur.execute(sql, (anio,))
-            filas = cur.fetchall()
-            return [
-                {
-                    "department": f.get("department"),
-                    "job": f.get("job"),
-                    "q1": int(f.get("q1", 0) or 0),
-                    "q2": int(f.get("q2", 0) or 0),
-                    "q3": int(f.get("q3", 0) or 0),
-                    "q4": int(f.get("q4", 0) or 0),
-                }
-                for f in filas
-            ]
-    finally:
-        conexion.close()
+    columnas = ("department", "job", "q1", "q2", "q3", "q4")
+    if _cubo is not None:
+        return await run_in_threadpool(_metrica_desde_cubo, "contrataciones_por_trimestre", columnas, anio, incluir_nulos)
+    sentencia = SQL_TRIMESTRES_CON_NULOS if incluir_nulos else SQL_TRIMESTRES
+    return await ejecutar_cancelable(request, "metricas", _consultar_metrica, sentencia, (anio,), columnas)
 
 
 # =============================
 # Métrica: Departamentos sobre el promedio anual
 # =============================
+SQL_SOBRE_PROMEDIO = registrar_sentencia("metricas_sobre_promedio", ("int",), (
+    "WITH hires AS ("
+    "  SELECT d.id AS id, d.departamento AS department,"
+    "         COUNT(e.id)::int AS hired"
+    "  FROM departamentos d"
+    "  LEFT JOIN empleados_contratados e"
+    "    ON e.id_departamento = d.id"
+    "   AND e.fecha_hora IS NOT NULL"
+    "   AND EXTRACT(YEAR FROM e.fecha_hora) = $1"
+    "  GROUP BY d.id, d.departamento"
+    "), avg_h AS ("
+    "  SELECT AVG(hired) AS avg_hired FROM hires"
+    ")"
+    " SELECT id, department, hired"
+    " FROM hires, avg_h"
+    " WHERE hired > avg_hired"
+    " ORDER BY hired DESC"
+))
+
+
 @app.get("/metricas/departamentos_sobre_promedio")
-def departamentos_sobre_promedio(anio: int):
+async def departamentos_sobre_promedio(request: Request, anio: int):
     """Lista de departamentos que contratan más empleados que el promedio en un año dado.
 
     - Considera todos los departamentos para calcular el promedio (incluidos con 0 contrataciones).
     - Devuelve: id del departamento, nombre y cantidad contratada.
     - Ordena de mayor a menor según la cantidad de contrataciones.
+    - Con CUBO_CONTRATACIONES=true se responde desde el cubo en memoria.
+    - Se cancela como /metricas/contrataciones_por_trimestre.
     """
-    conexion = obtener_conexion_db()
-    try:
-        with conexion.cursor(cursor_factory=pgextras.RealDictCursor) as cur:
-            sql = (
-                "WITH hires AS ("
-                "  SELECT d.id AS id, d.departamento AS department,"
-                "         COUNT(e.id) AS hired"
-                "  FROM departamentos d"
-                "  LEFT JOIN empleados_contratados e"
-                "    ON e.id_departamento = d.id"
-                "   AND e.fecha_hora IS NOT NULL"
-                "   AND EXTRACT(YEAR FROM e.fecha_hora) = %s"
-                "  GROUP BY d.id, d.departamento"
-                "), avg_h AS ("
-                "  SELECT AVG(hired) AS avg_hired FROM hires"
-                ")"
-                " SELECT id, department, hired"
-                " FROM hires, avg_h"
-                " WHERE hired > avg_hired"
-                " ORDER BY hired DESC"
-            )
-            cur.execute(sql, (anio,))
-            filas = cur.fetchall()
-            return [
-                {
-                    "id": int(f.get("id")),
-                    "department": f.get("department"),
-                    "hired": int(f.get("hired", 0) or 0),
-                }
-                for f in filas
-            ]
-    finally:
-        conexion.close()
+    columnas = ("id", "department", "hired")
+    if _cubo is not None:
+        return await run_in_threadpool(_metrica_desde_cubo, "departamentos_sobre_promedio", columnas, anio)
+    return await ejecutar_cancelable(request, "metricas", _consultar_metrica, SQL_SOBRE_PROMEDIO, (anio,), columnas)
+
+# =============================
+# Analítica sobre respaldos PARQUET (sin tocar PostgreSQL)
+# =============================
+_ANALITICA_COLUMNAS = {
+    "empleados_contratados": ("fecha_hora", "id_departamento", "id_trabajo"),
+    "departamentos": ("id", "departamento"),
+    "trabajos": ("id", "trabajo"),
+}
+
+
+def _respaldos_analitica(directorio: str, tablas: Tuple[str, ...]) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """Tablas Arrow del último respaldo PARQUET válido de cada tabla y cabecera con los archivos usados."""
+    import analitica
+
+    cargadas: Dict[str, Any] = {}
+    usados: List[str] = []
+    for tabla in tablas:
+        info = _listar_respaldos_por_tabla(tabla, directorio)
+        archivos = [a for a in info["archivos"] if a["formato"] == "parquet"]
+        verificado, _ = _ultimo_respaldo_valido(archivos)
+        if verificado is None:
+            raise HTTPException(status_code=404, detail=f"No hay respaldos PARQUET válidos de '{tabla}' en '{directorio}'")
+        ruta = verificado["ruta"]
+        try:
+            cargadas[tabla] = analitica.cargar_respaldo(ruta, _ANALITICA_COLUMNAS[tabla])
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error leyendo el respaldo '{ruta}': {e}")
+        usados.append(os.path.basename(ruta))
+    return cargadas, {"X-Respaldos": ",".join(usados)}
+
+
+@app.get("/analitica/contrataciones_por_trimestre")
+def analitica_contrataciones_por_trimestre(anio: int, incluir_nulos: bool = False, directorio: str = "respaldos"):
+    """Como /metricas/contrataciones_por_trimestre, calculado sobre los últimos respaldos PARQUET."""
+    import analitica
+
+    t, cabeceras = _respaldos_analitica(directorio, ("empleados_contratados", "departamentos", "trabajos"))
+    resultado = analitica.contrataciones_por_trimestre(
+        t["empleados_contratados"], t["departamentos"], t["trabajos"], anio, incluir_nulos
+    )
+    return respuesta_json(resultado.to_pylist(), headers=cabeceras)
+
+
+@app.get("/analitica/departamentos_sobre_promedio")
+def analitica_departamentos_sobre_promedio(anio: int, directorio: str = "respaldos"):
+    """Como /metricas/departamentos_sobre_promedio, calculado sobre los últimos respaldos PARQUET."""
+    import analitica
+
+    t, cabeceras = _respaldos_analitica(directorio, ("empleados_contratados", "departamentos"))
+    resultado = analitica.departamentos_sobre_promedio(t["empleados_contratados"], t["departamentos"], anio)
+    return respuesta_json(resultado.to_pylist(), headers=cabeceras)
+
+
+@app.get("/analitica/agrupar")
+def analitica_agrupar(por: str, anio: Optional[int] = None, directorio: str = "respaldos"):
+    """Contrataciones agrupadas por dimensiones separadas por coma (p. ej. `por=departamento,trimestre`).
+
+    Dimensiones: anio, trimestre, mes, id_departamento, id_trabajo, departamento, trabajo.
+    """
+    import analitica
+
+    dimensiones = [d.strip() for d in por.split(",") if d.strip()]
+    invalidas = [d for d in dimensiones if d not in analitica.DIMENSIONES]
+    if not dimensiones or invalidas or len(set(dimensiones)) != len(dimensiones):
+        raise HTTPException(
+            status_code=400,
+            detail=f"'por' debe listar dimensiones distintas entre: {', '.join(analitica.DIMENSIONES)}",
+        )
+    tablas = ("empleados_contratados",)
+    tablas += tuple(t for d, t in (("departamento", "departamentos"), ("trabajo", "trabajos")) if d in dimensiones)
+    t, cabeceras = _respaldos_analitica(directorio, tablas)
+    resultado = analitica.agrupar(
+        t["empleados_contratados"], t.get("departamentos"), t.get("trabajos"), dimensiones, anio
+    )
+    return respuesta_json(resultado.to_pylist(), headers=cabeceras)
 
 # =============================
 # Restauración desde AVRO/PARQUET y verificación de respaldos
@@ -541,7 +2631,7 @@ def leer_parquet_archivo(ruta_archivo: str) -> List[Dict[str, Any]]:
     if not os.path.exists(ruta_archivo):
         raise HTTPException(status_code=400, detail=f"Archivo no encontrado: {ruta_archivo}")
     try:
-        table = pq.read_table(ruta_archivo)
+        table = pq.read_table(ruta_archivo, memory_map=True)
         return table.to_pylist()
     except Exception as e:
         raise RuntimeError(f"Error leyendo PARQUET: {e}")
@@ -570,12 +2660,16 @@ def _listar_respaldos_por_tabla(tabla: str, directorio: str = "respaldos", solo_
         fecha = m.group(1)
         if solo_hoy and fecha != hoy:
             continue
+        ruta = os.path.join(directorio, nombre)
         archivos.append({
             "archivo": nombre,
-            "ruta": os.path.join(directorio, nombre),
+            "ruta": ruta,
             "fecha": fecha,
             "formato": nombre.split('.')[-1],
+            "manifiesto": os.path.exists(ruta + ".manifest.json"),
         })
+    # Más reciente primero (el nombre lleva fecha y hora)
+    archivos.sort(key=lambda a: a["archivo"], reverse=True)
 
     return {
         "existen": len(archivos) > 0,
@@ -593,6 +2687,44 @@ def respaldos_existe(tabla: str, directorio: str = "respaldos", solo_hoy: bool =
     return _listar_respaldos_por_tabla(tabla, directorio, solo_hoy)
 
 
+@app.get("/respaldos/verificar")
+def verificar_respaldo_endpoint(archivo: Optional[str] = None, tabla: Optional[str] = None,
+                                directorio: str = "respaldos", completa: bool = False):
+    """Verifica un respaldo contra su manifiesto (tamaño, registros y, si completa=true, SHA-256).
+
+    Se indica `archivo` (ruta) o `tabla`, en cuyo caso se verifica su respaldo más reciente.
+    La verificación rápida solo lee el footer PARQUET o las cabeceras de bloque AVRO.
+    """
+    from lectura_respaldos import verificar_respaldo
+
+    if archivo is None:
+        if tabla is None:
+            raise HTTPException(status_code=400, detail="Indique 'archivo' o 'tabla'")
+        info = _listar_respaldos_por_tabla(tabla, directorio)
+        if not info["existen"]:
+            raise HTTPException(status_code=404, detail=f"No hay respaldos para '{tabla}' en '{directorio}'")
+        archivo = info["archivos"][0]["ruta"]
+    if not archivo.endswith(('.avro', '.parquet')):
+        raise HTTPException(status_code=400, detail="'archivo' debe ser .avro o .parquet")
+    return verificar_respaldo(archivo, completa=completa)
+
+
+def _ultimo_respaldo_valido(archivos: List[Dict[str, Any]], completa: bool = False) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Primer respaldo (del más reciente al más antiguo) que pasa la verificación.
+
+    Devuelve (verificación del válido o None, verificaciones fallidas).
+    """
+    from lectura_respaldos import verificar_respaldo
+
+    fallidos: List[Dict[str, Any]] = []
+    for info in archivos:
+        verificacion = verificar_respaldo(info["ruta"], completa=completa)
+        if verificacion["valido"]:
+            return verificacion, fallidos
+        fallidos.append(verificacion)
+    return None, fallidos
+
+
 @app.delete("/limpiar_tabla")
 def limpiar_tabla(payload: Dict[str, Any] = Body(..., description="Borra todos los registros de una tabla si hay respaldo")):
     """
@@ -600,53 +2732,485 @@ def limpiar_tabla(payload: Dict[str, Any] = Body(..., description="Borra todos l
     {
       "tabla": "departamentos" | "trabajos" | "empleados_contratados",
       "directorio": "respaldos" (opcional, por defecto),
-      "solo_hoy": true (opcional, por defecto true)
+      "solo_hoy": true (opcional, por defecto true),
+      "verificacion_completa": false (opcional; true recalcula el SHA-256 del respaldo)
     }
+
+    Antes de borrar se verifica que el respaldo más reciente sea legible y coincida con
+    su manifiesto; si no, se prueba con los anteriores.
     """
     tabla = payload.get('tabla')
     directorio = payload.get('directorio') or 'respaldos'
     solo_hoy = payload.get('solo_hoy', True)
+    verificacion_completa = bool(payload.get('verificacion_completa', False))
+
+    if tabla not in TABLAS_VALIDAS:
+        raise HTTPException(status_code=400, detail="'tabla' debe ser una tabla válida")
+
+    info = _listar_respaldos_por_tabla(tabla, directorio, solo_hoy=bool(solo_hoy))
+    if not info["existen"]:
+        raise HTTPException(status_code=400, detail=f"No hay respaldos {'de hoy ' if solo_hoy else ''}.avro o .parquet para '{tabla}' en '{directorio}'")
+    verificado, fallidos = _ultimo_respaldo_valido(info["archivos"], completa=verificacion_completa)
+    if verificado is None:
+        raise HTTPException(status_code=409, detail={
+            "mensaje": f"Ningún respaldo de '{tabla}' pasó la verificación; no se borraron datos",
+            "verificaciones": fallidos,
+        })
+
+    # Borrado seguro de datos de la tabla
+    conexion = obtener_conexion_db()
+    try:
+        borrados = 0
+        with conexion.cursor() as cursor:
+            referencias = _referencias_a_tabla(cursor, tabla)
+            if referencias:
+                # TRUNCATE no se admite en tablas referenciadas: DELETE, solo si ninguna fila la usa
+                for referente, columna in referencias:
+                    cursor.execute(f"LOCK TABLE {referente} IN SHARE MODE")
+                    cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {referente} WHERE {columna} IS NOT NULL)")
+                    if cursor.fetchone()[0]:
+                        raise HTTPException(
+                            status_code=409,
+                            detail=f"No se puede vaciar '{tabla}': hay filas de '{referente}' que la referencian ({columna})",
+                        )
+                version = version_datos_tabla(conexion, tabla)
+                cursor.execute(f"DELETE FROM {tabla}")
+                borrados = cursor.rowcount if cursor.rowcount is not None else 0
+            else:
+                # TRUNCATE: sin WAL por fila ni tuplas muertas que limpiar después
+                cursor.execute(f"LOCK TABLE {tabla} IN ACCESS EXCLUSIVE MODE")
+                version = version_datos_tabla(conexion, tabla)
+                cursor.execute(f"SELECT count(*) FROM {tabla}")
+                borrados = cursor.fetchone()[0]
+                cursor.execute(f"TRUNCATE {tabla}")
+        marca = marcar_cambios(conexion)
+        conexion.commit()
+        registrar_cambios(marca, [(tabla, OPERACION_VACIAR, [])])
+        manifiesto = verificado.get("manifiesto") or {}
+        return {
+            "tabla": tabla,
+            "borrados": borrados,
+            "respaldos": info,
+            "respaldo_verificado": verificado,
+            # False: hubo escrituras posteriores al respaldo (None si no tiene manifiesto)
+            "respaldo_al_dia": (manifiesto.get("version_datos") == version) if manifiesto else None,
+        }
+    except HTTPException:
+        conexion.rollback()
+        raise
+    except Exception as e:
+        conexion.rollback()
+        raise HTTPException(status_code=500, detail=f"Error al borrar datos de '{tabla}': {e}")
+    finally:
+        liberar_conexion_db(conexion)
+
+
+# =============================
+# Restauración PARQUET con Arrow (sin objetos Python por fila)
+# =============================
+_RESTAURAR_LOTE_ARROW = int(os.getenv('RESTAURAR_LOTE_ARROW_FILAS', '50000'))
+# Lectura paralela de respaldos: hilos para row groups PARQUET, procesos para bloques AVRO
+_RESTAURAR_HILOS = int(os.getenv('RESTAURAR_HILOS') or os.cpu_count() or 1)
+_RESTAURAR_PROCESOS_AVRO = int(os.getenv('RESTAURAR_PROCESOS_AVRO') or os.cpu_count() or 1)
+_AVRO_PARALELO_MIN_BYTES = int(os.getenv('AVRO_PARALELO_MIN_BYTES', str(32 * 1024 * 1024)))
+# Mismas restricciones de texto que los modelos: (mínimo, máximo, obligatorio)
+_RESTRICCIONES_TEXTO = {
+    "departamento": (1, 50, True),
+    "trabajo": (1, 200, True),
+    "nombre": (0, 100, False),
+}
+_FKS_EMPLEADOS = (
+    ("id_departamento", "departamentos", CODIGO_FK_DEPARTAMENTO),
+    ("id_trabajo", "trabajos", CODIGO_FK_TRABAJO),
+)
+
+
+def _copiar_csv_a_tabla(cursor, tabla: str, columnas: Tuple[str, ...], datos_csv) -> Dict[str, int]:
+    """COPY de un bloque CSV a un staging temporal y UPSERT en la tabla destino.
+
+    Si el bloque repite un id, gana la última fila (igual que lotes sucesivos). Como en
+    upsert_*, las filas idénticas no se reescriben; devuelve los conteos de CONTEOS_UPSERT.
+    """
+    stg = f"_stg_{tabla}"
+    cursor.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS {stg} (LIKE {tabla} INCLUDING DEFAULTS, _fila BIGSERIAL) ON COMMIT DROP"
+    )
+    lista = ", ".join(columnas)
+    cursor.copy_expert(f"COPY {stg} ({lista}) FROM STDIN WITH (FORMAT csv)", datos_csv)
+    actualizar = ", ".join(f"{c} = EXCLUDED.{c}" for c in columnas if c != 'id')
+    cambia = " OR ".join(f"{tabla}.{c} IS DISTINCT FROM EXCLUDED.{c}" for c in columnas if c != 'id')
+    cursor.execute(
+        f"WITH fuente AS (SELECT DISTINCT ON (id) {lista} FROM {stg} ORDER BY id, _fila DESC), "
+        f"escritas AS (INSERT INTO {tabla} ({lista}) SELECT {lista} FROM fuente "
+        f"ON CONFLICT (id) DO UPDATE SET {actualizar} WHERE {cambia} RETURNING (xmax = 0) AS insertada) "
+        f"SELECT (SELECT count(*) FROM fuente), count(*) FILTER (WHERE insertada), "
+        f"count(*) FILTER (WHERE NOT insertada) FROM escritas"
+    )
+    filas, insertados, actualizados = cursor.fetchone()
+    cursor.execute(f"TRUNCATE {stg}")
+    return _conteos_upsert(filas, [(insertados, actualizados)])
+
+
+def copiar_registros(cursor, tabla: str, registros: List[BaseModel]) -> Dict[str, int]:
+    """COPY + UPSERT de modelos ya validados (ver _copiar_csv_a_tabla)."""
+    if not registros:
+        return dict.fromkeys(CONTEOS_UPSERT, 0)
+    columnas = COLUMNAS_POR_TABLA[tabla]
+    datos = io.StringIO()
+    # None -> campo vacío sin comillas, que COPY en CSV lee como NULL
+    csv.writer(datos).writerows(tuple(getattr(r, c) for c in columnas) for r in registros)
+    datos.seek(0)
+    return _copiar_csv_a_tabla(cursor, tabla, columnas, datos)
+
+
+def _restaurar_lote_python(conexion, tabla: str, filas: List[Dict[str, Any]], desplazamiento: int,
+                           staging: Optional[str] = None, conteos: Optional[Counter] = None) -> Tuple[int, List[Dict[str, Any]]]:
+    """Ruta previa (modelos Pydantic) para un bloque que Arrow no puede validar.
+
+    Con `staging`, las filas válidas van a esa tabla temporal (con su índice en `_fila`)
+    y las FKs se validan después, en bloque. Si no, los conteos del UPSERT se suman a `conteos`.
+    """
+    registros_modelo, errores_modelo = _parsear_registros_para_tabla(tabla, filas)
+    for err in errores_modelo:
+        err["indice"] += desplazamiento
+    descartados = {e["indice"] - desplazamiento for e in errores_modelo}
+    indices = [i for i in range(len(filas)) if i not in descartados]
+    if staging is not None:
+        columnas = COLUMNAS_POR_TABLA[tabla]
+        valores = [tuple(getattr(r, c) for c in columnas) + (indices[i] + desplazamiento,) for i, r in enumerate(registros_modelo)]
+        with conexion.cursor() as cursor:
+            pgextras.execute_values(cursor, f"INSERT INTO {staging} ({', '.join(columnas)}, _fila) VALUES %s", valores, page_size=1000)
+        return len(valores), errores_modelo
+    # validar_reglas_calidad indexa sobre los registros ya parseados: recuperar el índice del bloque
+    registros_validos, errores_calidad = validar_reglas_calidad(tabla, registros_modelo, conexion)
+    for err in errores_calidad:
+        err["indice"] = indices[err["indice"]] + desplazamiento
+    parcial = upsert_por_tabla(conexion, tabla, registros_validos, confirmar=False)
+    if conteos is not None:
+        conteos.update(parcial)
+    return sum(parcial.values()), errores_modelo + errores_calidad
+
+
+def restaurar_lotes_arrow(conexion, tabla: str, lotes: Iterable[Tuple[int, Any]], staging: Optional[str] = None) -> Dict[str, Any]:
+    """Restaura lotes Arrow: validación con pyarrow.compute y COPY.
+
+    `lotes` produce (desplazamiento, pyarrow.Table | lista de dicts), como los lectores de
+    lectura_respaldos; el desplazamiento es el índice en el archivo de la primera fila.
+    Los valores válidos van de los buffers Arrow a CSV (pyarrow.csv) y de ahí a COPY,
+    sin pasar por dicts ni modelos. Solo las filas inválidas se convierten a Python para
+    armar el detalle del rechazo (con el mismo formato que la ruta Pydantic). Un bloque
+    con columnas faltantes o valores que no se pueden convertir usa la ruta Pydantic.
+    Con `staging` las filas válidas se copian a esa tabla temporal, con su índice en el
+    archivo en `_fila`, sin validar FKs (ver reemplazar_tabla_arrow).
+    No hace commit: la llamada decide cuándo confirmar.
+    """
+    try:
+        import pyarrow as pa  # Lazy import
+        import pyarrow.compute as pc
+        import pyarrow.csv as pacsv
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Dependencia pyarrow no disponible: {e}")
+
+    columnas = COLUMNAS_POR_TABLA[tabla]
+    tipos = {c: pa.timestamp('us') if c == 'fecha_hora' else pa.string() if c in _RESTRICCIONES_TEXTO else pa.int64() for c in columnas}
+    opciones_csv = pacsv.WriteOptions(include_header=False)
+    modelo = TABLAS_VALIDAS[tabla]
+    recibidos = restaurados = 0
+    errores: List[Dict[str, Any]] = []
+    conteos = Counter(dict.fromkeys(CONTEOS_UPSERT, 0))
+
+    def _lotes_acotados():
+        # Row groups / rangos AVRO grandes se procesan en bloques de RESTAURAR_LOTE_ARROW_FILAS
+        for inicio, contenido in lotes:
+            if isinstance(contenido, list):
+                yield inicio, contenido
+                continue
+            for lote in contenido.to_batches(max_chunksize=_RESTAURAR_LOTE_ARROW):
+                yield inicio, lote
+                inicio += lote.num_rows
+
+    with conexion.cursor() as cursor:
+        for desplazamiento, lote in _lotes_acotados():
+            if isinstance(lote, list):
+                recibidos += len(lote)
+                cantidad, errores_lote = _restaurar_lote_python(conexion, tabla, lote, desplazamiento, staging, conteos)
+                restaurados += cantidad
+                errores.extend(errores_lote)
+                continue
+            recibidos += lote.num_rows
+            presentes = [c for c in columnas if c in lote.schema.names]
+            try:
+                if 'id' not in presentes or any(_RESTRICCIONES_TEXTO.get(c, (0, 0, False))[2] for c in columnas if c not in presentes):
+                    raise pa.ArrowInvalid("faltan columnas obligatorias")
+                datos = {
+                    c: lote.column(c).cast(tipos[c]) if c in presentes else pa.nulls(lote.num_rows, tipos[c])
+                    for c in columnas
+                }
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+                cantidad, errores_lote = _restaurar_lote_python(conexion, tabla, lote.to_pylist(), desplazamiento, staging, conteos)
+                restaurados += cantidad
+                errores.extend(errores_lote)
+                continue
+
+            # Esquema: id > 0, longitudes de texto, FKs nulas o > 0
+            valido = pc.fill_null(pc.greater(datos['id'], 0), False)
+            for c, (minimo, maximo, obligatorio) in _RESTRICCIONES_TEXTO.items():
+                if c in datos:
+                    largo = pc.utf8_length(datos[c])
+                    ok = pc.and_(pc.greater_equal(largo, minimo), pc.less_equal(largo, maximo))
+                    valido = pc.and_(valido, pc.fill_null(ok, not obligatorio))
+            for c, _, _ in _FKS_EMPLEADOS:
+                if c in datos:
+                    valido = pc.and_(valido, pc.fill_null(pc.greater(datos[c], 0), True))
+
+            if not pc.all(valido).as_py():
+                # Filas inválidas: detalle con el modelo, igual que la ruta Pydantic
+                invalidas = pc.indices_nonzero(pc.invert(valido))
+                filas = lote.take(invalidas).to_pylist()
+                cantidad, errores_lote = _restaurar_lote_python(conexion, tabla, filas, 0, staging, conteos)
+                for err in errores_lote:
+                    err["indice"] = desplazamiento + invalidas[err["indice"]].as_py()
+                restaurados += cantidad
+                errores.extend(errores_lote)
+
+            # Reglas de calidad: existencia de FKs, verificada sobre los valores únicos del bloque
+            if tabla == "empleados_contratados" and staging is None:
+                fk_validas = valido
+                for c, referida, codigo in _FKS_EMPLEADOS:
+                    candidatos = pc.unique(pc.drop_null(pc.filter(datos[c], valido))).to_pylist()
+                    ejecutar_preparada(cursor, f"fk_{referida}", (candidatos,))
+                    existentes = pa.array([f[0] for f in cursor.fetchall()], type=pa.int64())
+                    # is_in devuelve False (no null) para nulos: una FK nula es válida
+                    fk_ok = pc.or_(pc.is_null(datos[c]), pc.is_in(datos[c], value_set=existentes))
+                    # Como en validar_reglas_calidad: un error por cada FK inexistente
+                    fallan = pc.indices_nonzero(pc.and_(valido, pc.invert(fk_ok)))
+                    if len(fallan):
+                        filas = pa.table(datos).take(fallan).to_pylist()
+                        for i, fila in zip(fallan.to_pylist(), filas):
+                            errores.append({
+                                "indice": desplazamiento + i,
+                                "tabla": tabla,
+                                "codigo": codigo,
+                                "detalle": f"{c} {fila[c]} no existe",
+                                "registro": modelo(**fila).model_dump(mode="json"),
+                            })
+                    fk_validas = pc.and_(fk_validas, fk_ok)
+                valido = fk_validas
+
+            aceptadas = pa.table(datos).filter(valido)
+            if aceptadas.num_rows:
+                if staging is not None:
+                    filas_origen = pc.add(pc.indices_nonzero(valido).cast(pa.int64()), desplazamiento)
+                    aceptadas = aceptadas.append_column('_fila', filas_origen)
+                buffer = pa.BufferOutputStream()
+                pacsv.write_csv(aceptadas, buffer, write_options=opciones_csv)
+                if staging is not None:
+                    cursor.copy_expert(
+                        f"COPY {staging} ({', '.join(columnas)}, _fila) FROM STDIN WITH (FORMAT csv)",
+                        pa.BufferReader(buffer.getvalue()),
+                    )
+                    restaurados += aceptadas.num_rows
+                else:
+                    parcial = _copiar_csv_a_tabla(cursor, tabla, columnas, pa.BufferReader(buffer.getvalue()))
+                    conteos.update(parcial)
+                    restaurados += sum(parcial.values())
+
+    return {"restaurados": restaurados, "recibidos": recibidos, "errores": errores, "conteos": dict(conteos)}
+
+
+def restaurar_parquet_arrow(conexion, tabla: str, ruta_archivo: str, ordenado: bool = True, reemplazar: bool = False) -> Dict[str, Any]:
+    """Restaura un PARQUET mapeado en memoria, decodificando row groups en paralelo (hilos)."""
+    from lectura_respaldos import lotes_parquet
+
+    if not os.path.exists(ruta_archivo):
+        raise HTTPException(status_code=400, detail=f"Archivo no encontrado: {ruta_archivo}")
+    lotes = lotes_parquet(ruta_archivo, COLUMNAS_POR_TABLA[tabla], _RESTAURAR_HILOS, ordenado)
+    if reemplazar:
+        return reemplazar_tabla_arrow(conexion, tabla, lotes)
+    return restaurar_lotes_arrow(conexion, tabla, lotes)
+
+
+def restaurar_avro_arrow(conexion, tabla: str, ruta_archivo: str, ordenado: bool = True, reemplazar: bool = False) -> Dict[str, Any]:
+    """Restaura un AVRO dividido por bloques (sync marker) y decodificado en procesos."""
+    from lectura_respaldos import lotes_avro
+
+    if not os.path.exists(ruta_archivo):
+        raise HTTPException(status_code=400, detail=f"Archivo no encontrado: {ruta_archivo}")
+    lotes = lotes_avro(ruta_archivo, _RESTAURAR_PROCESOS_AVRO, ordenado, _AVRO_PARALELO_MIN_BYTES)
+    if reemplazar:
+        return reemplazar_tabla_arrow(conexion, tabla, lotes)
+    return restaurar_lotes_arrow(conexion, tabla, lotes)
+
+
+def _referencias_a_tabla(cursor, tabla: str) -> List[Tuple[str, str]]:
+    """(tabla, columna) de cada FK de otra tabla que apunta a `tabla`."""
+    cursor.execute(
+        """
+        SELECT c.conrelid::regclass::text, a.attname
+        FROM pg_constraint c
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+        WHERE c.contype = 'f' AND c.confrelid = %s::regclass AND c.conrelid <> c.confrelid
+        """,
+        (tabla,),
+    )
+    return cursor.fetchall()
+
 
-    if tabla not in TABLAS_VALIDAS:
-        raise HTTPException(status_code=400, detail="'tabla' debe ser una tabla válida")
+def _triggers_version_filas(cursor, tablas: Iterable[str], habilitar: bool) -> None:
+    """Deshabilita (o vuelve a habilitar) los triggers de versión con tabla de transición.
 
-    info = _listar_respaldos_por_tabla(tabla, directorio, solo_hoy=bool(solo_hoy))
-    if not info["existen"]:
-        raise HTTPException(status_code=400, detail=f"No hay respaldos {'de hoy ' if solo_hoy else ''}.avro o .parquet para '{tabla}' en '{directorio}'")
+    Solo después de un TRUNCATE de esas tablas en la misma transacción: su trigger ya
+    incrementó la versión, y la recarga en bloque no necesita copiar cada fila a la tabla
+    de transición para saber si cambió algo. Es DDL transaccional: un rollback lo revierte.
+    """
+    accion = "ENABLE" if habilitar else "DISABLE"
+    for tabla in tablas:
+        cursor.execute(
+            f"ALTER TABLE {tabla} "
+            + ", ".join(f"{accion} TRIGGER trg_version_{tabla}_{evento}" for evento in ("insert", "update", "delete"))
+        )
 
-    # Borrado seguro de datos de la tabla
-    conexion = obtener_conexion_db()
-    try:
-        borrados = 0
-        with conexion.cursor() as cursor:
-            cursor.execute(f"DELETE FROM {tabla}")
-            borrados = cursor.rowcount if cursor.rowcount is not None else 0
-        conexion.commit()
-        return {
-            "tabla": tabla,
-            "borrados": borrados,
-            "respaldos": info,
-        }
-    except Exception as e:
-        conexion.rollback()
-        raise HTTPException(status_code=500, detail=f"Error al borrar datos de '{tabla}': {e}")
-    finally:
-        conexion.close()
 
+def reemplazar_tabla_arrow(conexion, tabla: str, lotes: Iterable[Tuple[int, Any]]) -> Dict[str, Any]:
+    """Reemplaza todo el contenido de `tabla` por los lotes (modo "reemplazar"). No hace commit.
 
-@app.post("/restaurar")
-def restaurar(payload: Dict[str, Any] = Body(..., description="Restaura una tabla desde archivo AVRO/PARQUET")):
+    Las filas válidas se copian con COPY a un staging temporal, donde las FKs se validan
+    con un anti-join por FK y los ids repetidos se resuelven (gana la última fila). Luego:
+    - tabla sin FKs que la referencien: TRUNCATE, se quitan PK/FKs/índices, INSERT ...
+      SELECT y se vuelven a crear (índices armados de una vez, FKs validadas en bloque);
+    - tabla referenciada: si alguna fila que la referencia quedaría huérfana se cancela
+      con 409; si no, se borran los ids ausentes y solo se escriben las filas que cambian.
     """
-    Payload esperado:
-    {
-      "formato": "avro" | "parquet",
-      "tabla": "departamentos" | "trabajos" | "empleados_contratados",
-      "archivo": "ruta/al/archivo.avro|parquet"
+    from psycopg2.extensions import quote_ident
+
+    columnas = COLUMNAS_POR_TABLA[tabla]
+    lista = ", ".join(columnas)
+    stg = f"_rep_{tabla}"
+    with conexion.cursor() as cursor:
+        cursor.execute(f"CREATE TEMP TABLE {stg} (LIKE {tabla} INCLUDING DEFAULTS, _fila BIGINT NOT NULL) ON COMMIT DROP")
+    resultado = restaurar_lotes_arrow(conexion, tabla, lotes, staging=stg)
+    errores = resultado["errores"]
+    modelo = TABLAS_VALIDAS[tabla]
+
+    with conexion.cursor() as cursor:
+        # Las tablas temporales no tienen estadísticas: sin ANALYZE los anti-joins se planifican mal
+        cursor.execute(f"ANALYZE {stg}")
+        if tabla == "empleados_contratados":
+            # Como en validar_reglas_calidad: un error por cada FK inexistente
+            for c, referida, codigo in _FKS_EMPLEADOS:
+                cursor.execute(
+                    f"SELECT _fila, {lista} FROM {stg} s WHERE s.{c} IS NOT NULL "
+                    f"AND NOT EXISTS (SELECT 1 FROM {referida} r WHERE r.id = s.{c}) ORDER BY _fila"
+                )
+                for fila in cursor.fetchall():
+                    registro = dict(zip(columnas, fila[1:]))
+                    errores.append({
+                        "indice": fila[0],
+                        "tabla": tabla,
+                        "codigo": codigo,
+                        "detalle": f"{c} {registro[c]} no existe",
+                        "registro": modelo(**registro).model_dump(mode="json"),
+                    })
+            cursor.execute(
+                f"DELETE FROM {stg} s WHERE "
+                + " OR ".join(
+                    f"(s.{c} IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {referida} r WHERE r.id = s.{c}))"
+                    for c, referida, _ in _FKS_EMPLEADOS
+                )
+            )
+
+        referencias = _referencias_a_tabla(cursor, tabla)
+        if referencias:
+            for referente, columna in referencias:
+                cursor.execute(
+                    f"SELECT DISTINCT r.{columna} FROM {referente} r WHERE r.{columna} IS NOT NULL "
+                    f"AND NOT EXISTS (SELECT 1 FROM {stg} s WHERE s.id = r.{columna}) LIMIT 10"
+                )
+                huerfanos = [f[0] for f in cursor.fetchall()]
+                if huerfanos:
+                    raise HTTPException(
+                        status_code=409,
+                        detail=f"Reemplazar '{tabla}' dejaría filas de '{referente}' sin referencia ({columna} en {huerfanos})",
+                    )
+            cursor.execute(f"DELETE FROM {tabla} t WHERE NOT EXISTS (SELECT 1 FROM {stg} s WHERE s.id = t.id)")
+            eliminados = cursor.rowcount
+            actualizar = ", ".join(f"{c} = EXCLUDED.{c}" for c in columnas if c != 'id')
+            cambia = " OR ".join(f"{tabla}.{c} IS DISTINCT FROM EXCLUDED.{c}" for c in columnas if c != 'id')
+            cursor.execute(
+                f"INSERT INTO {tabla} ({lista}) "
+                f"SELECT DISTINCT ON (id) {lista} FROM {stg} ORDER BY id, _fila DESC "
+                f"ON CONFLICT (id) DO UPDATE SET {actualizar} WHERE {cambia}"
+            )
+            escritos = cursor.rowcount
+            cursor.execute(f"SELECT count(*) FROM {tabla}")
+            restaurados = cursor.fetchone()[0]
+            estrategia = "sincronizar"
+        else:
+            cursor.execute(f"LOCK TABLE {tabla} IN ACCESS EXCLUSIVE MODE")
+            # Contenido idéntico (ids únicos en ambos lados): no se reescribe, así la
+            # versión de datos no cambia y los respaldos/el cubo siguen al día
+            cursor.execute(f"SELECT count(*) FROM {tabla}")
+            actuales = cursor.fetchone()[0]
+            cursor.execute(
+                f"SELECT (SELECT count(DISTINCT id) FROM {stg}) = %s "
+                f"AND NOT EXISTS (SELECT {lista} FROM {tabla} EXCEPT ALL "
+                f"SELECT * FROM (SELECT DISTINCT ON (id) {lista} FROM {stg} ORDER BY id, _fila DESC) f)",
+                (actuales,),
+            )
+            if cursor.fetchone()[0]:
+                restaurados = actuales
+                eliminados = escritos = 0
+                estrategia = "sin_cambios"
+            else:
+                # PK/UNIQUE primero al recrear; las FKs al final
+                cursor.execute(
+                    "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                    "WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f') ORDER BY contype = 'f', conname",
+                    (tabla,),
+                )
+                restricciones = cursor.fetchall()
+                cursor.execute(
+                    "SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index i "
+                    "WHERE indrelid = %s::regclass AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)",
+                    (tabla,),
+                )
+                indices = cursor.fetchall()
+                cursor.execute(f"TRUNCATE {tabla}")
+                _triggers_version_filas(cursor, [tabla], habilitar=False)
+                for nombre, _ in reversed(restricciones):
+                    cursor.execute(f"ALTER TABLE {tabla} DROP CONSTRAINT {quote_ident(nombre, cursor)}")
+                for nombre, _ in indices:
+                    cursor.execute(f"DROP INDEX {nombre}")
+                # Orden por id: la PK se arma sobre datos ya ordenados
+                cursor.execute(f"INSERT INTO {tabla} ({lista}) SELECT DISTINCT ON (id) {lista} FROM {stg} ORDER BY id, _fila DESC")
+                restaurados = cursor.rowcount
+                for nombre, definicion in restricciones:
+                    cursor.execute(f"ALTER TABLE {tabla} ADD CONSTRAINT {quote_ident(nombre, cursor)} {definicion}")
+                for _, definicion in indices:
+                    cursor.execute(definicion)
+                _triggers_version_filas(cursor, [tabla], habilitar=True)
+                eliminados = escritos = None
+                estrategia = "truncate"
+
+    return {
+        "restaurados": restaurados,
+        "recibidos": resultado["recibidos"],
+        "errores": errores,
+        "estrategia": estrategia,
+        "eliminados": eliminados,
+        "escritos": escritos,
     }
-    """
+
+
+def restaurar_tabla(trabajo: TrabajoCancelable, payload: Dict[str, Any]) -> Response:
+    """Valida el payload de /restaurar y restaura la tabla en una transacción de `trabajo`."""
     formato = payload.get('formato')
     tabla = payload.get('tabla')
     archivo = payload.get('archivo')
+    motor = payload.get('motor') or 'arrow'
+    ordenado = payload.get('ordenado', True)
+    modo = payload.get('modo') or 'upsert'
+    validacion_fk = payload.get('validacion_fk') or 'auto'
 
     if formato not in {"avro", "parquet"}:
         raise HTTPException(status_code=400, detail="'formato' debe ser 'avro' o 'parquet'")
@@ -654,9 +3218,56 @@ def restaurar(payload: Dict[str, Any] = Body(..., description="Restaura una tabl
         raise HTTPException(status_code=400, detail="'tabla' debe ser una tabla válida")
     if not isinstance(archivo, str) or not archivo:
         raise HTTPException(status_code=400, detail="'archivo' debe ser una cadena no vacía")
+    if motor not in {"arrow", "python"}:
+        raise HTTPException(status_code=400, detail="'motor' debe ser 'arrow' o 'python'")
+    if not isinstance(ordenado, bool):
+        raise HTTPException(status_code=400, detail="'ordenado' debe ser booleano")
+    if modo not in {"upsert", "reemplazar"}:
+        raise HTTPException(status_code=400, detail="'modo' debe ser 'upsert' o 'reemplazar'")
+    if modo == 'reemplazar' and motor != 'arrow':
+        raise HTTPException(status_code=400, detail="'modo' 'reemplazar' requiere 'motor' 'arrow'")
+    if validacion_fk not in ESTRATEGIAS_FK:
+        raise HTTPException(status_code=400, detail="'validacion_fk' debe ser 'auto', 'python' o 'sql'")
 
     # Medir duración total
     _ts_ini = datetime.now()
+    if motor == 'arrow':
+        conexion = obtener_conexion_db()
+        try:
+            trabajo.usar(conexion)
+            if formato == 'parquet':
+                resultado = restaurar_parquet_arrow(conexion, tabla, archivo, ordenado, modo == 'reemplazar')
+            else:
+                resultado = restaurar_avro_arrow(conexion, tabla, archivo, ordenado, modo == 'reemplazar')
+            marca = marcar_cambios(conexion)
+            conexion.commit()
+            # Las filas restauradas no van al registro de cambios: no se puede reproducir a través de esto
+            registrar_cambios(marca, [(tabla, OPERACION_BARRERA, [])])
+        except HTTPException:
+            conexion.rollback()
+            raise
+        except Exception as e:
+            conexion.rollback()
+            raise HTTPException(status_code=500, detail=f"Error restaurando {formato.upper()} con Arrow: {e}")
+        finally:
+            trabajo.soltar()
+            liberar_conexion_db(conexion)
+        errores = resultado["errores"]
+        respuesta = {
+            "tabla": tabla,
+            "modo": modo,
+            "restaurados": resultado["restaurados"],
+            "recibidos": resultado["recibidos"],
+            "validos": resultado["recibidos"] - len({e["indice"] for e in errores}),
+            "rechazados": registrar_rechazados(errores),
+            "duracion_ms": int((datetime.now() - _ts_ini).total_seconds() * 1000),
+        }
+        if modo == 'reemplazar':
+            respuesta.update({k: resultado[k] for k in ("estrategia", "eliminados", "escritos")})
+        else:
+            respuesta.update(resultado["conteos"])
+        return respuesta_json(respuesta)
+
     # Leer registros del archivo
     if formato == 'avro':
         registros = leer_avro_archivo(archivo)
@@ -666,33 +3277,226 @@ def restaurar(payload: Dict[str, Any] = Body(..., description="Restaura una tabl
     # Convertir tipos con modelos locales y aplicar reglas de calidad
     conexion = obtener_conexion_db()
     try:
+        trabajo.usar(conexion)
         # Paso 1: Parsear a modelos Pydantic locales según TABLAS_VALIDAS
         registros_modelo, errores_modelo = _parsear_registros_para_tabla(tabla, registros)
 
         # Paso 2: Aplicar reglas de calidad (FKs para empleados)
-        registros_validos, errores_calidad = validar_reglas_calidad(tabla, registros_modelo, conexion)
+        registros_validos, errores_calidad = validar_reglas_calidad(tabla, registros_modelo, conexion, validacion_fk)
 
         # Paso 3: UPSERT por tabla
-        cantidad = 0
-        if tabla == "departamentos":
-            cantidad = upsert_departamentos(conexion, registros_validos)  # type: ignore[arg-type]
-        elif tabla == "trabajos":
-            cantidad = upsert_trabajos(conexion, registros_validos)  # type: ignore[arg-type]
-        elif tabla == "empleados_contratados":
-            cantidad = upsert_empleados(conexion, registros_validos)  # type: ignore[arg-type]
+        conteos = upsert_por_tabla(conexion, tabla, registros_validos, confirmar=False)
+        marca = marcar_cambios(conexion)
+        conexion.commit()
+        registrar_cambios(marca, [(tabla, OPERACION_BARRERA, [])])
 
         _dur_ms = int((datetime.now() - _ts_ini).total_seconds() * 1000)
-        return {
+        return respuesta_json({
             "tabla": tabla,
-            "restaurados": cantidad,
+            "restaurados": sum(conteos.values()),
+            **conteos,
             "recibidos": len(registros),
             "validos": len(registros_validos),
-            "errores_modelo": errores_modelo,
-            "errores_calidad": errores_calidad,
+            "rechazados": registrar_rechazados(errores_modelo + errores_calidad),
             "duracion_ms": _dur_ms,
-        }
+        })
     finally:
-        conexion.close()
+        trabajo.soltar()
+        liberar_conexion_db(conexion)
+
+
+@app.post("/restaurar")
+async def restaurar(request: Request, payload: Dict[str, Any] = Body(..., description="Restaura una tabla desde archivo AVRO/PARQUET")):
+    """
+    Payload esperado:
+    {
+      "formato": "avro" | "parquet",
+      "tabla": "departamentos" | "trabajos" | "empleados_contratados",
+      "archivo": "ruta/al/archivo.avro|parquet",
+      "motor": "arrow" | "python",   # opcional (por defecto "arrow")
+      "ordenado": true | false,      # opcional (por defecto true), solo motor "arrow"
+      "modo": "upsert" | "reemplazar",  # opcional (por defecto "upsert"), "reemplazar" solo motor "arrow"
+      "validacion_fk": "auto" | "python" | "sql"  # opcional (por defecto "auto"), solo motor "python"
+    }
+
+    Con motor "arrow" el archivo se lee en paralelo (row groups PARQUET en hilos sobre
+    el archivo mapeado en memoria; rangos de bloques AVRO en procesos) y se valida y
+    copia a la base por lotes Arrow, sin convertir cada fila en dict/modelo. Con
+    "ordenado": false los lotes se escriben a medida que se decodifican (más rápido;
+    solo si el archivo no repite ids, como los respaldos generados por /respaldos).
+    "python" usa la ruta con modelos Pydantic; "validacion_fk" elige cómo se validan las
+    FKs de empleados (ver validar_reglas_calidad).
+
+    "modo": "reemplazar" deja la tabla con exactamente el contenido del archivo (borra
+    las filas que no están en él) con carga masiva en lugar de UPSERT fila a fila; ver
+    reemplazar_tabla_arrow.
+
+    Las sentencias de la restauración tienen un límite de STATEMENT_TIMEOUT_RESTAURAR_MS
+    (504 si se supera). Si el cliente se desconecta, la consulta en curso se cancela y
+    la transacción se revierte sin escribir nada.
+    """
+    return await ejecutar_cancelable(request, "restaurar", restaurar_tabla, payload)
+
+
+def reproducir_cambios(conexion, tabla: str, entradas) -> Dict[str, int]:
+    """Aplica a `tabla` entradas del registro de cambios (pyarrow.Table ordenada por secuencia).
+
+    Los upserts entre dos vaciados se envían juntos (COPY + UPSERT, gana la última
+    versión de cada id); cada vaciado se aplica en su lugar de la secuencia. No hace commit.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+
+    columnas = COLUMNAS_POR_TABLA[tabla]
+    opciones_csv = pacsv.WriteOptions(include_header=False)
+    operaciones = entradas.column('_operacion')
+    secuencias = entradas.column('_secuencia')
+    vaciados = pc.filter(secuencias, pc.equal(operaciones, OPERACION_VACIAR)).to_pylist()
+    upserts = pc.equal(operaciones, OPERACION_UPSERT)
+    aplicados = {"upserts": 0, "vaciados": 0}
+    desde = None
+    with conexion.cursor() as cursor:
+        for hasta in vaciados + [None]:
+            mascara = upserts
+            if desde is not None:
+                mascara = pc.and_(mascara, pc.greater(secuencias, desde))
+            if hasta is not None:
+                mascara = pc.and_(mascara, pc.less(secuencias, hasta))
+            for lote in entradas.filter(mascara).select(list(columnas)).to_batches(max_chunksize=_RESTAURAR_LOTE_ARROW):
+                buffer = pa.BufferOutputStream()
+                pacsv.write_csv(lote, buffer, write_options=opciones_csv)
+                _copiar_csv_a_tabla(cursor, tabla, columnas, pa.BufferReader(buffer.getvalue()))
+                aplicados["upserts"] += lote.num_rows
+            if hasta is not None:
+                cursor.execute(f"DELETE FROM {tabla}")
+                aplicados["vaciados"] += 1
+            desde = hasta
+    return aplicados
+
+
+def _respaldo_base(tabla: str, directorio: str, hasta: datetime) -> Optional[Dict[str, Any]]:
+    """Verificación del respaldo válido más reciente de `tabla` tomado hasta `hasta`.
+
+    Solo sirven respaldos cuyo manifiesto registra la instantánea de la exportación.
+    """
+    from lectura_respaldos import leer_manifiesto
+
+    candidatos = []
+    for info in _listar_respaldos_por_tabla(tabla, directorio)["archivos"]:
+        manifiesto = leer_manifiesto(info["ruta"]) if info["manifiesto"] else None
+        if not manifiesto or not manifiesto.get("instantanea") or not manifiesto.get("instante"):
+            continue
+        instante = datetime.fromisoformat(manifiesto["instante"])
+        if instante <= hasta:
+            candidatos.append((instante, info))
+    candidatos.sort(key=lambda c: c[0], reverse=True)
+    verificado, _ = _ultimo_respaldo_valido([info for _, info in candidatos])
+    return verificado
+
+
+@app.post("/restaurar/punto_en_el_tiempo")
+def restaurar_punto_en_el_tiempo(payload: Dict[str, Any] = Body(..., description="Restaura tablas al estado de un instante")):
+    """
+    Payload esperado:
+    {
+      "instante": "2024-05-01T12:00:00+00:00",  # ISO-8601; sin zona, hora local del servidor
+      "tablas": ["departamentos", "trabajos", "empleados_contratados"],  # opcional, por defecto todas
+      "directorio": "respaldos"  # opcional
+    }
+
+    Por tabla (en orden de dependencias) se vacía la tabla, se carga con COPY el respaldo
+    válido más reciente tomado hasta el instante y se reproduce el registro de cambios
+    hasta el instante. Todo ocurre en una transacción: si algo falla, nada cambia.
+    """
+    from registro_cambios import leer_cambios, marcas_huerfanas
+
+    instante = payload.get('instante')
+    directorio = payload.get('directorio') or 'respaldos'
+    tablas = payload.get('tablas')
+    if not REGISTRO_CAMBIOS_DIR:
+        raise HTTPException(status_code=400, detail="El registro de cambios está desactivado (REGISTRO_CAMBIOS_DIR)")
+    try:
+        hasta = datetime.fromisoformat(instante).astimezone()
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="'instante' debe ser una fecha/hora ISO-8601")
+    if tablas is None:
+        tablas = list(ORDEN_DEPENDENCIAS)
+    if not isinstance(tablas, list) or not tablas or any(t not in TABLAS_VALIDAS for t in tablas):
+        raise HTTPException(status_code=400, detail="'tablas' debe ser una lista no vacía de tablas válidas")
+    tablas = [t for t in ORDEN_DEPENDENCIAS if t in tablas]
+
+    _ts_ini = datetime.now()
+    # Lo encolado por este proceso tiene que estar en disco antes de leer los segmentos
+    _escritor_cambios.vaciar()
+    incompleto = [(ruta, desde) for ruta, desde in marcas_huerfanas(REGISTRO_CAMBIOS_DIR) if desde <= hasta]
+    if incompleto:
+        ruta, desde = min(incompleto, key=lambda m: m[1])
+        raise HTTPException(
+            status_code=409,
+            detail=(
+                f"El registro de cambios puede estar incompleto desde {desde.isoformat()}: un proceso terminó "
+                f"con transacciones confirmadas sin escribir en el registro ({ruta}). Restaure a un instante "
+                f"anterior; para aceptar la pérdida, borre la marca."
+            ),
+        )
+    planes: Dict[str, Tuple[Dict[str, Any], Any, int, int]] = {}
+    for tabla in tablas:
+        base = _respaldo_base(tabla, directorio, hasta)
+        if base is None:
+            raise HTTPException(status_code=409, detail=f"No hay un respaldo válido de '{tabla}' con manifiesto tomado hasta {hasta.isoformat()}")
+        entradas, leidos, total = leer_cambios(REGISTRO_CAMBIOS_DIR, tabla, hasta, base["manifiesto"]["instantanea"])
+        if entradas is not None and OPERACION_BARRERA in entradas.column('_operacion').to_pylist():
+            raise HTTPException(
+                status_code=409,
+                detail=f"'{tabla}' se restauró, cargó o importó (modelos.py) después del respaldo {base['ruta']}; esas filas no están en el registro de cambios. Use un respaldo posterior.",
+            )
+        planes[tabla] = (base, entradas, leidos, total)
+
+    conexion = obtener_conexion_db()
+    resultado: Dict[str, Any] = {}
+    errores: List[Dict[str, Any]] = []
+    try:
+        with conexion.cursor() as cursor:
+            try:
+                cursor.execute(f"TRUNCATE {', '.join(tablas)}")
+            except psycopg2.errors.FeatureNotSupported as e:
+                raise HTTPException(status_code=409, detail=f"Incluya también las tablas que referencian a las restauradas: {e}")
+            _triggers_version_filas(cursor, tablas, habilitar=False)
+        for tabla in tablas:
+            base, entradas, leidos, total = planes[tabla]
+            if base["ruta"].endswith('.parquet'):
+                cargado = restaurar_parquet_arrow(conexion, tabla, base["ruta"])
+            else:
+                cargado = restaurar_avro_arrow(conexion, tabla, base["ruta"])
+            errores.extend(cargado["errores"])
+            aplicados = reproducir_cambios(conexion, tabla, entradas) if entradas is not None else {"upserts": 0, "vaciados": 0}
+            resultado[tabla] = {
+                "respaldo": base["ruta"],
+                "respaldo_instante": base["manifiesto"]["instante"],
+                "restaurados": cargado["restaurados"],
+                "cambios": aplicados,
+                "segmentos_leidos": leidos,
+                "segmentos_totales": total,
+            }
+        with conexion.cursor() as cursor:
+            _triggers_version_filas(cursor, tablas, habilitar=True)
+        marca = marcar_cambios(conexion)
+        conexion.commit()
+        registrar_cambios(marca, [(tabla, OPERACION_BARRERA, []) for tabla in tablas])
+    except BaseException:
+        conexion.rollback()
+        raise
+    finally:
+        liberar_conexion_db(conexion)
+
+    return respuesta_json({
+        "instante": hasta.isoformat(),
+        "tablas": resultado,
+        "rechazados": registrar_rechazados(errores),
+        "duracion_ms": int((datetime.now() - _ts_ini).total_seconds() * 1000),
+    })
+
 
 def _parsear_registros_para_tabla(tabla: str, datos: List[Dict[str, Any]]) -> Tuple[List[BaseModel], List[Dict[str, Any]]]:
     """Convierte dicts a modelos Pydantic de la tabla dada. Retorna (validos, errores)."""
@@ -708,13 +3512,28 @@ def _parsear_registros_para_tabla(tabla: str, datos: List[Dict[str, Any]]) -> Tu
             errores.append({
                 "indice": idx,
                 "tabla": tabla,
-                "detalle": ve.errors(),
+                "codigo": CODIGO_ESQUEMA_INVALIDO,
+                "detalle": ve.errors(include_url=False),
+                "registro": item,
             })
     return registros_validos, errores
 
 
+def _referir_errores_calidad(total: int, errores_modelo: List[Dict[str, Any]], errores_calidad: List[Dict[str, Any]]) -> None:
+    """validar_reglas_calidad indexa sobre los registros que pasaron el modelo: lleva el
+    `indice` de sus errores a la posición en los `total` datos recibidos, como errores_modelo."""
+    descartados = {e["indice"] for e in errores_modelo}
+    posiciones = [i for i in range(total) if i not in descartados]
+    for err in errores_calidad:
+        err["indice"] = posiciones[err["indice"]]
+
+
 @app.post("/transacciones")
-def recibir_transacciones(payload: Dict[str, Any] = Body(..., description="Carga de registros por tabla")):
+def recibir_transacciones(
+    payload: Dict[str, Any] = Body(..., description="Carga de registros por tabla"),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key", max_length=255),
+    diferido: bool = False,
+):
     """Endpoint único para recibir registros de cualquier tabla.
 
     Formatos soportados de payload:
@@ -736,6 +3555,15 @@ def recibir_transacciones(payload: Dict[str, Any] = Body(..., description="Carga
     - Soporta lotes entre 1 y 1000 registros por grupo.
     - Valida contra el diccionario de datos antes de aceptar.
     - Aplica reglas de calidad específicas por tabla.
+    - Los grupos se escriben en orden de dependencias (departamentos, trabajos,
+      empleados) dentro de una única transacción: la validación de FKs de empleados
+      ve los departamentos/trabajos del mismo payload y un fallo no deja estado parcial.
+    - Con cabecera `Idempotency-Key` (o IDEMPOTENCIA_POR_CONTENIDO=true), un reintento
+      del mismo lote devuelve la respuesta registrada sin volver a procesarlo.
+    - Con `?diferido=true` (requiere ESCRITURA_DIFERIDA_DIR) los registros válidos van a
+      la bitácora local y se responde 202 en cuanto están en disco; un hilo los aplica
+      luego junto con los de otras solicitudes (ver EscritorDiferido). Las FKs también
+      se satisfacen con ids aún en la bitácora de este proceso.
     """
     grupos: Dict[str, List[Dict[str, Any]]] = {}
 
@@ -743,6 +3571,8 @@ def recibir_transacciones(payload: Dict[str, Any] = Body(..., description="Carga
     if "tabla" in payload and "registros" in payload:
         tabla = payload["tabla"]
         registros = payload["registros"]
+        if tabla not in TABLAS_VALIDAS:
+            raise HTTPException(status_code=400, detail=f"Tabla no soportada: {tabla}")
         if not isinstance(registros, list):
             raise HTTPException(status_code=400, detail="'registros' debe ser una lista")
         grupos[tabla] = registros
@@ -757,6 +3587,8 @@ def recibir_transacciones(payload: Dict[str, Any] = Body(..., description="Carga
 
     if not grupos:
         raise HTTPException(status_code=400, detail="Payload vacío o sin claves de tablas válidas")
+    if diferido and not ESCRITURA_DIFERIDA_DIR:
+        raise HTTPException(status_code=400, detail="Escritura diferida desactivada (ESCRITURA_DIFERIDA_DIR)")
 
     # Validación de tamaños de lote
     for tabla, registros in grupos.items():
@@ -764,38 +3596,422 @@ def recibir_transacciones(payload: Dict[str, Any] = Body(..., description="Carga
         if n < 1 or n > 1000:
             raise HTTPException(status_code=400, detail=f"El grupo '{tabla}' debe contener entre 1 y 1000 registros")
 
+    cupo = 0
+    if diferido:
+        # Con lugar en la cola de la bitácora apartado antes de tomar la conexión, agregar()
+        # no espera con ella tomada (ver EscritorDiferido.reservar_cupo)
+        cupo = sum(len(registros) for registros in grupos.values())
+        if not _escritor_diferido.reservar_cupo(cupo):
+            raise HTTPException(status_code=503, detail="Escritura diferida saturada, intente más tarde",
+                                headers={"Retry-After": "1"})
+    try:
+        conexion = obtener_conexion_db()
+
+        clave = idempotency_key
+        huella = None
+        if clave or _IDEMPOTENCIA_POR_CONTENIDO:
+            huella = huella_payload(payload)
+            clave = clave or f"sha256:{huella}"
+            try:
+                previa = reservar_idempotencia(conexion, clave, huella)
+            except BaseException:
+                liberar_conexion_db(conexion)
+                raise
+            if previa is not None:
+                liberar_conexion_db(conexion)
+                return respuesta_json(previa, headers={"Idempotent-Replayed": "true"})
+
+        def escribir_grupos():
+            # Se repite completo si la transacción se aborta por un conflicto con otra (con_reintentos)
+            procesados: Dict[str, Any] = {}
+            errores: List[Dict[str, Any]] = []
+            cambios: List[Tuple[str, str, List[BaseModel]]] = []
+            diferidos: Dict[str, List[Dict[str, Any]]] = {}
+            posiciones: Dict[str, List[int]] = {}
+            for tabla in ORDEN_DEPENDENCIAS:
+                if tabla not in grupos:
+                    continue
+                datos = grupos[tabla]
+                # Paso 1: Validación contra el diccionario de datos
+                registros_modelo, errores_modelo = _parsear_registros_para_tabla(tabla, datos)
+                errores.extend(errores_modelo)
+
+                # Paso 2: Reglas de calidad por tabla (ve lo escrito antes en esta transacción)
+                registros_validos, errores_calidad = validar_reglas_calidad(tabla, registros_modelo, conexion)
+                if diferido and errores_calidad:
+                    # Los grupos anteriores del payload no están en la base sino en `diferidos`
+                    locales = {t: {r["id"] for r in filas} for t, filas in diferidos.items()}
+                    registros_validos, errores_calidad = _resolver_fks_diferidas(registros_modelo, errores_calidad, locales)
+                _referir_errores_calidad(len(datos), errores_modelo, errores_calidad)
+                errores.extend(errores_calidad)
+
+                if diferido:
+                    diferidos[tabla] = [r.model_dump(mode="json") for r in registros_validos]
+                    rechazados = {e["indice"] for e in errores_modelo + errores_calidad}
+                    posiciones[tabla] = [i for i in range(len(datos)) if i not in rechazados]
+                    procesados[tabla] = {"recibidos": len(datos), "validos": len(registros_validos)}
+                    continue
+
+                # Un id aún en la bitácora diferida se aplicaría después y pisaría esta escritura
+                pendientes = [r.id for r in registros_validos if _escritor_diferido.en_bufer(tabla, r.id)]
+                if pendientes:
+                    raise HTTPException(status_code=409, detail={
+                        "mensaje": f"Hay escrituras diferidas de '{tabla}' sin aplicar para estos ids; reintente cuando se apliquen",
+                        "tabla": tabla,
+                        "ids": pendientes[:20],
+                    })
+
+                # Paso 3: Inserción/actualización (UPSERT) sin confirmar todavía
+                conteos = upsert_por_tabla(conexion, tabla, registros_validos, confirmar=False)
+                cambios.append((tabla, OPERACION_UPSERT, registros_validos))
+
+                procesados[tabla] = {
+                    "recibidos": len(datos),
+                    "validos": len(registros_validos),
+                    "upsert": sum(conteos.values()),
+                    **conteos,
+                }
+            return procesados, errores, cambios, diferidos, posiciones
+
+        try:
+            procesados, errores, cambios, diferidos, posiciones = con_reintentos(conexion, escribir_grupos)
+            resumen: Dict[str, Any] = {"procesados": procesados}
+            # Solo conteos y referencia: el detalle va al dead-letter tras el commit (si falla
+            # algo antes, el reintento del cliente no debe dejar una segunda copia)
+            resumen["rechazados"] = resumen_rechazados(errores)
+            diferidos = {t: filas for t, filas in diferidos.items() if filas}
+            if diferidos:
+                # Lo que falle al aplicarse se agrega a este mismo lote, con su índice en el payload
+                lote_id = resumen["rechazados"]["lote_id"] or str(uuid.uuid4())
+                resumen["rechazados"]["lote_id"] = lote_id
+                procedencia = {"lote_id": lote_id, "indices": {t: posiciones[t] for t in diferidos}}
+                # Vuelve cuando la línea está sincronizada a disco
+                resumen["secuencia"] = _escritor_diferido.bitacora().agregar(diferidos, procedencia)
+            if huella is not None:
+                # El resultado queda registrado si y solo si los datos se confirman
+                completar_idempotencia(conexion, clave, resumen)
+            marca = None if diferido else marcar_cambios(conexion)
+            conexion.commit()
+            registrar_cambios(marca, cambios)
+            if errores:
+                encolar_rechazados(errores, resumen["rechazados"]["lote_id"])
+            return respuesta_json(resumen, status_code=202 if diferido else 200)
+        except BaseException:
+            conexion.rollback()
+            if huella is not None:
+                liberar_idempotencia(clave)
+            raise
+        finally:
+            liberar_conexion_db(conexion)
+    finally:
+        if cupo:
+            _escritor_diferido.liberar_cupo(cupo)
+
+
+@app.get("/rechazados/{lote_id}")
+def listar_rechazados(lote_id: str, limite: int = 100, desde_id: int = 0):
+    """Consulta paginada de los registros rechazados de un lote (motivo y registro original)."""
+    if limite < 1 or limite > 1000:
+        raise HTTPException(status_code=400, detail="'limite' debe estar entre 1 y 1000")
+    _escritor_rechazados.vaciar()
     conexion = obtener_conexion_db()
+    try:
+        with conexion.cursor(cursor_factory=pgextras.RealDictCursor) as cur:
+            cur.execute(
+                "SELECT id, tabla, indice, codigo, detalle, registro, reprocesado "
+                "FROM registros_rechazados WHERE lote_id = %s AND id > %s ORDER BY id LIMIT %s",
+                (lote_id, desde_id, limite),
+            )
+            filas = [dict(f) for f in cur.fetchall()]
+        return {
+            "lote_id": lote_id,
+            "rechazados": filas,
+            "siguiente_desde_id": filas[-1]["id"] if len(filas) == limite else None,
+        }
+    finally:
+        liberar_conexion_db(conexion)
 
-    resumen: Dict[str, Any] = {"procesados": {}, "errores": []}
 
+@app.post("/rechazados/reprocesar")
+def reprocesar_rechazados(payload: Dict[str, Any] = Body(..., description="Reingresa en bloque los rechazados de un lote")):
+    """
+    Payload esperado:
+    {
+      "lote_id": "uuid del lote devuelto en 'rechazados'",
+      "correcciones": { "<id rechazado>": { ...registro corregido... } }  # opcional
+    }
+
+    Los registros pendientes del lote (con su corrección si se envía) pasan de nuevo por
+    modelo, reglas de calidad y UPSERT. Los que vuelvan a fallar quedan en un lote nuevo.
+    """
+    lote_id = payload.get('lote_id')
+    correcciones = payload.get('correcciones') or {}
+    if not isinstance(lote_id, str) or not lote_id:
+        raise HTTPException(status_code=400, detail="'lote_id' debe ser una cadena no vacía")
+    if not isinstance(correcciones, dict):
+        raise HTTPException(status_code=400, detail="'correcciones' debe ser un objeto {id: registro}")
+
+    # Asegurar que los rechazos aún en cola estén persistidos
+    _escritor_rechazados.vaciar()
+    conexion = obtener_conexion_db()
     try:
-        for tabla, datos in grupos.items():
-            # Paso 1: Validación contra el diccionario de datos
-            registros_modelo, errores_modelo = _parsear_registros_para_tabla(tabla, datos)
-            resumen["errores"].extend(errores_modelo)
+        def escribir_grupos():
+            # FOR UPDATE: un reproceso concurrente del mismo lote espera y, al confirmar este,
+            # ya no los ve pendientes. Va dentro del reintento porque el rollback suelta el bloqueo.
+            with conexion.cursor() as cur:
+                cur.execute(
+                    "SELECT id, tabla, indice, registro FROM registros_rechazados "
+                    "WHERE lote_id = %s AND NOT reprocesado ORDER BY id FOR UPDATE",
+                    (lote_id,),
+                )
+                filas = cur.fetchall()
+            if not filas:
+                raise HTTPException(status_code=404, detail=f"No hay rechazados pendientes para el lote '{lote_id}'")
+
+            # Un registro con varios motivos genera varias filas; se reingresa una sola vez.
+            # Identidad: tabla, posición en su carga y registro original (el índice solo no
+            # basta para rechazos anteriores a que fuera único en el lote)
+            pendientes: Dict[Tuple[str, Any, str], Dict[str, Any]] = {}
+            for id_rechazo, tabla, indice, registro in filas:
+                clave = (tabla, indice if indice is not None else f"id:{id_rechazo}", json.dumps(registro, sort_keys=True))
+                item = pendientes.setdefault(clave, {"ids": [], "registro": registro})
+                item["ids"].append(id_rechazo)
+                corregido = correcciones.get(str(id_rechazo))
+                if corregido is not None:
+                    item["registro"] = corregido
+
+            grupos: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+            for (tabla, _, _), item in pendientes.items():
+                grupos[tabla].append(item)
+
+            procesados: Dict[str, Any] = {}
+            errores: List[Dict[str, Any]] = []
+            cambios: List[Tuple[str, str, List[BaseModel]]] = []
+            for tabla in ORDEN_DEPENDENCIAS:
+                items = grupos.get(tabla)
+                if not items:
+                    continue
+                datos = [i["registro"] if isinstance(i["registro"], dict) else {} for i in items]
+                registros_modelo, errores_modelo = _parsear_registros_para_tabla(tabla, datos)
+                registros_validos, errores_calidad = validar_reglas_calidad(tabla, registros_modelo, conexion)
+                _referir_errores_calidad(len(datos), errores_modelo, errores_calidad)
+                errores.extend(errores_modelo + errores_calidad)
+                conteos = upsert_por_tabla(conexion, tabla, registros_validos, confirmar=False)
+                cambios.append((tabla, OPERACION_UPSERT, registros_validos))
+                procesados[tabla] = {"recibidos": len(datos), "validos": len(registros_validos),
+                                     "upsert": sum(conteos.values()), **conteos}
+
+            # Todos los pendientes quedan cerrados: los que fallaron de nuevo viajan en el lote nuevo
+            with conexion.cursor() as cur:
+                cur.execute(
+                    "UPDATE registros_rechazados SET reprocesado = TRUE WHERE id = ANY(%s)",
+                    ([id_r for item in pendientes.values() for id_r in item["ids"]],),
+                )
+            return procesados, errores, cambios
+
+        procesados, errores, cambios = con_reintentos(conexion, escribir_grupos)
+        marca = marcar_cambios(conexion)
+        conexion.commit()
+        registrar_cambios(marca, cambios)
+        return {
+            "lote_id": lote_id,
+            "procesados": procesados,
+            "rechazados": registrar_rechazados(errores),
+        }
+    finally:
+        liberar_conexion_db(conexion)
+
+
+# =============================
+# Carga de CSV por streaming
+# =============================
+_CARGA_CSV_LOTE = int(os.getenv('CARGA_CSV_LOTE_FILAS', '5000'))
+# Bloques del cuerpo recibidos y aún no procesados (contrapresión sobre el cliente)
+_CARGA_CSV_BLOQUES_EN_VUELO = int(os.getenv('CARGA_CSV_BLOQUES_EN_VUELO', '16'))
+_FIRMA_GZIP = b"\x1f\x8b"
+# Fin de línea como open(newline=''), que es lo que espera csv.reader: str.splitlines
+# también corta en \x0b, \x0c, \x1c-\x1e, \x85, \u2028 y \u2029, que son datos válidos
+_LINEA_CSV = re.compile(r"[^\r\n]*(?:\r\n?|\n)|[^\r\n]+")
 
-            # Paso 2: Reglas de calidad por tabla
-            registros_validos, errores_calidad = validar_reglas_calidad(tabla, registros_modelo, conexion)
-            resumen["errores"].extend(errores_calidad)
-
-            # Paso 3: Inserción/actualización (UPSERT)
-            cantidad = 0
-            if tabla == "departamentos":
-                cantidad = upsert_departamentos(conexion, registros_validos)  # type: ignore[arg-type]
-            elif tabla == "trabajos":
-                cantidad = upsert_trabajos(conexion, registros_validos)  # type: ignore[arg-type]
-            elif tabla == "empleados_contratados":
-                cantidad = upsert_empleados(conexion, registros_validos)  # type: ignore[arg-type]
-
-            resumen["procesados"][tabla] = {
-                "recibidos": len(datos),
-                "validos": len(registros_validos),
-                "upsert": cantidad,
-            }
 
-        return resumen
+def _lineas_carga(bloques: "queue.Queue") -> Iterator[str]:
+    """Líneas de texto del cuerpo a medida que llegan sus bloques.
+
+    `None` marca el fin del cuerpo y una excepción en la cola la propaga. Si el cuerpo
+    empieza con la firma gzip se descomprime en línea (admite varios miembros).
+    """
+    decodificador = codecs.getincrementaldecoder("utf-8-sig")()
+    descompresor = None
+    con_datos = False  # el miembro gzip actual recibió bytes
+    primero = True
+    pendiente = ""
+    while True:
+        bloque = bloques.get()
+        if isinstance(bloque, BaseException):
+            raise bloque
+        fin = bloque is None
+        datos = b"" if fin else bloque
+        if primero and datos:
+            primero = False
+            if datos.startswith(_FIRMA_GZIP):
+                descompresor = zlib.decompressobj(wbits=31)
+        if descompresor is not None:
+            partes = []
+            while datos:
+                partes.append(descompresor.decompress(datos))
+                con_datos = True
+                if not descompresor.eof:
+                    break
+                datos = descompresor.unused_data
+                descompresor, con_datos = zlib.decompressobj(wbits=31), False
+            if fin and con_datos:
+                raise EOFError("el contenido gzip está truncado")
+            datos = b"".join(partes)
+        texto = pendiente + decodificador.decode(datos, final=fin)
+        lineas = _LINEA_CSV.findall(texto)
+        # Una línea sin salto puede continuar en el próximo bloque (y un "\r" final, ser "\r\n")
+        pendiente = "" if fin or not lineas or lineas[-1].endswith("\n") else lineas.pop()
+        yield from lineas
+        if fin:
+            return
+
+
+def _escribir_lote_carga(conexion, tabla: str, lote: List[Dict[str, Any]], indices: List[int]) -> Tuple[int, Dict[str, int], List[Dict[str, Any]]]:
+    """Valida un lote de filas del CSV y copia las válidas. Devuelve (validas, conteos del UPSERT, errores).
+
+    `indices` es la posición de cada fila en el archivo; los errores quedan referidos a ella.
+    """
+    registros_modelo, errores_modelo = _parsear_registros_para_tabla(tabla, lote)
+    descartados = {e["indice"] for e in errores_modelo}
+    for err in errores_modelo:
+        err["indice"] = indices[err["indice"]]
+    indices_modelo = [indice for i, indice in enumerate(indices) if i not in descartados]
+    registros_validos, errores_calidad = validar_reglas_calidad(tabla, registros_modelo, conexion)
+    for err in errores_calidad:
+        err["indice"] = indices_modelo[err["indice"]]
+    with conexion.cursor() as cursor:
+        conteos = copiar_registros(cursor, tabla, registros_validos)
+    return len(registros_validos), conteos, errores_modelo + errores_calidad
+
+
+def cargar_csv_en_tabla(tabla: str, bloques: "queue.Queue", cabecera: bool = False) -> Dict[str, Any]:
+    """Carga en `tabla` el CSV que llega por `bloques` (ver _lineas_carga) en una transacción.
+
+    Cada fila pasa por normalizar_fila_csv (mismas reglas que modelos.py: en empleados
+    basta el id y los vacíos quedan NULL; en el resto se descartan filas incompletas),
+    luego por los modelos y las reglas de calidad, y las válidas se copian por lotes de
+    CARGA_CSV_LOTE_FILAS con COPY + UPSERT. Solo hay en memoria el lote en curso (y los
+    rechazados, que van al dead-letter recién tras el commit).
+    """
+    columnas = COLUMNAS_POR_TABLA[tabla]
+    es_empleados = tabla == "empleados_contratados"
+    resumen: Dict[str, Any] = {"tabla": tabla, "recibidas": 0, "descartadas": 0, "validas": 0, "escritas": 0,
+                               **dict.fromkeys(CONTEOS_UPSERT, 0)}
+    rechazados: List[Dict[str, Any]] = []
+
+    def escribir(lote: List[Dict[str, Any]], indices: List[int]) -> None:
+        validas, conteos, errores = _escribir_lote_carga(conexion, tabla, lote, indices)
+        resumen["validas"] += validas
+        resumen["escritas"] += sum(conteos.values())
+        for clave, cantidad in conteos.items():
+            resumen[clave] += cantidad
+        rechazados.extend(errores)
+
+    conexion = obtener_conexion_db()
+    try:
+        lector = csv.reader(_lineas_carga(bloques))
+        if cabecera:
+            next(lector, None)
+        lote: List[Dict[str, Any]] = []
+        indices: List[int] = []
+        for indice, fila in enumerate(lector):
+            resumen["recibidas"] += 1
+            fila = normalizar_fila_csv(fila, es_empleados)
+            if fila is None:
+                resumen["descartadas"] += 1
+                continue
+            if len(fila) != len(columnas):
+                rechazados.append({
+                    "indice": indice,
+                    "tabla": tabla,
+                    "codigo": CODIGO_ESQUEMA_INVALIDO,
+                    "detalle": f"se esperaban {len(columnas)} columnas y la fila tiene {len(fila)}",
+                    "registro": dict(zip(columnas, fila)),
+                })
+                continue
+            lote.append(dict(zip(columnas, fila)))
+            indices.append(indice)
+            if len(lote) >= _CARGA_CSV_LOTE:
+                escribir(lote, indices)
+                lote, indices = [], []
+        if lote:
+            escribir(lote, indices)
+        marca = marcar_cambios(conexion)
+        conexion.commit()
+        # Como en /restaurar, las filas cargadas en bloque no van al registro de cambios
+        registrar_cambios(marca, [(tabla, OPERACION_BARRERA, [])])
+    except (UnicodeDecodeError, zlib.error, EOFError, csv.Error) as e:
+        conexion.rollback()
+        raise HTTPException(status_code=400, detail=f"CSV inválido en la fila {resumen['recibidas'] + 1}: {e}")
+    except BaseException:
+        conexion.rollback()
+        raise
     finally:
-        conexion.close()
+        liberar_conexion_db(conexion)
+    # Si la carga se revierte, el dead-letter no recibe filas de un lote que el cliente no vio
+    resumen["rechazados"] = registrar_rechazados(rechazados)
+    return resumen
+
+
+@app.post("/cargas/csv/{tabla}")
+async def cargar_csv(tabla: str, request: Request, cabecera: bool = False):
+    """Carga un CSV (opcionalmente comprimido con gzip) enviado como cuerpo de la solicitud.
+
+    Columnas en el orden de la tabla, sin cabecera salvo `cabecera=true`. El cuerpo se
+    procesa a medida que llega: un hilo parsea, valida y copia por lotes mientras se
+    siguen recibiendo bytes, sin guardar el archivo en disco ni en memoria. Si el hilo
+    se atrasa, se deja de leer del cliente. Todo se confirma en una transacción al final;
+    los rechazados van al dead-letter como en /transacciones.
+
+    Ejemplo: curl -H "X-API-Key: ..." --data-binary @hired_employees.csv.gz \\
+             "http://127.0.0.1:8000/cargas/csv/empleados_contratados"
+    """
+    if tabla not in TABLAS_VALIDAS:
+        raise HTTPException(status_code=400, detail="'tabla' debe ser una tabla válida")
+
+    _ts_ini = datetime.now()
+    bloques: "queue.Queue" = queue.Queue(maxsize=_CARGA_CSV_BLOQUES_EN_VUELO)
+    tarea = asyncio.ensure_future(run_in_threadpool(cargar_csv_en_tabla, tabla, bloques, cabecera))
+
+    async def entregar(item) -> bool:
+        # Sin bloquear el event loop; False si el hilo ya terminó (con error)
+        while not tarea.done():
+            try:
+                bloques.put_nowait(item)
+                return True
+            except queue.Full:
+                await asyncio.sleep(0.005)
+        return False
+
+    recibidos = 0
+    try:
+        async for bloque in request.stream():
+            if bloque:
+                recibidos += len(bloque)
+                if not await entregar(bloque):
+                    break
+    except BaseException as e:
+        # Cliente desconectado o cancelación: el hilo revierte la transacción
+        await entregar(e if isinstance(e, Exception) else RuntimeError("carga cancelada"))
+        await asyncio.wait({tarea})
+        if not tarea.cancelled():
+            tarea.exception()  # ya se informa la excepción original
+        raise
+    await entregar(None)
+    resumen = await tarea
+    resumen["bytes"] = recibidos
+    resumen["duracion_ms"] = int((datetime.now() - _ts_ini).total_seconds() * 1000)
+    return respuesta_json(resumen)
 
 
 # =============================
@@ -822,6 +4038,222 @@ def obtener_datos_tabla(conexion, tabla: str) -> List[Dict[str, Any]]:
         raise RuntimeError(f"Error obteniendo datos de {tabla}: {e}")
 
 
+def version_datos_tabla(conexion, tabla: str) -> int:
+    """Versión de datos de la tabla: cambia con cada sentencia que la modifica."""
+    with conexion.cursor() as cursor:
+        cursor.execute("SELECT COALESCE(SUM(version), 0) FROM versiones_tablas WHERE tabla = %s", (tabla,))
+        return int(cursor.fetchone()[0])
+
+
+# =============================
+# Exportación paginada de tablas (cursores del lado del servidor)
+# =============================
+_EXPORTACION_BLOQUE = int(os.getenv('EXPORTACION_BLOQUE_FILAS', '5000'))
+# Una página con `limite` se lee completa antes de responder (ver exportar_tabla)
+_EXPORTACION_LIMITE_MAX = int(os.getenv('EXPORTACION_LIMITE_MAX', '100000'))
+# Columnas de cada tabla en el orden de la base (coinciden con los campos del modelo)
+COLUMNAS_POR_TABLA: Dict[str, Tuple[str, ...]] = {
+    tabla: tuple(modelo.model_fields) for tabla, modelo in TABLAS_VALIDAS.items()
+}
+FORMATOS_EXPORTACION = {
+    "jsonl": "application/x-ndjson",
+    "json": "application/json",
+    "csv": "text/csv; charset=utf-8",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+class _AcumuladorBytes(io.RawIOBase):
+    """Destino de escritura en memoria que se vacía tras cada bloque emitido."""
+
+    def __init__(self):
+        super().__init__()
+        self._partes: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, datos) -> int:
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def tomar(self) -> bytes:
+        datos = b"".join(self._partes)
+        self._partes.clear()
+        return datos
+
+
+def _codificador_exportacion(formato: str, columnas: Tuple[str, ...]) -> Tuple[bytes, Callable[[List[tuple]], bytes], Callable[[], bytes]]:
+    """Devuelve (apertura, codificar_bloque, cierre) en bytes para el formato pedido."""
+    if formato == 'jsonl':
+        def codificar(filas):
+            return b"".join(a_json_bytes(dict(zip(columnas, f))) + b"\n" for f in filas)
+        return b"", codificar, lambda: b""
+
+    if formato == 'json':
+        primero = [True]
+
+        def codificar(filas):
+            fragmento = a_json_bytes([dict(zip(columnas, f)) for f in filas])[1:-1]
+            separador = b"" if primero[0] else b","
+            primero[0] = False
+            return separador + fragmento
+        return b"[", codificar, lambda: b"]"
+
+    if formato == 'csv':
+        import csv
+
+        def codificar(filas):
+            buffer = io.StringIO()
+            escritor = csv.writer(buffer, lineterminator='\n')
+            escritor.writerows(
+                [v.isoformat() if hasattr(v, 'isoformat') else v for v in f] for f in filas
+            )
+            return buffer.getvalue().encode('utf-8')
+        return codificar([columnas]), codificar, lambda: b""
+
+    # Arrow IPC (formato stream): un record batch por bloque leído del cursor
+    try:
+        import pyarrow as pa  # Lazy import
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Dependencia pyarrow no disponible: {e}")
+    tipos = {'fecha_hora': pa.timestamp('us')}
+    esquema = pa.schema([
+        (c, tipos.get(c, pa.int32() if c == 'id' or c.startswith('id_') else pa.string())) for c in columnas
+    ])
+    destino = _AcumuladorBytes()
+    escritor = pa.ipc.new_stream(destino, esquema)
+
+    def codificar(filas):
+        valores = list(zip(*filas))
+        escritor.write_batch(pa.record_batch(
+            [pa.array(valores[i], type=campo.type) for i, campo in enumerate(esquema)], schema=esquema,
+        ))
+        return destino.tomar()
+
+    def cerrar():
+        escritor.close()
+        return destino.tomar()
+    return b"", codificar, cerrar
+
+
+@app.get("/tablas/{tabla}")
+def exportar_tabla(
+    tabla: str,
+    formato: str = "jsonl",
+    columnas: Optional[str] = None,
+    desde_id: int = 0,
+    limite: Optional[int] = None,
+    fecha_desde: Optional[datetime] = None,
+    fecha_hasta: Optional[datetime] = None,
+    id_departamento: Optional[int] = None,
+    id_trabajo: Optional[int] = None,
+):
+    """Lee una tabla por páginas (keyset por id) y la envía en streaming.
+
+    - `formato`: jsonl (por defecto), json, csv o arrow (Arrow IPC stream).
+    - `columnas`: proyección separada por comas (p. ej. `id,nombre`).
+    - `desde_id` / `limite`: devuelve filas con `id > desde_id` en orden de id. Si hay
+      más filas después de la página, la cabecera `X-Siguiente-Desde-Id` trae el cursor
+      siguiente (el id de la última fila enviada).
+    - `fecha_desde` (incluida) / `fecha_hasta` (excluida), `id_departamento`, `id_trabajo`:
+      filtros solo para empleados_contratados.
+    Las filas se leen con un cursor del lado del servidor en bloques de
+    EXPORTACION_BLOQUE_FILAS, así que la tabla nunca se materializa en memoria. Con
+    `limite` (hasta EXPORTACION_LIMITE_MAX) la página se lee antes de responder, porque la
+    cabecera sale antes que el cuerpo.
+    """
+    if tabla not in TABLAS_VALIDAS:
+        raise HTTPException(status_code=400, detail=f"Tabla no soportada: {tabla}")
+    if formato not in FORMATOS_EXPORTACION:
+        raise HTTPException(status_code=400, detail=f"'formato' debe ser uno de: {', '.join(FORMATOS_EXPORTACION)}")
+    if limite is not None and not 1 <= limite <= _EXPORTACION_LIMITE_MAX:
+        raise HTTPException(status_code=400, detail=f"'limite' debe estar entre 1 y {_EXPORTACION_LIMITE_MAX}")
+
+    disponibles = COLUMNAS_POR_TABLA[tabla]
+    if columnas:
+        seleccion = tuple(dict.fromkeys(c.strip() for c in columnas.split(',') if c.strip()))
+        invalidas = [c for c in seleccion if c not in disponibles]
+        if invalidas or not seleccion:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Columnas no válidas para {tabla}: {', '.join(invalidas) or '(vacío)'}; disponibles: {', '.join(disponibles)}",
+            )
+    else:
+        seleccion = disponibles
+
+    condiciones = ["id > %s"]
+    parametros: List[Any] = [desde_id]
+    filtros = {
+        "fecha_hora >= %s": fecha_desde,
+        "fecha_hora < %s": fecha_hasta,
+        "id_departamento = %s": id_departamento,
+        "id_trabajo = %s": id_trabajo,
+    }
+    for condicion, valor in filtros.items():
+        if valor is None:
+            continue
+        if tabla != 'empleados_contratados':
+            raise HTTPException(status_code=400, detail="Los filtros de fecha y FK solo aplican a empleados_contratados")
+        condiciones.append(condicion)
+        parametros.append(valor)
+    where = " AND ".join(condiciones)
+
+    apertura, codificar, cierre = _codificador_exportacion(formato, seleccion)
+    cabeceras: Dict[str, str] = {}
+    # El cursor siguiente sale de las filas leídas: con una proyección sin id, se lee igual
+    id_extra = limite is not None and 'id' not in seleccion
+    lectura = seleccion + ('id',) if id_extra else seleccion
+    sql = f"SELECT {', '.join(lectura)} FROM {tabla} WHERE {where} ORDER BY id"
+    pagina: Optional[List[tuple]] = None
+    if limite is not None:
+        # Una fila de más en la misma sentencia (y la misma instantánea): si llega, hay página siguiente
+        conexion = obtener_conexion_lectura()
+        try:
+            with conexion.cursor(name=f"exportar_{uuid.uuid4().hex}") as cursor:
+                cursor.execute(sql + " LIMIT %s", parametros + [limite + 1])
+                pagina = cursor.fetchmany(limite + 1)
+        finally:
+            # Página ya leída: la conexión no queda esperando al cliente
+            liberar_conexion_db(conexion)
+        if len(pagina) > limite:
+            del pagina[limite:]
+            cabeceras["X-Siguiente-Desde-Id"] = str(pagina[-1][lectura.index('id')])
+        if id_extra:
+            pagina = [fila[:-1] for fila in pagina]
+
+    def filas_sin_limite():
+        # La conexión se toma al empezar a enviar: si el cliente se va antes del primer
+        # bloque, Starlette nunca arranca el generador y su finally no correría
+        conexion = obtener_conexion_lectura()
+        try:
+            with conexion.cursor(name=f"exportar_{uuid.uuid4().hex}") as cursor:
+                cursor.itersize = _EXPORTACION_BLOQUE
+                cursor.execute(sql, parametros)
+                while True:
+                    filas = cursor.fetchmany(_EXPORTACION_BLOQUE)
+                    if not filas:
+                        break
+                    yield filas
+        finally:
+            liberar_conexion_db(conexion)
+
+    def generar():
+        if apertura:
+            yield apertura
+        if pagina is not None:
+            for i in range(0, len(pagina), _EXPORTACION_BLOQUE):
+                yield codificar(pagina[i:i + _EXPORTACION_BLOQUE])
+        else:
+            for filas in filas_sin_limite():
+                yield codificar(filas)
+        final = cierre()
+        if final:
+            yield final
+
+    return StreamingResponse(generar(), media_type=FORMATOS_EXPORTACION[formato], headers=cabeceras)
+
+
 def _avro_schema_para_tabla(tabla: str) -> Dict[str, Any]:
     """Devuelve un esquema AVRO simple para la tabla."""
     if tabla == 'departamentos':
@@ -868,48 +4300,63 @@ def exportar_avro_por_tabla(registros: List[Dict[str, Any]], tabla: str, ruta_ar
     # Asegurar directorio
     os.makedirs(os.path.dirname(ruta_archivo), exist_ok=True)
     try:
-        with open(ruta_archivo, 'wb') as f:
+        # Escribir en un temporal y renombrar: nunca queda un respaldo truncado con nombre válido
+        temporal = ruta_archivo + '.tmp'
+        with open(temporal, 'wb') as f:
             writer(f, schema, registros)
+        os.replace(temporal, ruta_archivo)
         return len(registros)
     except Exception as e:
         raise RuntimeError(f"Error exportando AVRO para {tabla}: {e}")
 
 
-def exportar_parquet_por_tabla(registros: List[Dict[str, Any]], tabla: str, ruta_archivo: str) -> int:
-    """Exporta registros a PARQUET en ruta_archivo. Devuelve cantidad de registros."""
-    try:
-        import pyarrow as pa  # Lazy import
-        import pyarrow.parquet as pq
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Dependencia pyarrow no disponible: {e}")
+_RESPALDO_FILAS_POR_GRUPO = int(os.getenv('RESPALDO_PARQUET_FILAS_POR_GRUPO', '100000'))
+
 
-    # Definir esquema simple (fecha_hora como string para compatibilidad)
+def esquema_arrow_tabla(tabla: str):
+    """Esquema Arrow de respaldos PARQUET y segmentos del registro de cambios."""
+    import pyarrow as pa  # Lazy import
+
+    # Esquema simple (fecha_hora como string para compatibilidad)
     if tabla == 'departamentos':
-        schema = pa.schema([
+        return pa.schema([
             ('id', pa.int32()),
             ('departamento', pa.string()),
         ])
-    elif tabla == 'trabajos':
-        schema = pa.schema([
+    if tabla == 'trabajos':
+        return pa.schema([
             ('id', pa.int32()),
             ('trabajo', pa.string()),
         ])
-    elif tabla == 'empleados_contratados':
-        schema = pa.schema([
+    if tabla == 'empleados_contratados':
+        return pa.schema([
             ('id', pa.int32()),
             ('nombre', pa.string()),
             ('fecha_hora', pa.string()),
             ('id_departamento', pa.int32()),
             ('id_trabajo', pa.int32()),
         ])
-    else:
-        raise HTTPException(status_code=400, detail=f"Tabla no soportada: {tabla}")
+    raise HTTPException(status_code=400, detail=f"Tabla no soportada: {tabla}")
+
+
+def exportar_parquet_por_tabla(registros: List[Dict[str, Any]], tabla: str, ruta_archivo: str) -> int:
+    """Exporta registros a PARQUET en ruta_archivo. Devuelve cantidad de registros."""
+    try:
+        import pyarrow as pa  # Lazy import
+        import pyarrow.parquet as pq
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Dependencia pyarrow no disponible: {e}")
+
+    schema = esquema_arrow_tabla(tabla)
 
     # Asegurar directorio
     os.makedirs(os.path.dirname(ruta_archivo), exist_ok=True)
     try:
         table = pa.Table.from_pylist(registros, schema=schema)
-        pq.write_table(table, ruta_archivo)
+        # Varios row groups: la restauración los decodifica en paralelo
+        temporal = ruta_archivo + '.tmp'
+        pq.write_table(table, temporal, row_group_size=_RESPALDO_FILAS_POR_GRUPO)
+        os.replace(temporal, ruta_archivo)
         return len(registros)
     except Exception as e:
         raise RuntimeError(f"Error exportando PARQUET para {tabla}: {e}")
@@ -923,9 +4370,15 @@ def generar_respaldos(payload: Dict[str, Any] = Body(..., description="Genera re
     {
       "formato": "avro" | "parquet",
       "tablas": ["departamentos", "trabajos", "empleados_contratados"],  # opcional, por defecto todas
-      "directorio": "respaldos"  # opcional
+      "directorio": "respaldos",  # opcional
+      "omitir_sin_cambios": false  # opcional: no re-exporta tablas sin escrituras desde su último respaldo válido
     }
+
+    Cada archivo se acompaña de un manifiesto (<archivo>.manifest.json) con registros,
+    SHA-256 y la versión de datos de la tabla al momento de exportar.
     """
+    from lectura_respaldos import escribir_manifiesto
+
     formato = payload.get('formato')
     if formato not in {"avro", "parquet"}:
         raise HTTPException(status_code=400, detail="'formato' debe ser 'avro' o 'parquet'")
@@ -939,8 +4392,10 @@ def generar_respaldos(payload: Dict[str, Any] = Body(..., description="Genera re
     directorio = payload.get('directorio') or 'respaldos'
     if not isinstance(directorio, str) or not directorio:
         raise HTTPException(status_code=400, detail="'directorio' debe ser una cadena no vacía")
+    omitir_sin_cambios = bool(payload.get('omitir_sin_cambios', False))
 
-    conexion = obtener_conexion_db()
+    # Exportación de solo lectura: puede salir de una réplica
+    conexion = obtener_conexion_lectura()
     resultado: List[Dict[str, Any]] = []
 
     try:
@@ -950,7 +4405,33 @@ def generar_respaldos(payload: Dict[str, Any] = Body(..., description="Genera re
             if tabla not in TABLAS_VALIDAS:
                 raise HTTPException(status_code=400, detail=f"Tabla no soportada: {tabla}")
 
+            # Versión y datos salen de la misma instantánea: el manifiesto describe
+            # exactamente lo exportado aunque haya escrituras concurrentes
+            conexion.rollback()
+            with conexion.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                # La instantánea decide qué entradas del registro de cambios reproducir sobre este respaldo
+                cursor.execute("SELECT txid_current_snapshot()::text, now()")
+                instantanea, instante = cursor.fetchone()
+            version = version_datos_tabla(conexion, tabla)
+
+            if omitir_sin_cambios:
+                previos = [a for a in _listar_respaldos_por_tabla(tabla, directorio)["archivos"]
+                           if a["formato"] == formato and a["manifiesto"]]
+                previo, _ = _ultimo_respaldo_valido(previos)
+                if previo is not None and previo["manifiesto"].get("version_datos") == version:
+                    conexion.rollback()
+                    resultado.append({
+                        'tabla': tabla,
+                        'formato': formato,
+                        'ruta': previo['ruta'],
+                        'registros': previo['registros'],
+                        'omitido': True,
+                    })
+                    continue
+
             registros = obtener_datos_tabla(conexion, tabla)
+            conexion.rollback()
             nombre_archivo = f"{tabla}_{ts}.{ 'avro' if formato == 'avro' else 'parquet' }"
             ruta_archivo = os.path.join(directorio, nombre_archivo)
 
@@ -958,12 +4439,24 @@ def generar_respaldos(payload: Dict[str, Any] = Body(..., description="Genera re
                 cantidad = exportar_avro_por_tabla(registros, tabla, ruta_archivo)
             else:
                 cantidad = exportar_parquet_por_tabla(registros, tabla, ruta_archivo)
+            del registros
+            manifiesto = escribir_manifiesto(ruta_archivo, {
+                'tabla': tabla,
+                'formato': formato,
+                'registros': cantidad,
+                'version_datos': version,
+                'instantanea': instantanea,
+                'instante': instante.isoformat(),
+                'creado': datetime.now().isoformat(),
+            })
 
             resultado.append({
                 'tabla': tabla,
                 'formato': formato,
                 'ruta': ruta_archivo,
                 'registros': cantidad,
+                'sha256': manifiesto['sha256'],
+                'omitido': False,
             })
 
         _dur_ms_total = int((datetime.now() - _t0).total_seconds() * 1000)
@@ -974,7 +4467,7 @@ def generar_respaldos(payload: Dict[str, Any] = Body(..., description="Genera re
             'duracion_ms_total': _dur_ms_total,
         }
     finally:
-        conexion.close()
+        liberar_conexion_db(conexion)
 
 # =============================
 # UI simple para pruebas
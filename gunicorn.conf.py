@@ -0,0 +1,35 @@
+"""Configuración de gunicorn para servir la app con varios workers uvicorn.
+
+Uso:
+    gunicorn -c gunicorn.conf.py fast_api_con_rest:app
+
+Variables de entorno:
+    WEB_CONCURRENCY   número de workers (por defecto, CPUs disponibles para el proceso)
+    PORT              puerto de escucha (por defecto 8000)
+    GUNICORN_TIMEOUT  segundos antes de reiniciar un worker bloqueado (por defecto 120)
+"""
+import os
+
+
+def _cpus_disponibles() -> int:
+    # Respeta la afinidad/cgroups del contenedor cuando el sistema lo permite
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+workers = int(os.getenv("WEB_CONCURRENCY") or _cpus_disponibles())
+# El pool de conexiones de cada worker se dimensiona con este valor (ver _tamano_pool_por_worker)
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# Importar la app una sola vez en el proceso maestro: los workers comparten por
+# copy-on-write el código y las estructuras de solo lectura (esquemas, OpenAPI, etc.).
+# Conexiones, pools e hilos se crean de forma diferida dentro de cada worker.
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
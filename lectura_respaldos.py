@@ -0,0 +1,326 @@
+"""Lectura paralela y verificación de integridad de respaldos PARQUET y AVRO.
+
+Este módulo no importa FastAPI ni psycopg2: los procesos que decodifican AVRO lo
+importan al arrancar (contexto 'spawn') y así se mantienen livianos.
+
+Ambos lectores generan tuplas (desplazamiento, lote), donde `desplazamiento` es el
+índice en el archivo de la primera fila del lote y `lote` es un pyarrow.Table o, si
+Arrow no pudo armar las columnas, la lista de dicts original.
+
+Cada respaldo va acompañado de un manifiesto (`<archivo>.manifest.json`) con su
+checksum SHA-256, tamaño y cantidad de registros, que `verificar_respaldo` contrasta
+con el archivo.
+"""
+import hashlib
+import io
+import json
+import mmap
+import os
+from collections import deque
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+_MAGIA_AVRO = b"Obj\x01"
+_TAMANO_SYNC = 16
+
+
+def en_paralelo(ejecutor: Executor, funcion: Callable, tareas: Iterable[Tuple], ventana: int, ordenado: bool) -> Iterator[Any]:
+    """Ejecuta funcion(*tarea) con a lo sumo `ventana` tareas en vuelo.
+
+    ordenado=True entrega los resultados en el orden de las tareas; False, a medida que
+    terminan. La ventana acota la memoria: no se decodifica más de lo que se consume.
+    """
+    pendientes: deque = deque()
+    tareas = iter(tareas)
+    agotadas = False
+    while True:
+        while not agotadas and len(pendientes) < ventana:
+            tarea = next(tareas, None)
+            if tarea is None:
+                agotadas = True
+                break
+            pendientes.append(ejecutor.submit(funcion, *tarea))
+        if not pendientes:
+            return
+        if ordenado:
+            yield pendientes.popleft().result()
+        else:
+            listas, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+            for futuro in listas:
+                pendientes.remove(futuro)
+                yield futuro.result()
+
+
+# =============================
+# PARQUET: memory map + row groups en hilos
+# =============================
+def _leer_grupo_parquet(ruta: str, metadata, indice: int, columnas: Sequence[str], desplazamiento: int):
+    import pyarrow.parquet as pq
+
+    # Un lector por tarea: ParquetFile no garantiza lecturas concurrentes seguras
+    archivo = pq.ParquetFile(ruta, memory_map=True, metadata=metadata)
+    return desplazamiento, archivo.read_row_group(indice, columns=list(columnas), use_threads=False)
+
+
+def lotes_parquet(ruta: str, columnas: Sequence[str], hilos: int, ordenado: bool = True) -> Iterator[Tuple[int, Any]]:
+    """Decodifica los row groups de un PARQUET mapeado en memoria en `hilos` hilos.
+
+    La decodificación de Arrow libera el GIL, así que los hilos trabajan en paralelo
+    mientras quien consume valida y copia el lote anterior. Con un solo row group
+    se lee con los hilos internos de Arrow (paralelismo por columna).
+    """
+    import pyarrow.parquet as pq
+    from concurrent.futures import ThreadPoolExecutor
+
+    archivo = pq.ParquetFile(ruta, memory_map=True)
+    presentes = [c for c in columnas if c in archivo.schema_arrow.names]
+    metadata = archivo.metadata
+    if metadata.num_row_groups <= 1 or hilos <= 1:
+        desplazamiento = 0
+        for indice in range(metadata.num_row_groups):
+            tabla = archivo.read_row_group(indice, columns=presentes, use_threads=True)
+            yield desplazamiento, tabla
+            desplazamiento += tabla.num_rows
+        return
+
+    tareas = []
+    desplazamiento = 0
+    for indice in range(metadata.num_row_groups):
+        tareas.append((ruta, metadata, indice, presentes, desplazamiento))
+        desplazamiento += metadata.row_group(indice).num_rows
+    with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="parquet") as ejecutor:
+        yield from en_paralelo(ejecutor, _leer_grupo_parquet, tareas, hilos * 2, ordenado)
+
+
+# =============================
+# AVRO: división por bloques (sync marker) + procesos
+# =============================
+def _leer_long(buffer, pos: int) -> Tuple[int, int]:
+    """Decodifica un long AVRO (varint zigzag) y devuelve (valor, nueva posición)."""
+    byte = buffer[pos]
+    pos += 1
+    valor = byte & 0x7F
+    desplazamiento = 7
+    while byte & 0x80:
+        byte = buffer[pos]
+        pos += 1
+        valor |= (byte & 0x7F) << desplazamiento
+        desplazamiento += 7
+    return (valor >> 1) ^ -(valor & 1), pos
+
+
+def bloques_avro(buffer) -> Tuple[int, List[Tuple[int, int, int]]]:
+    """Recorre la cabecera y los bloques de un contenedor AVRO sin decodificar registros.
+
+    Devuelve (fin_cabecera, [(inicio, fin, cantidad_registros), ...]). Cada bloque termina
+    en el sync marker de la cabecera; si no coincide el archivo está corrupto.
+    """
+    if bytes(buffer[:4]) != _MAGIA_AVRO:
+        raise ValueError("No es un archivo AVRO (cabecera inválida)")
+    pos = 4
+    # Metadatos: mapa AVRO en bloques (cantidad negativa => viene el tamaño en bytes)
+    while True:
+        cantidad, pos = _leer_long(buffer, pos)
+        if cantidad == 0:
+            break
+        if cantidad < 0:
+            cantidad = -cantidad
+            _, pos = _leer_long(buffer, pos)
+        for _ in range(cantidad * 2):  # clave y valor
+            largo, pos = _leer_long(buffer, pos)
+            pos += largo
+    sync = bytes(buffer[pos:pos + _TAMANO_SYNC])
+    fin_cabecera = pos + _TAMANO_SYNC
+    pos = fin_cabecera
+
+    bloques: List[Tuple[int, int, int]] = []
+    total = len(buffer)
+    while pos < total:
+        inicio = pos
+        cantidad, pos = _leer_long(buffer, pos)
+        tamano, pos = _leer_long(buffer, pos)
+        pos += tamano
+        if bytes(buffer[pos:pos + _TAMANO_SYNC]) != sync:
+            raise ValueError(f"Sync marker inválido en el byte {pos}")
+        pos += _TAMANO_SYNC
+        bloques.append((inicio, pos, cantidad))
+    return fin_cabecera, bloques
+
+
+def decodificar_rango_avro(ruta: str, fin_cabecera: int, inicio: int, fin: int, desplazamiento: int):
+    """Decodifica los bloques AVRO entre `inicio` y `fin` (se ejecuta en un proceso aparte).
+
+    Arma un contenedor válido con la cabecera original + el rango de bloques y lo lee
+    con fastavro. Devuelve (desplazamiento, pyarrow.Table) o la lista de dicts si Arrow no
+    puede inferir tipos consistentes.
+    """
+    from fastavro import reader
+
+    with open(ruta, 'rb') as f:
+        cabecera = f.read(fin_cabecera)
+        f.seek(inicio)
+        datos = f.read(fin - inicio)
+    registros = list(reader(io.BytesIO(cabecera + datos)))
+    return desplazamiento, _a_tabla_arrow(registros)
+
+
+def _a_tabla_arrow(registros: List[dict]):
+    import pyarrow as pa
+
+    try:
+        return pa.Table.from_pylist(registros)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return registros
+
+
+def lotes_avro(ruta: str, procesos: int, ordenado: bool = True, min_bytes_paralelo: int = 32 * 1024 * 1024,
+               bytes_por_tarea: int = 8 * 1024 * 1024) -> Iterator[Tuple[int, Any]]:
+    """Lee un AVRO como lotes Arrow, decodificando rangos de bloques en `procesos` procesos.
+
+    Los límites de bloque salen de la cabecera de cada bloque (verificados con el sync
+    marker) recorriendo el archivo mapeado en memoria, sin decodificar registros. Archivos
+    menores que `min_bytes_paralelo` se decodifican en el proceso actual.
+    """
+    with open(ruta, 'rb') as f:
+        tamano_archivo = os.fstat(f.fileno()).st_size
+        if tamano_archivo == 0:
+            raise ValueError("Archivo AVRO vacío")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapa:
+            fin_cabecera, bloques = bloques_avro(mapa)
+
+    # Agrupar bloques contiguos en tareas de ~bytes_por_tarea
+    tareas: List[Tuple[str, int, int, int, int]] = []
+    desplazamiento = 0
+    actual: Optional[List[int]] = None  # [inicio, fin, desplazamiento, cantidad]
+    for inicio, fin, cantidad in bloques:
+        if actual is None:
+            actual = [inicio, fin, desplazamiento, 0]
+        actual[1] = fin
+        actual[3] += cantidad
+        desplazamiento += cantidad
+        if actual[1] - actual[0] >= bytes_por_tarea:
+            tareas.append((ruta, fin_cabecera, actual[0], actual[1], actual[2]))
+            actual = None
+    if actual is not None:
+        tareas.append((ruta, fin_cabecera, actual[0], actual[1], actual[2]))
+
+    if procesos <= 1 or len(tareas) <= 1 or tamano_archivo < min_bytes_paralelo:
+        for tarea in tareas:
+            yield decodificar_rango_avro(*tarea)
+        return
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # 'spawn': el proceso web tiene hilos (pool, escritor de rechazados) y fork no es seguro
+    contexto = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=procesos, mp_context=contexto) as ejecutor:
+        yield from en_paralelo(ejecutor, decodificar_rango_avro, tareas, procesos * 2, ordenado)
+
+
+# =============================
+# Manifiestos e integridad
+# =============================
+SUFIJO_MANIFIESTO = ".manifest.json"
+
+
+def ruta_manifiesto(ruta: str) -> str:
+    return ruta + SUFIJO_MANIFIESTO
+
+
+def sha256_archivo(ruta: str, bloque: int = 1024 * 1024) -> str:
+    """SHA-256 del archivo leído por bloques (memoria constante)."""
+    h = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for trozo in iter(lambda: f.read(bloque), b''):
+            h.update(trozo)
+    return h.hexdigest()
+
+
+def escribir_manifiesto(ruta: str, datos: Dict[str, Any]) -> Dict[str, Any]:
+    """Escribe el manifiesto de `ruta` con `datos` + tamaño y checksum del archivo.
+
+    Se escribe en un temporal y se renombra: un manifiesto nunca queda a medias.
+    """
+    manifiesto = dict(datos)
+    manifiesto.update({
+        'archivo': os.path.basename(ruta),
+        'bytes': os.path.getsize(ruta),
+        'sha256': sha256_archivo(ruta),
+    })
+    destino = ruta_manifiesto(ruta)
+    temporal = destino + '.tmp'
+    with open(temporal, 'w', encoding='utf-8') as f:
+        json.dump(manifiesto, f, ensure_ascii=False, indent=2)
+    os.replace(temporal, destino)
+    return manifiesto
+
+
+def leer_manifiesto(ruta: str) -> Optional[Dict[str, Any]]:
+    """Manifiesto de `ruta` o None si no existe o no es JSON válido."""
+    try:
+        with open(ruta_manifiesto(ruta), 'r', encoding='utf-8') as f:
+            manifiesto = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifiesto if isinstance(manifiesto, dict) else None
+
+
+def contar_registros_respaldo(ruta: str) -> int:
+    """Cuenta registros sin decodificarlos.
+
+    PARQUET: solo lee el footer (metadatos de los row groups). AVRO: recorre las
+    cabeceras de bloque del archivo mapeado en memoria, verificando cada sync marker.
+    """
+    if ruta.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        return pq.read_metadata(ruta).num_rows
+    with open(ruta, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("Archivo AVRO vacío")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapa:
+            _, bloques = bloques_avro(mapa)
+    return sum(cantidad for _, _, cantidad in bloques)
+
+
+def verificar_respaldo(ruta: str, completa: bool = False) -> Dict[str, Any]:
+    """Verifica que un respaldo sea legible y esté completo.
+
+    La verificación rápida compara tamaño y cantidad de registros (footer PARQUET o
+    cabeceras de bloque AVRO) con el manifiesto. `completa=True` además recalcula el
+    SHA-256 leyendo el archivo entero. Sin manifiesto solo se valida la estructura.
+    """
+    resultado: Dict[str, Any] = {
+        'ruta': ruta,
+        'valido': False,
+        'completa': completa,
+        'manifiesto': None,
+        'registros': None,
+        'errores': [],
+    }
+    errores: List[str] = resultado['errores']
+    if not os.path.isfile(ruta):
+        errores.append("El archivo no existe")
+        return resultado
+
+    manifiesto = leer_manifiesto(ruta)
+    resultado['manifiesto'] = manifiesto
+    if manifiesto is None:
+        resultado['advertencia'] = "Sin manifiesto: solo se verificó la estructura"
+    elif manifiesto.get('bytes') != os.path.getsize(ruta):
+        errores.append(f"Tamaño {os.path.getsize(ruta)} distinto del manifiesto ({manifiesto.get('bytes')})")
+
+    try:
+        resultado['registros'] = contar_registros_respaldo(ruta)
+    except Exception as e:
+        errores.append(f"Estructura inválida: {e}")
+
+    if manifiesto is not None:
+        if resultado['registros'] is not None and manifiesto.get('registros') != resultado['registros']:
+            errores.append(f"{resultado['registros']} registros en el archivo, {manifiesto.get('registros')} en el manifiesto")
+        if completa and not errores and sha256_archivo(ruta) != manifiesto.get('sha256'):
+            errores.append("El checksum SHA-256 no coincide con el manifiesto")
+
+    resultado['valido'] = not errores
+    return resultado
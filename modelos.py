@@ -1,15 +1,104 @@
 import time
 import psycopg2
 import csv
+import hashlib
+import argparse
+import json
+import uuid
 from datetime import datetime
-from typing import List, Dict, Any
+from collections import defaultdict
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import os
 import io
+import psycopg2.extras
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
 load_dotenv()
 
+# Identificador de esta ejecución para agrupar sus filas rechazadas
+LOTE_IMPORTACION = str(uuid.uuid4())
+
+COLUMNAS_DEPARTAMENTOS = ('id', 'departamento')
+COLUMNAS_TRABAJOS = ('id', 'trabajo')
+COLUMNAS_EMPLEADOS = ('id', 'nombre', 'fecha_hora', 'id_departamento', 'id_trabajo')
+
+# Filas por COPY en el motor arrow
+TAMANO_LOTE_ARROW = int(os.getenv('IMPORTACION_LOTE_ARROW_FILAS', '100000'))
+
+# Mismo registro de cambios que el servicio (ver registro_cambios.py); vacío lo desactiva
+REGISTRO_CAMBIOS_DIR = os.getenv('REGISTRO_CAMBIOS_DIR', 'registro_cambios')
+
+
+class BarrerasImportacion:
+    """Barreras del registro de cambios para las transacciones que confirma el importador.
+
+    Las filas importadas no van al registro de cambios: como en /restaurar, cada
+    transacción deja una barrera para que /restaurar/punto_en_el_tiempo no reproduzca a
+    través de ella. La marca (secuencia, txid, instante) se toma antes del commit y queda
+    reservada en `_pendientes` hasta que escribir() guarda los segmentos: si el proceso
+    cae antes, la restauración responde 409 igual que con un worker caído.
+    """
+
+    def __init__(self, directorio: str):
+        self._directorio = directorio
+        self._marca = None
+        self._entradas: Dict[str, List[Tuple]] = defaultdict(list)
+        self._secuencias: List[int] = []
+
+    def confirmar(self, conexion, *tablas: str) -> None:
+        """Deja la barrera de `tablas` en la transacción en curso y la confirma."""
+        if self._directorio and tablas:
+            from registro_cambios import OPERACION_BARRERA, MarcaPendientes
+
+            with conexion.cursor() as cursor:
+                # Sin la secuencia el servicio nunca preparó el esquema: no hay registro que proteger
+                cursor.execute("SELECT to_regclass('registro_cambios_secuencia') IS NOT NULL")
+                if cursor.fetchone()[0]:
+                    cursor.execute("SELECT nextval('registro_cambios_secuencia'), txid_current(), clock_timestamp()")
+                    secuencia, txid, instante = cursor.fetchone()
+                    if self._marca is None:
+                        self._marca = MarcaPendientes(self._directorio)
+                    self._marca.reservar(secuencia, instante)
+                    self._secuencias.append(secuencia)
+                    for tabla in tablas:
+                        self._entradas[tabla].append((secuencia, txid, instante, OPERACION_BARRERA, None))
+        conexion.commit()
+
+    def escribir(self) -> None:
+        """Escribe un segmento por tabla con las barreras acumuladas y libera su reserva."""
+        if not self._secuencias:
+            return
+        import pyarrow as pa
+        from registro_cambios import escribir_segmento
+
+        while self._entradas:
+            tabla = next(iter(self._entradas))
+            # Sin columnas de la tabla: las barreras no traen filas
+            escribir_segmento(self._directorio, tabla, pa.schema([]), self._entradas[tabla])
+            del self._entradas[tabla]
+        self._marca.liberar(self._secuencias)
+        self._secuencias = []
+
+
+_barreras = BarrerasImportacion(REGISTRO_CAMBIOS_DIR)
+
+SQL_TABLA_RECHAZADOS = """
+    CREATE TABLE IF NOT EXISTS registros_rechazados (
+        id BIGSERIAL PRIMARY KEY,
+        lote_id VARCHAR(36) NOT NULL,
+        tabla VARCHAR(50) NOT NULL,
+        indice INTEGER,
+        codigo VARCHAR(50) NOT NULL,
+        detalle JSONB,
+        registro JSONB,
+        creado TIMESTAMP NOT NULL DEFAULT now(),
+        reprocesado BOOLEAN NOT NULL DEFAULT FALSE
+    );
+    CREATE INDEX IF NOT EXISTS idx_registros_rechazados_lote
+        ON registros_rechazados (lote_id);
+"""
+
 def obtener_conexion_db():
     """Establece conexión con la base de datos PostgreSQL."""
     try:
@@ -63,14 +152,64 @@ def crear_tablas(conexion):
                     id_trabajo INTEGER REFERENCES trabajos(id)
                 )
             """)
+
+            # El dead-letter no se borra: conserva rechazos de importaciones previas
+            cursor.execute(SQL_TABLA_RECHAZADOS)
             
-            conexion.commit()
+            _barreras.confirmar(conexion, 'departamentos', 'trabajos', 'empleados_contratados')
             print("Tablas creadas correctamente")
     except Exception as e:
         conexion.rollback()
         print(f"Error al crear las tablas: {e}")
         raise
 
+def crear_tablas_si_no_existen(conexion):
+    """Crea las tablas si no existen, sin borrar datos (modo incremental)."""
+    try:
+        with conexion.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS departamentos (
+                    id INTEGER PRIMARY KEY,
+                    departamento VARCHAR(50) NOT NULL
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS trabajos (
+                    id INTEGER PRIMARY KEY,
+                    trabajo VARCHAR(200) NOT NULL
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS empleados_contratados (
+                    id INTEGER PRIMARY KEY,
+                    nombre VARCHAR(100),
+                    fecha_hora TIMESTAMP,
+                    id_departamento INTEGER REFERENCES departamentos(id),
+                    id_trabajo INTEGER REFERENCES trabajos(id)
+                )
+            """)
+            cursor.execute(SQL_TABLA_RECHAZADOS)
+            # Tabla de control: un checkpoint por archivo importado
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS importacion_checkpoints (
+                    archivo VARCHAR(255) PRIMARY KEY,
+                    tabla VARCHAR(50) NOT NULL,
+                    checksum CHAR(64) NOT NULL,
+                    offset_bytes BIGINT NOT NULL DEFAULT 0,
+                    filas_confirmadas BIGINT NOT NULL DEFAULT 0,
+                    completado BOOLEAN NOT NULL DEFAULT FALSE,
+                    actualizado TIMESTAMP NOT NULL DEFAULT now()
+                )
+            """)
+            # Filas del CSV recorridas (incluidas las descartadas): al reanudar, los rechazos
+            # siguen numerados por su posición en el archivo
+            cursor.execute("ALTER TABLE importacion_checkpoints ADD COLUMN IF NOT EXISTS filas_leidas BIGINT NOT NULL DEFAULT 0")
+        conexion.commit()
+    except Exception as e:
+        conexion.rollback()
+        print(f"Error al asegurar las tablas: {e}")
+        raise
+
 def contar_registros_tabla(conexion, nombre_tabla):
     """Cuenta el número de registros en una tabla."""
     try:
@@ -81,46 +220,269 @@ def contar_registros_tabla(conexion, nombre_tabla):
         print(f"Error al contar registros de {nombre_tabla}: {e}")
         return 0
 
+def normalizar_fila_csv(fila: List[str], es_empleados: bool) -> Optional[List[Any]]:
+    """Aplica las reglas de limpieza del importador a una fila CSV.
+
+    - Empleados: basta con que el ID exista; los campos vacíos se rellenan con None.
+    - Otros archivos: todos los campos deben estar completos.
+    Devuelve la fila procesada o None si debe descartarse.
+    """
+    if not fila:
+        return None
+    if es_empleados:
+        if not fila[0].strip():
+            return None
+        return [campo.strip() if campo.strip() else None for campo in fila]
+    if all(campo.strip() for campo in fila):
+        return fila
+    return None
+
 def procesar_csv_por_lotes(ruta_archivo: str, tamano_lote: int = 1000):
-    """Lee un archivo CSV en lotes y los devuelve como un generador."""
+    """Lee un archivo CSV en lotes y los devuelve como un generador.
+
+    Genera tuplas (lote, indices): `indices` es la posición de cada fila del lote en el
+    archivo (sin contar la cabecera), con la que se registran sus rechazos.
+    """
     lote_actual = []
+    indices = []
     total_registros = 0
-    
+    es_empleados = ruta_archivo.endswith('hired_employees.csv')
+
     try:
         with open(ruta_archivo, 'r', encoding='utf-8') as archivo:
             lector_csv = csv.reader(archivo)
             # Saltar la cabecera si existe
-            if ruta_archivo.endswith('hired_employees.csv'):
+            if es_empleados:
                 next(lector_csv)
-            
-            for fila in lector_csv:
-                # Para hired_employees.csv, asegurarse de que al menos el ID no esté vacío
-                if ruta_archivo.endswith('hired_employees.csv'):
-                    if fila and fila[0].strip():  # Verificar que al menos el ID existe
-                        # Rellenar campos vacíos con None
-                        fila_procesada = [campo.strip() if campo.strip() else None for campo in fila]
-                        lote_actual.append(fila_procesada)
-                        total_registros += 1
-                else:
-                    # Para otros archivos, verificar que todos los campos estén completos
-                    if all(campo.strip() for campo in fila):
-                        lote_actual.append(fila)
-                        total_registros += 1
-                
+
+            for indice, fila in enumerate(lector_csv):
+                fila_procesada = normalizar_fila_csv(fila, es_empleados)
+                if fila_procesada is not None:
+                    lote_actual.append(fila_procesada)
+                    indices.append(indice)
+                    total_registros += 1
+
                 if len(lote_actual) >= tamano_lote:
-                    yield lote_actual
+                    yield lote_actual, indices
                     lote_actual = []
+                    indices = []
             
             # Devolver el último lote si existe
             if lote_actual:
-                yield lote_actual
+                yield lote_actual, indices
             
             print(f"Total de registros leídos de {ruta_archivo}: {total_registros}")
     except Exception as e:
         print(f"Error al procesar el archivo {ruta_archivo}: {e}")
         raise
 
-def insertar_lote_departamentos(conexion, lote: List[List[str]]):
+def procesar_csv_por_lotes_desde(ruta_archivo: str, offset_inicial: int = 0, tamano_lote: int = 1000,
+                                 fila_inicial: int = 0) -> Iterator[Tuple[List[List[Any]], List[int], int, int]]:
+    """Lee un CSV en lotes a partir de un offset en bytes.
+
+    Devuelve tuplas (lote, indices, offset_fin, filas_leidas): offset_fin es la posición
+    en bytes justo después de la última fila del lote y filas_leidas las filas recorridas
+    hasta ahí; ambos sirven como checkpoint para reanudar. `indices` es la posición de cada
+    fila en el archivo (sin la cabecera), contando desde `fila_inicial`. Una fila con un
+    campo entre comillas que contiene saltos de línea ocupa varias líneas del archivo.
+    """
+    es_empleados = ruta_archivo.endswith('hired_employees.csv')
+    lote_actual = []
+    indices = []
+    offset = offset_inicial
+    fila_actual = fila_inicial
+    consumido = [offset_inicial]
+    try:
+        # Modo binario para que los offsets sean posiciones reales del archivo
+        with open(ruta_archivo, 'rb') as archivo:
+            archivo.seek(offset_inicial)
+            # La cabecera solo existe al inicio del archivo
+            if es_empleados and offset_inicial == 0:
+                consumido[0] += len(archivo.readline())
+                offset = consumido[0]
+
+            def lineas():
+                for linea in archivo:
+                    consumido[0] += len(linea)
+                    yield linea.decode('utf-8')
+
+            # csv.reader pide las líneas de a una y devuelve la fila al completarla:
+            # tras cada fila, lo consumido es exactamente hasta su fin
+            for fila in csv.reader(lineas()):
+                offset = consumido[0]
+                fila_procesada = normalizar_fila_csv(fila, es_empleados)
+                if fila_procesada is not None:
+                    lote_actual.append(fila_procesada)
+                    indices.append(fila_actual)
+                fila_actual += 1
+
+                if len(lote_actual) >= tamano_lote:
+                    yield lote_actual, indices, offset, fila_actual
+                    lote_actual = []
+                    indices = []
+
+            # El último lote se emite aunque venga vacío para registrar el offset final
+            yield lote_actual, indices, offset, fila_actual
+    except Exception as e:
+        print(f"Error al procesar el archivo {ruta_archivo} desde el byte {offset_inicial}: {e}")
+        raise
+
+def _enteros_arrow(columna):
+    """Convierte una columna de texto a int32: (valores, máscara de valores no enteros).
+
+    Los vacíos quedan nulos sin contar como inválidos; lo que no es un entero de 32 bits
+    (p. ej. '5.0' o 'abc', igual que int() en el lector previo) queda nulo e inválido.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    enteros = pc.cast(pc.if_else(pc.match_substring_regex(columna, r"^-?\d{1,10}$"), columna, None), pa.int64())
+    valido = pc.fill_null(pc.and_(pc.greater_equal(enteros, -2**31), pc.less_equal(enteros, 2**31 - 1)), False)
+    invalido = pc.and_(pc.is_valid(columna), pc.invert(valido))
+    return pc.cast(pc.if_else(valido, enteros, None), pa.int32()), invalido
+
+def procesar_csv_arrow(ruta_archivo: str, columnas: Tuple[str, ...], tamano_lote: int = TAMANO_LOTE_ARROW):
+    """Lee un CSV con el lector multihilo de pyarrow y lo devuelve en lotes.
+
+    Genera tuplas (pyarrow.Table tipada, rechazos) con las mismas reglas que
+    procesar_csv_por_lotes + insertar_lote_*, pero por columnas: ids int32, `fecha_hora`
+    timestamp, vacíos como NULL y filtrado con pyarrow.compute. Los rechazos tienen el
+    formato de registrar_rechazados, con el índice de la fila en el archivo (sin la
+    cabecera), como procesar_csv_por_lotes. A diferencia del lector previo, el archivo se
+    parsea completo en memoria (en formato columnar) antes de emitir el primer lote.
+    """
+    import bisect
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+
+    es_empleados = ruta_archivo.endswith('hired_employees.csv')
+    cabecera = 1 if es_empleados else 0
+    mal_formadas = []
+
+    def fila_mal_formada(fila):
+        # Se llama desde los hilos del lector: solo acumular. `number` cuenta desde 1 e
+        # incluye la cabecera; el lector multihilo no lo informa
+        mal_formadas.append((
+            fila.number - 1 - cabecera if fila.number is not None and fila.number > 0 else None,
+            'fila_invalida',
+            f"se esperaban {fila.expected_columns} columnas y la fila tiene {fila.actual_columns}",
+            next(csv.reader([fila.text]), []),
+        ))
+        return 'skip'
+
+    def leer(hilos: bool):
+        del mal_formadas[:]
+        return pacsv.read_csv(
+            ruta_archivo,
+            read_options=pacsv.ReadOptions(column_names=list(columnas), skip_rows=cabecera, use_threads=hilos),
+            parse_options=pacsv.ParseOptions(invalid_row_handler=fila_mal_formada),
+            # Todo como texto: un valor que no convierte no debe descartar el bloque entero
+            convert_options=pacsv.ConvertOptions(
+                column_types={c: pa.string() for c in columnas}, strings_can_be_null=False, quoted_strings_can_be_null=False
+            ),
+        )
+
+    tabla = leer(True)
+    if any(indice is None for indice, *_ in mal_formadas):
+        # Sin la posición de las filas omitidas no se ubica en el archivo ninguna posterior:
+        # solo en ese caso se relee con un hilo, que sí las numera
+        tabla = leer(False)
+    mal_formadas.sort(key=lambda rechazo: rechazo[0])
+    # Fila i de la tabla -> fila del archivo: i más las omitidas antes que ella
+    omitidas = [indice - j for j, (indice, *_) in enumerate(mal_formadas)]
+
+    def en_archivo(fila: int) -> int:
+        return fila + bisect.bisect_right(omitidas, fila)
+
+    # Al menos un lote, aunque el archivo esté vacío, para entregar las filas mal formadas
+    for desde in range(0, max(tabla.num_rows, 1), tamano_lote):
+        lote = tabla.slice(desde, tamano_lote)
+        recortados = {c: pc.utf8_trim_whitespace(lote.column(c)) for c in columnas}
+        if es_empleados:
+            # Basta con el id; los demás campos vacíos (o solo espacios) son NULL
+            valores = {c: pc.if_else(pc.equal(v, ""), None, v) for c, v in recortados.items()}
+            presente = pc.is_valid(valores['id'])
+        else:
+            # Todos los campos completos; el texto se conserva tal cual
+            valores = {c: lote.column(c) for c in columnas}
+            valores['id'] = recortados['id']
+            presente = None
+            for c in columnas:
+                completo = pc.not_equal(recortados[c], "")
+                presente = completo if presente is None else pc.and_(presente, completo)
+        # Posición en el lote sin filtrar de cada fila que queda, para numerar sus rechazos
+        posiciones = pc.indices_nonzero(presente).to_pylist()
+        lote = lote.filter(presente)
+        valores = {c: v.filter(presente) for c, v in valores.items()}
+
+        errores = {}
+        no_enteros = []
+        for c in ('id', 'id_departamento', 'id_trabajo'):
+            if c in valores:
+                valores[c], invalido = _enteros_arrow(valores[c])
+                no_enteros.append(invalido)
+        descartar = no_enteros[0]
+        for invalido in no_enteros[1:]:
+            descartar = pc.or_(descartar, invalido)
+        errores['fila_invalida'] = (descartar, "id, id_departamento o id_trabajo no es un entero de 32 bits")
+        if 'fecha_hora' in valores:
+            # Mismo recorte que insertar_lote_empleados: 'T' -> ' ', sin fracción ni 'Z'
+            fecha = pc.utf8_rtrim(
+                pc.replace_substring_regex(pc.replace_substring(valores['fecha_hora'], 'T', ' '), r"\..*$", ""),
+                characters="Z",
+            )
+            valores['fecha_hora'] = pc.strptime(fecha, format='%Y-%m-%d %H:%M:%S', unit='s', error_is_null=True)
+            # Fecha inválida: se registra, pero la fila se carga con NULL
+            fecha_invalida = pc.and_(pc.and_(pc.is_valid(fecha), pc.is_null(valores['fecha_hora'])), pc.invert(descartar))
+            errores['fecha_invalida'] = (fecha_invalida, "fecha_hora no tiene el formato '%Y-%m-%d %H:%M:%S'")
+
+        rechazos = mal_formadas if desde == 0 else []
+        for codigo, (mascara, detalle) in errores.items():
+            indices = pc.indices_nonzero(mascara).to_pylist()
+            if indices:
+                originales = lote.take(indices).to_pylist()
+                rechazos.extend(
+                    (en_archivo(desde + posiciones[indice]), codigo, detalle, [original[c] for c in columnas])
+                    for indice, original in zip(indices, originales)
+                )
+        yield pa.table([valores[c] for c in columnas], names=list(columnas)).filter(pc.invert(descartar)), rechazos
+
+def _texto_copy(valor: str) -> str:
+    """Escapa un campo para COPY en formato text (p. ej. los saltos de línea de un campo CSV entre comillas)."""
+    return valor.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def _copiar_lote(cursor, output, tabla: str, columnas: Tuple[str, ...], upsert: bool, formato: str = 'text'):
+    """Copia un buffer a la tabla con COPY FROM.
+
+    Con upsert=True el buffer se copia a una tabla temporal de staging y luego se
+    aplica INSERT ... ON CONFLICT, de modo que recargar filas existentes no falla.
+    `formato` 'csv' es la salida de pyarrow.csv.write_csv (motor arrow).
+    """
+    def copiar(destino):
+        if formato == 'csv':
+            cursor.copy_expert(f"COPY {destino} ({', '.join(columnas)}) FROM STDIN WITH (FORMAT csv)", output)
+        else:
+            cursor.copy_from(output, destino, columns=columnas)
+
+    if not upsert:
+        copiar(tabla)
+        return
+    staging = f"_stg_{tabla}"
+    cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {tabla} INCLUDING DEFAULTS, _fila BIGSERIAL)")
+    copiar(staging)
+    lista = ", ".join(columnas)
+    actualizar = ", ".join(f"{c} = EXCLUDED.{c}" for c in columnas if c != 'id')
+    # ON CONFLICT no admite dos filas con el mismo id en una sentencia: gana la última del lote
+    cursor.execute(
+        f"INSERT INTO {tabla} ({lista}) SELECT DISTINCT ON (id) {lista} FROM {staging} ORDER BY id, _fila DESC "
+        f"ON CONFLICT (id) DO UPDATE SET {actualizar}"
+    )
+    cursor.execute(f"TRUNCATE {staging}")
+
+def insertar_lote_departamentos(conexion, lote: List[List[str]], upsert: bool = False, confirmar: bool = True,
+                          indices: Optional[List[int]] = None) -> int:
     """Inserta un lote de departamentos en la base de datos usando COPY FROM."""
     try:
         with conexion.cursor() as cursor:
@@ -129,55 +491,94 @@ def insertar_lote_departamentos(conexion, lote: List[List[str]]):
             for fila in lote:
                 # Asegurarse de que los datos estén en el formato correcto para COPY FROM
                 # y manejar posibles valores None o vacíos
-                line = f"{fila[0]}\t{fila[1]}\n"
+                line = f"{fila[0]}\t{_texto_copy(fila[1])}\n"
                 output.write(line)
             output.seek(0) # Volver al inicio del "archivo"
             
-            cursor.copy_from(output, 'departamentos', columns=('id', 'departamento'))
-            conexion.commit()
+            _copiar_lote(cursor, output, 'departamentos', ('id', 'departamento'), upsert)
+            if confirmar:
+                _barreras.confirmar(conexion, 'departamentos')
+            return len(lote)
     except Exception as e:
         conexion.rollback()
         print(f"Error al insertar departamentos con COPY FROM: {e}")
         raise
 
-def insertar_lote_trabajos(conexion, lote: List[List[str]]):
+def insertar_lote_trabajos(conexion, lote: List[List[str]], upsert: bool = False, confirmar: bool = True,
+                          indices: Optional[List[int]] = None) -> int:
     """Inserta un lote de trabajos en la base de datos usando COPY FROM."""
     try:
         with conexion.cursor() as cursor:
             output = io.StringIO()
             for fila in lote:
-                line = f"{fila[0]}\t{fila[1]}\n"
+                line = f"{fila[0]}\t{_texto_copy(fila[1])}\n"
                 output.write(line)
             output.seek(0)
             
-            cursor.copy_from(output, 'trabajos', columns=('id', 'trabajo'))
-            conexion.commit()
+            _copiar_lote(cursor, output, 'trabajos', ('id', 'trabajo'), upsert)
+            if confirmar:
+                _barreras.confirmar(conexion, 'trabajos')
+            return len(lote)
     except Exception as e:
         conexion.rollback()
         print(f"Error al insertar trabajos con COPY FROM: {e}")
         raise
 
-def insertar_lote_empleados(conexion, lote: List[List[str]]):
-    """Inserta un lote de empleados en la base de datos usando COPY FROM."""
+def registrar_rechazados(cursor, tabla: str, rechazos: List[Tuple[int, str, str, List[Any]]], columnas: Tuple[str, ...]):
+    """Inserta en bloque las filas rechazadas de un lote en el dead-letter.
+
+    Cada rechazo es (indice, codigo, detalle, fila); la fila se guarda como objeto
+    con los nombres de columna de la tabla para poder reprocesarla vía /rechazados.
+    """
+    if not rechazos:
+        return
+    valores = [
+        (
+            LOTE_IMPORTACION,
+            tabla,
+            indice,
+            codigo,
+            json.dumps(detalle),
+            json.dumps(dict(zip(columnas, fila))),
+        )
+        for indice, codigo, detalle, fila in rechazos
+    ]
+    psycopg2.extras.execute_values(
+        cursor,
+        "INSERT INTO registros_rechazados (lote_id, tabla, indice, codigo, detalle, registro) VALUES %s",
+        valores,
+        page_size=1000,
+    )
+
+def insertar_lote_empleados(conexion, lote: List[List[str]], upsert: bool = False, confirmar: bool = True,
+                            indices: Optional[List[int]] = None) -> int:
+    """Inserta un lote de empleados en la base de datos usando COPY FROM.
+
+    Las filas rechazadas (y las fechas inválidas, que se cargan como NULL) se
+    registran en `registros_rechazados` con su código de motivo y su posición en el
+    archivo (`indices`, de procesar_csv_por_lotes*; sin ella, la posición en el lote).
+    """
     try:
         with conexion.cursor() as cursor:
             output = io.StringIO()
             lote_procesado = []
-            for fila in lote:
+            rechazos = []
+            for posicion, fila in enumerate(lote):
+                indice = indices[posicion] if indices is not None else posicion
                 try:
                     if fila[0] is not None:
                         fecha_hora = None
                         if fila[2]:
                             try:
                                 fecha_str = fila[2].replace('T', ' ')
-                                fecha_hora = datetime.strptime(fecha_str.split('.')[0], '%Y-%m-%d %H:%M:%S')
-                            except ValueError:
-                                print(f"Error al procesar fecha para el empleado ID {fila[0]}")
+                                fecha_hora = datetime.strptime(fecha_str.split('.')[0].rstrip('Z'), '%Y-%m-%d %H:%M:%S')
+                            except ValueError as e:
+                                rechazos.append((indice, 'fecha_invalida', str(e), fila))
 
                         # Formatear los datos para COPY FROM. Los valores None deben ser cadenas vacías para COPY FROM.
                         # Los enteros deben ser convertidos a cadena.
                         id_empleado = str(int(fila[0])) if fila[0] is not None else "\\N"
-                        nombre_empleado = fila[1] if fila[1] is not None else "\\N"
+                        nombre_empleado = _texto_copy(fila[1]) if fila[1] is not None else "\\N"
                         fecha_hora_empleado = fecha_hora.strftime('%Y-%m-%d %H:%M:%S') if fecha_hora else "\\N"
                         id_departamento_empleado = str(int(fila[3])) if fila[3] is not None else "\\N"
                         id_trabajo_empleado = str(int(fila[4])) if fila[4] is not None else "\\N"
@@ -186,49 +587,215 @@ def insertar_lote_empleados(conexion, lote: List[List[str]]):
                         output.write(line)
                         lote_procesado.append(fila) # Mantener un registro para el conteo
                 except (ValueError, IndexError) as e:
-                    print(f"Error procesando fila {fila}: {e}")
+                    rechazos.append((indice, 'fila_invalida', str(e), fila))
                     continue
             
             output.seek(0)
             if lote_procesado: # Solo intentar copiar si hay datos válidos
-                cursor.copy_from(output, 'empleados_contratados', columns=('id', 'nombre', 'fecha_hora', 'id_departamento', 'id_trabajo'))
-                conexion.commit()
+                _copiar_lote(cursor, output, 'empleados_contratados', COLUMNAS_EMPLEADOS, upsert)
+            registrar_rechazados(cursor, 'empleados_contratados', rechazos, COLUMNAS_EMPLEADOS)
+            if confirmar:
+                _barreras.confirmar(conexion, 'empleados_contratados')
+            if lote_procesado:
                 print(f"Insertados {len(lote_procesado)} empleados con COPY FROM")
+            if rechazos:
+                print(f"{len(rechazos)} filas de empleados enviadas a registros_rechazados (lote {LOTE_IMPORTACION})")
+            return len(lote_procesado)
     except Exception as e:
         conexion.rollback()
         print(f"Error al insertar empleados con COPY FROM: {e}")
         raise
 
-def importar_todos_los_datos():
-    """Función principal para importar todos los datos."""
+def insertar_lote_arrow(conexion, tabla: str, columnas: Tuple[str, ...], lote, rechazos: List[Tuple[int, str, str, List[Any]]],
+                        upsert: bool = False, confirmar: bool = True) -> int:
+    """Inserta un lote de procesar_csv_arrow con COPY FROM (CSV generado por pyarrow) y registra sus rechazos."""
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    try:
+        with conexion.cursor() as cursor:
+            if lote.num_rows:
+                buffer = pa.BufferOutputStream()
+                pacsv.write_csv(lote, buffer, write_options=pacsv.WriteOptions(include_header=False))
+                _copiar_lote(cursor, pa.BufferReader(buffer.getvalue()), tabla, columnas, upsert, formato='csv')
+            registrar_rechazados(cursor, tabla, rechazos, columnas)
+            if confirmar:
+                _barreras.confirmar(conexion, tabla)
+            if rechazos:
+                print(f"{len(rechazos)} filas de {tabla} enviadas a registros_rechazados (lote {LOTE_IMPORTACION})")
+            return lote.num_rows
+    except Exception as e:
+        conexion.rollback()
+        print(f"Error al insertar {tabla} con COPY FROM (arrow): {e}")
+        raise
+
+def importar_archivo_arrow(conexion, ruta_archivo: str, tabla: str, columnas: Tuple[str, ...]) -> None:
+    """Importa un CSV completo con el motor arrow (un COPY por lote)."""
+    total_registros = 0
+    for i, (lote, rechazos) in enumerate(procesar_csv_arrow(ruta_archivo, columnas), 1):
+        total_registros += insertar_lote_arrow(conexion, tabla, columnas, lote, rechazos)
+        print(f"Lote {i} de {tabla} procesado")
+    _barreras.escribir()
+    print(f"Total de registros leídos de {ruta_archivo}: {total_registros}")
+
+def calcular_checksum_archivo(ruta_archivo: str, tamano_bloque: int = 1024 * 1024) -> str:
+    """Calcula el SHA-256 de un archivo leyéndolo por bloques."""
+    digest = hashlib.sha256()
+    with open(ruta_archivo, 'rb') as archivo:
+        for bloque in iter(lambda: archivo.read(tamano_bloque), b''):
+            digest.update(bloque)
+    return digest.hexdigest()
+
+def leer_checkpoint(conexion, ruta_archivo: str) -> Optional[Dict[str, Any]]:
+    """Devuelve el checkpoint registrado para un archivo, o None si no existe."""
+    with conexion.cursor() as cursor:
+        cursor.execute(
+            "SELECT checksum, offset_bytes, filas_confirmadas, completado, filas_leidas "
+            "FROM importacion_checkpoints WHERE archivo = %s",
+            (ruta_archivo,),
+        )
+        fila = cursor.fetchone()
+    if fila is None:
+        return None
+    return {
+        "checksum": fila[0],
+        "offset_bytes": fila[1],
+        "filas_confirmadas": fila[2],
+        "completado": fila[3],
+        "filas_leidas": fila[4],
+    }
+
+def guardar_checkpoint(conexion, ruta_archivo: str, tabla: str, checksum: str, offset_bytes: int, filas_confirmadas: int, completado: bool,
+                       filas_leidas: int = 0):
+    """Registra el avance de un archivo. No confirma: va en la misma transacción que el lote."""
+    with conexion.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO importacion_checkpoints
+                (archivo, tabla, checksum, offset_bytes, filas_confirmadas, completado, filas_leidas, actualizado)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, now())
+            ON CONFLICT (archivo) DO UPDATE SET
+                tabla = EXCLUDED.tabla,
+                checksum = EXCLUDED.checksum,
+                offset_bytes = EXCLUDED.offset_bytes,
+                filas_confirmadas = EXCLUDED.filas_confirmadas,
+                completado = EXCLUDED.completado,
+                filas_leidas = EXCLUDED.filas_leidas,
+                actualizado = now()
+            """,
+            (ruta_archivo, tabla, checksum, offset_bytes, filas_confirmadas, completado, filas_leidas),
+        )
+
+def importar_archivo_incremental(conexion, ruta_archivo: str, tabla: str, insertar_lote, tamano_lote: int = 1000) -> Dict[str, Any]:
+    """Importa un CSV reanudando desde su último checkpoint.
+
+    - Si el checksum coincide y el archivo ya se completó, se omite por completo.
+    - Si el checksum coincide pero quedó a medias, se reanuda desde offset_bytes.
+    - Si el archivo cambió, se recorre desde el inicio con UPSERT (sin borrar datos).
+    Cada lote y su checkpoint se confirman en la misma transacción.
+    """
+    checksum = calcular_checksum_archivo(ruta_archivo)
+    checkpoint = leer_checkpoint(conexion, ruta_archivo)
+
+    if checkpoint and checkpoint["checksum"] == checksum and checkpoint["completado"]:
+        print(f"{ruta_archivo} sin cambios desde la última importación; se omite")
+        return {"archivo": ruta_archivo, "omitido": True, "filas": checkpoint["filas_confirmadas"]}
+
+    offset = 0
+    filas = 0
+    leidas = 0
+    if checkpoint and checkpoint["checksum"] == checksum:
+        offset = checkpoint["offset_bytes"]
+        filas = checkpoint["filas_confirmadas"]
+        leidas = checkpoint["filas_leidas"]
+        print(f"Reanudando {ruta_archivo} desde el byte {offset} ({filas} filas ya confirmadas)")
+    elif checkpoint:
+        print(f"{ruta_archivo} cambió desde la última importación; se reimporta con UPSERT")
+
+    lotes = procesar_csv_por_lotes_desde(ruta_archivo, offset, tamano_lote, fila_inicial=leidas)
+    for i, (lote, indices, offset_fin, leidas) in enumerate(lotes, 1):
+        try:
+            if lote:
+                filas += insertar_lote(conexion, lote, upsert=True, confirmar=False, indices=indices)
+            guardar_checkpoint(conexion, ruta_archivo, tabla, checksum, offset_fin, filas, False, leidas)
+            _barreras.confirmar(conexion, tabla)
+        except Exception:
+            conexion.rollback()
+            raise
+        print(f"Lote {i} de {tabla} confirmado (byte {offset_fin})")
+
+    guardar_checkpoint(conexion, ruta_archivo, tabla, checksum, offset_fin, filas, True, leidas)
+    conexion.commit()
+    _barreras.escribir()
+    return {"archivo": ruta_archivo, "omitido": False, "filas": filas}
+
+def importar_incremental():
+    """Importación incremental: no borra tablas y reanuda desde checkpoints."""
+    start_time = time.time()
+    conexion = obtener_conexion_db()
+    try:
+        crear_tablas_si_no_existen(conexion)
+        resultados = [
+            importar_archivo_incremental(conexion, 'departments.csv', 'departamentos', insertar_lote_departamentos),
+            importar_archivo_incremental(conexion, 'jobs.csv', 'trabajos', insertar_lote_trabajos),
+            importar_archivo_incremental(conexion, 'hired_employees.csv', 'empleados_contratados', insertar_lote_empleados),
+        ]
+        print("\nResumen de la importación incremental:")
+        for r in resultados:
+            estado = "omitido (sin cambios)" if r["omitido"] else "importado"
+            print(f"- {r['archivo']}: {estado}, {r['filas']} filas confirmadas")
+        print(f"\nImportación incremental completada en {time.time() - start_time:.2f} segundos.")
+    finally:
+        conexion.close()
+        # Lo confirmado antes de un error también deja su barrera
+        _barreras.escribir()
+
+def importar_todos_los_datos(motor: str = 'python'):
+    """Función principal para importar todos los datos.
+
+    `motor` 'arrow' lee cada CSV con procesar_csv_arrow en lugar de csv.reader.
+    """
     start_time = time.time() # Iniciar el temporizador
     try:
         conexion = obtener_conexion_db()
         
         # Crear tablas
         crear_tablas(conexion)
+        _barreras.escribir()
         
         # Importar departamentos
         print("\nImportando departamentos...")
-        for i, lote in enumerate(procesar_csv_por_lotes('departments.csv'), 1):
-            insertar_lote_departamentos(conexion, lote)
-            print(f"Lote {i} de departamentos procesado")
+        if motor == 'arrow':
+            importar_archivo_arrow(conexion, 'departments.csv', 'departamentos', COLUMNAS_DEPARTAMENTOS)
+        else:
+            for i, (lote, indices) in enumerate(procesar_csv_por_lotes('departments.csv'), 1):
+                insertar_lote_departamentos(conexion, lote, indices=indices)
+                print(f"Lote {i} de departamentos procesado")
+            _barreras.escribir()
         total_departamentos = contar_registros_tabla(conexion, 'departamentos')
         print(f"Total de departamentos importados: {total_departamentos}")
         
         # Importar trabajos
         print("\nImportando trabajos...")
-        for i, lote in enumerate(procesar_csv_por_lotes('jobs.csv'), 1):
-            insertar_lote_trabajos(conexion, lote)
-            print(f"Lote {i} de trabajos procesado")
+        if motor == 'arrow':
+            importar_archivo_arrow(conexion, 'jobs.csv', 'trabajos', COLUMNAS_TRABAJOS)
+        else:
+            for i, (lote, indices) in enumerate(procesar_csv_por_lotes('jobs.csv'), 1):
+                insertar_lote_trabajos(conexion, lote, indices=indices)
+                print(f"Lote {i} de trabajos procesado")
+            _barreras.escribir()
         total_trabajos = contar_registros_tabla(conexion, 'trabajos')
         print(f"Total de trabajos importados: {total_trabajos}")
         
         # Importar empleados
         print("\nImportando empleados...")
-        for i, lote in enumerate(procesar_csv_por_lotes('hired_employees.csv'), 1):
-            insertar_lote_empleados(conexion, lote)
-            print(f"Lote {i} de empleados procesado")
+        if motor == 'arrow':
+            importar_archivo_arrow(conexion, 'hired_employees.csv', 'empleados_contratados', COLUMNAS_EMPLEADOS)
+        else:
+            for i, (lote, indices) in enumerate(procesar_csv_por_lotes('hired_employees.csv'), 1):
+                insertar_lote_empleados(conexion, lote, indices=indices)
+                print(f"Lote {i} de empleados procesado")
+            _barreras.escribir()
         total_empleados = contar_registros_tabla(conexion, 'empleados_contratados')
         print(f"Total de empleados importados: {total_empleados}")
         
@@ -257,10 +824,30 @@ def importar_todos_los_datos():
         print(f"Error durante la importación: {e}")
         if 'conexion' in locals():
             conexion.close()
+        # Lo confirmado antes de un error también deja su barrera
+        _barreras.escribir()
         raise
 
 if __name__ == "__main__":
-    importar_todos_los_datos()
+    parser = argparse.ArgumentParser(description="Importa los CSV históricos a PostgreSQL")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="No borra las tablas; reanuda desde checkpoints y omite archivos sin cambios",
+    )
+    parser.add_argument(
+        "--motor",
+        choices=("python", "arrow"),
+        default="python",
+        help="Lector de CSV: csv.reader por filas o pyarrow multihilo por columnas (solo importación completa)",
+    )
+    args = parser.parse_args()
+    if args.incremental:
+        if args.motor != "python":
+            parser.error("--incremental reanuda por offsets de bytes y solo admite --motor python")
+        importar_incremental()
+    else:
+        importar_todos_los_datos(args.motor)
 
 
 
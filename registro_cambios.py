@@ -0,0 +1,283 @@
+"""Registro de cambios (change log) en segmentos PARQUET append-only.
+
+Cada transacción confirmada que escribe por la API agrega sus filas con la marca
+(secuencia, txid, instante) que toma de la base justo antes del commit. Las entradas
+se agrupan en segmentos PARQUET por tabla en `<directorio>/<tabla>/`; un segmento se
+escribe completo en un temporal, se sincroniza a disco y recién entonces se renombra.
+
+Para llevar una tabla desde un respaldo completo hasta un instante T se reproducen, en
+orden de secuencia, las entradas con instante <= T cuya transacción no era visible en
+la instantánea del respaldo (`txid_current_snapshot()`, guardada en su manifiesto).
+Así no importa que una transacción haya empezado antes del respaldo y confirmado
+después: si no está en el respaldo, se reproduce.
+
+Las entradas se escriben después del commit, desde un hilo. Para que una caída en ese
+intervalo no pase inadvertida, cada proceso mantiene una marca en `<directorio>/_pendientes/`
+(creada y sincronizada antes del commit, bloqueada con flock mientras vive) hasta que sus
+transacciones pendientes están en segmentos. Una marca sin bloqueo es de un proceso que
+cayó: el registro puede estar incompleto desde el instante que guarda (`marcas_huerfanas`).
+
+Este módulo no importa FastAPI ni psycopg2.
+"""
+import itertools
+import os
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    # Sin flock no se distingue la marca de un proceso caído de la de uno vivo: no se usan
+    fcntl = None
+
+OPERACION_UPSERT = "upsert"
+# Borrado de toda la tabla (/limpiar_tabla)
+OPERACION_VACIAR = "vaciar"
+# Escritura que no quedó en el registro (restauraciones): no se puede reproducir a través de ella
+OPERACION_BARRERA = "barrera"
+
+COLUMNAS_CONTROL = ("_secuencia", "_txid", "_instante", "_operacion")
+
+CARPETA_PENDIENTES = "_pendientes"
+_SUFIJO_MARCA = ".marca"
+# Instante ISO en UTC con microsegundos y zona: siempre 32 bytes, se reescribe en el lugar
+_LARGO_MARCA = 32
+
+_contador_segmentos = itertools.count()
+
+
+def _esquema_segmento(esquema_tabla):
+    import pyarrow as pa
+
+    return pa.schema([
+        ("_secuencia", pa.int64()),
+        ("_txid", pa.int64()),
+        ("_instante", pa.timestamp("us", tz="UTC")),
+        ("_operacion", pa.string()),
+    ] + list(esquema_tabla))
+
+
+def _marca_nombre(instante: datetime) -> str:
+    # Siempre en UTC: los nombres de distintos procesos y zonas se ordenan igual que los instantes
+    return instante.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+
+
+def _fsync_directorio(ruta: str) -> None:
+    try:
+        fd = os.open(ruta, os.O_RDONLY)
+    except OSError:
+        return  # p. ej. Windows: no se pueden abrir directorios
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def escribir_segmento(directorio: str, tabla: str, esquema_tabla, entradas: Sequence[Tuple]) -> str:
+    """Escribe un segmento con `entradas` = [(secuencia, txid, instante, operacion, valores | None)].
+
+    `valores` sigue el orden de `esquema_tabla` (None en operaciones sin filas). El nombre
+    empieza con el menor instante del segmento para poder descartar segmentos posteriores
+    a T sin abrirlos. Devuelve la ruta escrita.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    esquema = _esquema_segmento(esquema_tabla)
+    nombres = esquema_tabla.names
+    columnas: Dict[str, List[Any]] = {nombre: [] for nombre in esquema.names}
+    for secuencia, txid, instante, operacion, valores in entradas:
+        columnas["_secuencia"].append(secuencia)
+        columnas["_txid"].append(txid)
+        columnas["_instante"].append(instante)
+        columnas["_operacion"].append(operacion)
+        for nombre, valor in zip(nombres, valores if valores is not None else itertools.repeat(None)):
+            columnas[nombre].append(valor)
+    segmento = pa.table(columnas, schema=esquema)
+
+    carpeta = os.path.join(directorio, tabla)
+    os.makedirs(carpeta, exist_ok=True)
+    desde = min(e[2] for e in entradas)
+    ruta = os.path.join(carpeta, f"{_marca_nombre(desde)}_{os.getpid()}_{next(_contador_segmentos):06d}.parquet")
+    temporal = ruta + ".tmp"
+    with open(temporal, "wb") as f:
+        pq.write_table(segmento, f, compression="zstd")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
+    _fsync_directorio(carpeta)
+    return ruta
+
+
+class MarcaPendientes:
+    """Marca de un proceso con transacciones confirmadas cuyas entradas aún no están en segmentos.
+
+    `reservar` se llama antes del commit; `liberar` cuando sus entradas ya están escritas.
+    La marca guarda el instante de la reserva pendiente más antigua y se borra cuando no
+    queda ninguna. Una transacción reservada que no llega a confirmarse mantiene la marca
+    hasta `cerrar` (lado seguro: solo puede sobrar, no faltar).
+    """
+
+    def __init__(self, directorio: str):
+        self._carpeta = os.path.join(directorio, CARPETA_PENDIENTES)
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._reservas: Dict[int, datetime] = {}
+        self._fd: Optional[int] = None
+        self._ruta: Optional[str] = None
+        self._desde: Optional[datetime] = None
+
+    def _escribir_desde(self, desde: datetime, sincronizar: bool) -> None:
+        texto = desde.astimezone(timezone.utc).isoformat(timespec="microseconds")
+        os.pwrite(self._fd, texto.encode().ljust(_LARGO_MARCA), 0)
+        if sincronizar:
+            os.fsync(self._fd)
+        self._desde = desde
+
+    def reservar(self, secuencia: int, instante: datetime) -> None:
+        if fcntl is None:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Tras un fork la marca del padre no es de este proceso
+                self._pid, self._reservas, self._fd, self._ruta = os.getpid(), {}, None, None
+            if self._fd is None:
+                os.makedirs(self._carpeta, exist_ok=True)
+                self._ruta = os.path.join(self._carpeta, f"{os.getpid()}-{uuid.uuid4().hex[:12]}{_SUFIJO_MARCA}")
+                self._fd = os.open(self._ruta, os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+                self._escribir_desde(instante, sincronizar=True)
+                _fsync_directorio(self._carpeta)
+            self._reservas[secuencia] = instante
+
+    def liberar(self, secuencias: Iterable[int]) -> None:
+        with self._lock:
+            if self._pid != os.getpid() or self._fd is None:
+                return
+            for secuencia in secuencias:
+                self._reservas.pop(secuencia, None)
+            if not self._reservas:
+                self._borrar()
+            else:
+                desde = min(self._reservas.values())
+                if desde != self._desde:
+                    # Avanzar el instante no necesita fsync: si se pierde, queda uno anterior
+                    self._escribir_desde(desde, sincronizar=False)
+
+    def cerrar(self) -> None:
+        """Borra la marca; llamar solo cuando todo lo confirmado por el proceso está escrito."""
+        with self._lock:
+            if self._pid == os.getpid() and self._fd is not None:
+                self._reservas.clear()
+                self._borrar()
+
+    def _borrar(self) -> None:
+        # Se borra antes de soltar el bloqueo: quien lo tome después ve el archivo sin enlaces
+        os.remove(self._ruta)
+        os.close(self._fd)
+        self._fd = self._ruta = self._desde = None
+
+
+def marcas_huerfanas(directorio: str) -> List[Tuple[str, datetime]]:
+    """[(ruta, desde)] de las marcas de procesos que cayeron con entradas sin escribir.
+
+    Una marca ilegible (escritura a medias) cuenta desde datetime.min.
+    """
+    carpeta = os.path.join(directorio, CARPETA_PENDIENTES)
+    if fcntl is None or not os.path.isdir(carpeta):
+        return []
+    huerfanas = []
+    for nombre in sorted(os.listdir(carpeta)):
+        if not nombre.endswith(_SUFIJO_MARCA):
+            continue
+        ruta = os.path.join(carpeta, nombre)
+        try:
+            fd = os.open(ruta, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue  # su proceso sigue vivo
+            if os.fstat(fd).st_nlink == 0:
+                continue  # se borró mientras se abría
+            try:
+                desde = datetime.fromisoformat(os.pread(fd, _LARGO_MARCA, 0).decode().strip())
+            except ValueError:
+                desde = datetime.min.replace(tzinfo=timezone.utc)
+            huerfanas.append((ruta, desde))
+        finally:
+            os.close(fd)
+    return huerfanas
+
+
+def parsear_instantanea(texto: str) -> Tuple[int, int, List[int]]:
+    """'xmin:xmax:xip1,xip2' (txid_current_snapshot) -> (xmin, xmax, [xip...])."""
+    xmin, xmax, xip = texto.split(":")
+    return int(xmin), int(xmax), [int(x) for x in xip.split(",") if x]
+
+
+def _rango_columna(metadata, nombre: str) -> Optional[Tuple[Any, Any]]:
+    """(mínimo, máximo) de una columna según las estadísticas del footer, si las hay."""
+    indice = metadata.schema.names.index(nombre)
+    minimo = maximo = None
+    for g in range(metadata.num_row_groups):
+        estadisticas = metadata.row_group(g).column(indice).statistics
+        if estadisticas is None or not estadisticas.has_min_max:
+            return None
+        minimo = estadisticas.min if minimo is None else min(minimo, estadisticas.min)
+        maximo = estadisticas.max if maximo is None else max(maximo, estadisticas.max)
+    return (minimo, maximo) if minimo is not None else None
+
+
+def leer_cambios(directorio: str, tabla: str, hasta: datetime, instantanea: str):
+    """Entradas de `tabla` a reproducir sobre un respaldo tomado con `instantanea`.
+
+    Devuelve (pyarrow.Table ordenada por secuencia o None, segmentos leídos, segmentos
+    totales). Los segmentos cuyo nombre empieza después de `hasta` o cuyo mayor txid es
+    anterior al xmin de la instantánea (todo visible en el respaldo) se descartan sin
+    leer sus datos.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    carpeta = os.path.join(directorio, tabla)
+    if not os.path.isdir(carpeta):
+        return None, 0, 0
+    xmin, xmax, xip = parsear_instantanea(instantanea)
+    limite_nombre = _marca_nombre(hasta)
+    tipo_instante = pa.timestamp("us", tz="UTC")
+    en_curso = pa.array(xip, type=pa.int64())
+
+    partes = []
+    leidos = total = 0
+    for nombre in sorted(os.listdir(carpeta)):
+        if not nombre.endswith(".parquet"):
+            continue
+        total += 1
+        if nombre[:len(limite_nombre)] > limite_nombre:
+            continue
+        ruta = os.path.join(carpeta, nombre)
+        rango_txid = _rango_columna(pq.read_metadata(ruta), "_txid")
+        if rango_txid is not None and rango_txid[1] < xmin:
+            continue
+        leidos += 1
+        segmento = pq.read_table(ruta)
+        txid = segmento.column("_txid")
+        # Visible en el respaldo: txid < xmin, o < xmax y no estaba en curso
+        no_visible = pc.and_(
+            pc.greater_equal(txid, xmin),
+            pc.or_(pc.greater_equal(txid, xmax), pc.is_in(txid, value_set=en_curso)),
+        )
+        mascara = pc.and_(no_visible, pc.less_equal(segmento.column("_instante"), pa.scalar(hasta, type=tipo_instante)))
+        segmento = segmento.filter(mascara)
+        if segmento.num_rows:
+            partes.append(segmento)
+    if not partes:
+        return None, leidos, total
+    # Los segmentos de barreras del importador (modelos.py) solo tienen las columnas de control
+    return pa.concat_tables(partes, promote_options="default").sort_by([("_secuencia", "ascending")]), leidos, total